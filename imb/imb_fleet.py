@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+import os
+from pathlib import Path
+from traceback import format_exc
+
+from imb.imb_headless import FLAG_ANSWER_KEYS
+import imb.imb_yaml as imb_yaml
+
+# Fleet mode runs headless discovery of many deployments in parallel worker processes. Each app's outputs
+#   (discovery.yaml or discovery-telemetry.yaml, override.yaml, servo-manifests/,
+#   launch_servo.sh and the run's log) are written to
+#   <output>/<context>/<namespace>/<deployment>
+#
+# Fleet file:
+#   answers: {}            # answers shared by every target, see imb_headless
+#   targets:
+#     - context: my-context
+#       namespace: shop
+#       deployment: web
+#       container: main    # optional, needed when the deployment has several containers
+#       answers: {}        # optional per target answers
+#   selectors:             # optional, expanded to targets of every matching deployment
+#     - context: my-context
+#       namespace: shop    # optional, all namespaces when omitted
+#       labels: app.kubernetes.io/part-of=shop
+DEFAULT_FLEET_OUTPUT = 'fleet-output'
+FLEET_SUMMARY_FILE = 'fleet-summary.yaml'
+FLEET_LOG_FILE = 'imb.log'
+
+def run_fleet(fleet_path, output_dir=DEFAULT_FLEET_OUTPUT, workers=None):
+    'discover every target of the fleet file, returns the exit code: 0 when all succeeded, 1 otherwise'
+    from concurrent.futures import as_completed, ProcessPoolExecutor
+    from imb.imb_kubernetes import collect_inventory # kubernetes-client is slow to import, imb_main imports this module for its CLI
+    with open(fleet_path) as in_file:
+        fleet = imb_yaml.safe_load(in_file) or {}
+
+    targets = list(fleet.get('targets') or [])
+    for selector in fleet.get('selectors') or []:
+        targets.extend(_expand_selector(selector))
+    if not targets:
+        raise Exception('Fleet file {} contains no targets'.format(fleet_path))
+
+    # Cluster wide listings are collected once per context rather than by every worker
+    inventories = {}
+    for context in sorted(set(t['context'] for t in targets)):
+        try:
+            inventories[context] = collect_inventory(context)
+        except Exception:
+            inventories[context] = None # workers fall back to listing for themselves
+
+    output_root = Path(output_dir).resolve()
+    launch_dir = os.getcwd()
+    jobs = [ (t, _target_answers(fleet.get('answers') or {}, t), inventories[t['context']],
+        str(output_root / t['context'] / t['namespace'] / t['deployment']), launch_dir) for t in targets ]
+    # A worker crashing (BrokenProcessPool) or failing outside of discovery only fails its own target(s), the summary covers them all
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(_discover_target, *job): i for i, job in enumerate(jobs) }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                target, output_dir = jobs[i][0], jobs[i][3]
+                results[i] = { 'target': { k: target[k] for k in ('context', 'namespace', 'deployment') }, 'output_dir': output_dir,
+                    'status': 'failed', 'message': [ 'Worker failed: {}: {}'.format(type(e).__name__, e) ] }
+
+    summary = { 'success': [], 'partial': [], 'failed': [] }
+    for r in results:
+        summary[r.pop('status')].append(r)
+    summary['counts'] = { status: len(summary[status]) for status in ('success', 'partial', 'failed') }
+    output_root.mkdir(parents=True, exist_ok=True)
+    with open(output_root / FLEET_SUMMARY_FILE, 'w') as out_file:
+        imb_yaml.dump(summary, out_file)
+
+    print('Fleet discovery finished: {success} succeeded, {partial} partial, {failed} failed. Summary written to {path}'.format(
+        path=output_root / FLEET_SUMMARY_FILE, **summary['counts']))
+    return 0 if not summary['partial'] and not summary['failed'] else 1
+
+def _discover_target(target, answers, inventory, output_dir, launch_dir):
+    'worker process entry point, runs headless discovery of one target from within its output directory'
+    from dotenv import load_dotenv
+    from imb.imb_main import Imb # imb_main imports this module for its CLI
+    from imb.imb_headless import ImbHeadless
+
+    result = { 'target': { k: target[k] for k in ('context', 'namespace', 'deployment') }, 'output_dir': output_dir }
+    # Credentials are read from opsani.env/.env in the working directory, load the ones fleet mode was launched with
+    for env_path in (Path(launch_dir) / 'opsani.env', Path(launch_dir) / '.env'):
+        if env_path.exists():
+            load_dotenv(dotenv_path=env_path)
+            break
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    os.chdir(output_dir)
+    # Each run closes its event loop and workers are reused across targets
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    with open(FLEET_LOG_FILE, 'w') as log_file, contextlib.redirect_stdout(log_file), contextlib.redirect_stderr(log_file):
+        try:
+            app = Imb(inventory=inventory)
+            exit_code = app.run(headless_ui=ImbHeadless(answers, out=log_file))
+        except Exception:
+            exit_code, app = 1, None
+            print(format_exc())
+
+    if exit_code:
+        result['status'] = 'failed'
+    elif app.finished_discovery:
+        result['status'] = 'success'
+    else:
+        result['status'] = 'partial' # discovery stopped early or manifests need manual configuration
+    result['message'] = [ m for m in (app.finished_message if app else []) if m and not m.startswith('#') ]
+    return result
+
+def _target_answers(common_answers, target):
+    answers = dict(common_answers)
+    for flag in ('context', 'namespace', 'deployment', 'container'):
+        if target.get(flag):
+            answers[FLAG_ANSWER_KEYS[flag]] = target[flag]
+    answers.update(target.get('answers') or {})
+    return answers
+
+def _expand_selector(selector):
+    'targets for the deployments matching a fleet file selector'
+    import kubernetes
+    from imb.imb_kubernetes import EXCLUDED_NAMESPACES
+    apps_client = kubernetes.client.AppsV1Api(kubernetes.config.new_client_from_config(context=selector['context']))
+    if selector.get('namespace'):
+        deployments = apps_client.list_namespaced_deployment(namespace=selector['namespace'], label_selector=selector.get('labels', '')).items
+    else:
+        deployments = [ d for d in apps_client.list_deployment_for_all_namespaces(label_selector=selector.get('labels', '')).items
+            if d.metadata.namespace not in EXCLUDED_NAMESPACES ]
+    return [ dict(context=selector['context'], namespace=d.metadata.namespace, deployment=d.metadata.name, answers=selector.get('answers') or {})
+        for d in deployments ]
@@ -0,0 +1,149 @@
+import asyncio
+import re
+import sys
+from typing import Iterable, Union
+
+import imb.imb_yaml as imb_yaml
+
+# Answers are keyed by prompt title. Text input fields can also be answered individually by their prompt text,
+#   unanswered fields fall back to their initial text. A single value answers the first field of a multi field prompt
+FLAG_ANSWER_KEYS = {
+    'context': 'Select Context of App to be Optimized',
+    'namespace': 'Select Namespace of App to be Optimized',
+    'deployment': 'Select Deployment to be Optimized',
+    'container': 'Select Container to be Optimized',
+    'metrics': 'Select Deployment Metrics for Optimization Measurement',
+    'perf_metric': 'Select Performance Metric',
+    'endpoint': 'Select Endpoint for Load Generation',
+    'duration': 'Load Generation Configuration',
+    'servo_image': 'The following Servo image has been selected. Edit below to override with a different image',
+    'servo_namespace': 'Please enter the namespace to which servo should be deployed',
+}
+
+# Yes/no prompts with a safe default for unattended runs: start fresh, don't push anything and don't generate load
+DEFAULT_ANSWERS = {
+    'Resume Previous Discovery?': False,
+    'Push Discovery Telemetry?': False,
+    'Push Config Override?': False,
+    'Load Calibration': False,
+    'Select Load Generation Targets': [], # none selected loads the selected endpoint only
+}
+
+class HeadlessError(Exception):
+    pass
+
+class ImbHeadlessResult:
+    def __init__(self, value=None):
+        self.back_selected = False
+        self.other_selected = False
+        self.refresh_selected = False
+        self.value = value
+
+class ImbHeadless:
+    '''Drop in replacement for ImbTui answering prompts from an answers dict so run_stack methods can run without a TTY.
+    Prompts without an answer (or a default) and answers matching no or several choices raise HeadlessError'''
+    def __init__(self, answers=None, out=sys.stderr):
+        self.answers = dict(DEFAULT_ANSWERS)
+        self.answers.update(answers or {})
+        self.out = out
+        self.text_answers = {} # title -> values last given, answering a text prompt again means its values were rejected
+        self.init_done = asyncio.Event()
+        self.init_done.set()
+
+    @classmethod
+    def from_args(cls, args):
+        'answers from the file at args.answers (if any) overridden by the FLAG_ANSWER_KEYS flags that were set'
+        answers = {}
+        if args.answers:
+            with open(args.answers) as in_file:
+                answers.update(imb_yaml.safe_load(in_file) or {})
+        for flag, key in FLAG_ANSWER_KEYS.items():
+            value = getattr(args, flag, None)
+            if value is not None:
+                answers[key] = value.split(',') if flag == 'metrics' else value
+        return cls(answers)
+
+    async def start_ui(self):
+        pass
+
+    async def stop_ui(self):
+        pass
+
+    async def prompt_yn(self, title, prompt, disable_back=False, allow_other=False, other_button_text="Other"):
+        answer = self._answer(title)
+        if not isinstance(answer, bool):
+            raise HeadlessError('Expected true or false to answer "{}", got: {}'.format(title, answer))
+        return ImbHeadlessResult(answer)
+
+    async def prompt_ok(self, title, prompt: Union[str, Iterable[str]]):
+        self._print(title, prompt)
+        return ImbHeadlessResult()
+
+    async def prompt_text_input(self, title, prompts, allow_other=False, other_button_text="Other", ok_button_text="Ok"):
+        answer = self.answers.get(title)
+        positional = answer if isinstance(answer, list) else [answer]
+        if len(positional) > len(prompts):
+            raise HeadlessError('Expected at most {} values to answer "{}", got: {}'.format(len(prompts), title, answer))
+
+        values = []
+        for i, p in enumerate(prompts):
+            value = self.answers.get(p['prompt'], positional[i] if i < len(positional) else None)
+            if value is None:
+                value = p.get('initial_text', '')
+            if value == '' and not p.get('optional'):
+                raise HeadlessError('No answer for "{}" of prompt "{}"'.format(p['prompt'], title))
+            values.append(str(value))
+        if self.text_answers.get(title) == values:
+            raise HeadlessError('Answer {} to prompt "{}" was rejected'.format(values[0] if len(prompts) == 1 else values, title))
+        self.text_answers[title] = values
+        return ImbHeadlessResult(values[0] if len(prompts) == 1 else tuple(values))
+
+    async def long_prompt_text_input(self, title, prompt: Union[str, Iterable[str]], initial_text='', allow_other=False):
+        return await self.prompt_text_input(title, [{'prompt': title, 'initial_text': initial_text}])
+
+    async def prompt_multiline_text_input(self, title, prompt: Union[str, Iterable[str]], initial_text=''):
+        # Only used to describe configuration IMB couldn't discover, which needs a human
+        raise HeadlessError('Prompt "{}" requires interactive input: {}'.format(title, prompt))
+
+    async def prompt_multiline_text_output(self, title, text=''):
+        self._print(title, text)
+        return ImbHeadlessResult()
+
+    async def prompt_radio_list(self, values, title, header, allow_other=True, on_highlight=None, allow_refresh=False):
+        # Answers are known upfront, there is no time spent on a prompt to prefetch in
+        return ImbHeadlessResult(_match_choice(title, values, str(self._answer(title))))
+
+    async def prompt_check_list(self, values, title, header, allow_other=True, allow_refresh=False):
+        return ImbHeadlessResult([ _match_choice(title, values, str(a)) for a in self._answer_list(title) ])
+
+    async def prompt_search_check_list(self, search, title, header, initial_text='', allow_other=True, page_size=20, debounce=0.3):
+        selected = []
+        for a in self._answer_list(title):
+            found = [ value for value, _ in await search('^{}$'.format(re.escape(str(a)))) ]
+            if str(a) not in found:
+                raise HeadlessError('Answer "{}" to prompt "{}" did not match any choice'.format(a, title))
+            selected.append(str(a))
+        return ImbHeadlessResult(selected)
+
+    def _answer(self, title):
+        if title not in self.answers:
+            raise HeadlessError('No answer for prompt "{}"'.format(title))
+        return self.answers[title]
+
+    def _answer_list(self, title):
+        answer = self._answer(title)
+        return answer if isinstance(answer, list) else [answer]
+
+    def _print(self, title, text):
+        lines = [text] if isinstance(text, str) else list(text)
+        print('\n'.join(['== {} =='.format(title)] + lines), file=self.out)
+
+def _match_choice(title, values, answer):
+    'index of the choice equal to answer, or else of the only choice starting with answer followed by a space (eg. a url and its details)'
+    if answer in values:
+        return values.index(answer)
+    matches = [ i for i, v in enumerate(values) if v.startswith(answer + ' ') ]
+    if len(matches) != 1:
+        raise HeadlessError('Answer "{}" to prompt "{}" matched {} of the choices: {}'.format(
+            answer, title, 'none' if not matches else 'several', ', '.join(values)))
+    return matches[0]
@@ -0,0 +1,254 @@
+import asyncio
+import math
+import ssl
+import time
+from urllib.parse import urlsplit
+
+import imb.imb_stats as imb_stats
+
+# Minimal asyncio HTTP/1.1 client used to probe and calibrate load against the app before vegeta is configured.
+#   Kept dependency free and keep-alive aware so the local generator isn't the bottleneck at moderate rates
+
+DEFAULT_TIMEOUT = 10 # seconds per request
+DEFAULT_MAX_CONNECTIONS = 256
+PROBE_TIMEOUT = 3
+
+# Step ramp: rates (requests per second) grow by RAMP_STEP_FACTOR every RAMP_STEP_DURATION seconds until latency or errors degrade
+RAMP_START_RATE = 5
+RAMP_STEP_FACTOR = 2
+RAMP_STEP_DURATION = 10
+RAMP_MAX_STEPS = 8
+RAMP_LATENCY_FACTOR = 2 # p95 latency relative to the first step considered degraded
+RAMP_MAX_ERROR_RATIO = 0.01
+RAMP_MIN_ACHIEVED_RATIO = 0.9 # achieved rate relative to the target rate considered degraded
+
+class HttpResponse:
+    __slots__ = ('status', 'headers', 'body', 'keep_alive', 'ttfb')
+
+    def __init__(self, status, headers, body, keep_alive, ttfb=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+        self.ttfb = ttfb # seconds from sending the request to receiving the status line
+
+class HttpConnection:
+    def __init__(self, url, host=None, timeout=DEFAULT_TIMEOUT):
+        parts = urlsplit(url)
+        self.secure = parts.scheme == 'https'
+        self.address = (parts.hostname, parts.port or (443 if self.secure else 80))
+        self.host = host or parts.netloc
+        self.path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def connect(self, alpn_protocols=None):
+        context = None
+        if self.secure:
+            # Load balancer addresses rarely match the certificate of the app's host, this is a load test not a security check
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            if alpn_protocols:
+                context.set_alpn_protocols(alpn_protocols)
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(*self.address, ssl=context, server_hostname=self.host.split(':')[0] if context else None),
+            self.timeout)
+
+    async def request(self, method='GET'):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: opsani-imb\r\nAccept: */*\r\n\r\n'.format(
+            method, self.path, self.host).encode('latin-1'))
+        return await asyncio.wait_for(self._read_response(method, time.monotonic()), self.timeout)
+
+    async def _read_response(self, method, sent):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by {}:{}'.format(*self.address))
+        ttfb = time.monotonic() - sent
+        version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+        if method == 'HEAD' or status.startswith('1') or status in ('204', '304'):
+            body = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                chunks.append(await self.reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            body = b''.join(c[:-2] for c in chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            keep_alive = False
+
+        return HttpResponse(int(status), headers, body, keep_alive, ttfb)
+
+    def negotiated_protocol(self):
+        'ALPN protocol selected by a TLS server, None for cleartext connections or servers without ALPN'
+        ssl_object = self.writer.get_extra_info('ssl_object') if self.writer else None
+        return ssl_object.selected_alpn_protocol() if ssl_object else None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = self.reader = None
+
+class ConnectionPool:
+    'Keep-alive connections to one url, opened on demand up to max_connections in flight'
+    def __init__(self, url, host=None, max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+        self.url = url
+        self.host = host
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = []
+        self.in_flight = 0
+
+    async def request(self, method='GET'):
+        conn = self.idle.pop() if self.idle else HttpConnection(self.url, self.host, self.timeout)
+        self.in_flight += 1
+        try:
+            response = await conn.request(method)
+        except BaseException:
+            conn.close()
+            raise
+        finally:
+            self.in_flight -= 1
+
+        if response.keep_alive:
+            self.idle.append(conn)
+        else:
+            conn.close()
+        return response
+
+    def close(self):
+        for conn in self.idle:
+            conn.close()
+        self.idle = []
+
+async def probe(url, host=None, timeout=PROBE_TIMEOUT):
+    '''Request url once and report its status, time to first byte (seconds), keep-alive and HTTP/2 support (negotiated through
+    ALPN, None for cleartext urls where it can't be determined without an upgrade). error describes a failed probe'''
+    result = {'url': url, 'status': None, 'ttfb': None, 'keep_alive': None, 'http2': None, 'error': None}
+    conn = HttpConnection(url, host, timeout)
+    try:
+        if conn.secure:
+            # Offering h2 on a separate handshake keeps the HTTP/1.1 request below on a connection that negotiated http/1.1
+            h2_conn = HttpConnection(url, host, timeout)
+            await h2_conn.connect(alpn_protocols=['h2', 'http/1.1'])
+            result['http2'] = h2_conn.negotiated_protocol() == 'h2'
+            h2_conn.close()
+        response = await conn.request()
+        result.update(status=response.status, ttfb=response.ttfb, keep_alive=response.keep_alive)
+    except asyncio.TimeoutError:
+        result['error'] = 'timed out'
+    except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+        result['error'] = str(e) or type(e).__name__
+    finally:
+        conn.close()
+    return result
+
+async def probe_all(targets, timeout=PROBE_TIMEOUT):
+    'probe (url, host) targets concurrently, results are in target order'
+    return await asyncio.gather(*[ probe(url, host, timeout) for url, host in targets ])
+
+async def run_step(url, rate, duration, host=None, max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+    '''Send GET requests at a constant rate (per second) for duration seconds. Requests are scheduled open loop so a slow server
+    shows up as latency rather than a lower request rate; requests that would exceed max_connections in flight are dropped'''
+    loop = asyncio.get_event_loop()
+    pool = ConnectionPool(url, host, max_connections, timeout)
+    latencies, errors, dropped = [], [0], [0]
+    status_counts = {}
+
+    async def send():
+        start = time.monotonic()
+        try:
+            response = await pool.request()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            errors[0] += 1
+            return
+        latencies.append(time.monotonic() - start)
+        status_counts[response.status] = status_counts.get(response.status, 0) + 1
+        if response.status >= 500:
+            errors[0] += 1
+
+    tasks = []
+    total = max(1, int(rate * duration))
+    start = loop.time()
+    try:
+        for i in range(total):
+            delay = start + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if pool.in_flight >= max_connections:
+                dropped[0] += 1
+                continue
+            tasks.append(asyncio.ensure_future(send()))
+        # The rate is achieved over the send schedule, draining the requests still in flight only adds their latency
+        send_elapsed = max(loop.time() - start, total / rate)
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+        pool.close()
+
+    summary = imb_stats.summarize(latencies) or {}
+    return {
+        'rate': rate,
+        'requests': total,
+        'achieved_rate': (total - dropped[0] - errors[0]) / send_elapsed,
+        'errors': errors[0],
+        'dropped': dropped[0],
+        'error_ratio': (errors[0] + dropped[0]) / total,
+        'latency_mean': summary.get('mean'),
+        'latency_p50': summary.get('p50'),
+        'latency_p95': summary.get('p95'),
+        'status_counts': status_counts
+    }
+
+async def calibrate(url, host=None, start_rate=RAMP_START_RATE, step_factor=RAMP_STEP_FACTOR, step_duration=RAMP_STEP_DURATION,
+        max_steps=RAMP_MAX_STEPS, on_step=None):
+    '''Step ramp the request rate until p95 latency exceeds RAMP_LATENCY_FACTOR times the first step's, the error ratio exceeds
+    RAMP_MAX_ERROR_RATIO or the achieved rate falls behind. Returns a dict with the steps run, the last healthy step (None when
+    even the first step degraded) and whether degradation was reached at all'''
+    steps, healthy = [], None
+    rate = start_rate
+    for _ in range(max_steps):
+        step = await run_step(url, rate, step_duration, host)
+        steps.append(step)
+        degraded = _degradation(step, steps[0])
+        step['degraded'] = degraded
+        if on_step:
+            on_step(step)
+        if degraded:
+            break
+        healthy = step
+        rate *= step_factor
+
+    return {'steps': steps, 'healthy_step': healthy, 'saturated': bool(steps[-1]['degraded'])}
+
+def _degradation(step, first_step):
+    'reason the step is considered degraded, or None'
+    if step['error_ratio'] > RAMP_MAX_ERROR_RATIO:
+        return 'error ratio {:.1%}'.format(step['error_ratio'])
+    if step['achieved_rate'] < step['rate'] * RAMP_MIN_ACHIEVED_RATIO:
+        return 'achieved {:.1f}/s of {:g}/s'.format(step['achieved_rate'], step['rate'])
+    if step is not first_step and first_step['latency_p95'] and step['latency_p95'] > first_step['latency_p95'] * RAMP_LATENCY_FACTOR:
+        return 'p95 latency {:.0f}ms'.format(step['latency_p95'] * 1000)
+    return None
+
+def littles_law_concurrency(rate, latency):
+    'requests in flight needed to sustain rate (per second) at latency (seconds)'
+    return int(math.ceil(rate * latency))
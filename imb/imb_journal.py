@@ -0,0 +1,107 @@
+import json
+import os
+
+import imb.imb_yaml as imb_yaml
+
+JOURNAL_PATH = 'discovery.journal'
+STATE_PATH = 'discovery.yaml'
+JOURNAL_COMPACT_RECORDS = 200 # journal length at which it is folded into discovery.yaml during a run to keep resume fast
+
+class DiscoveryJournal:
+    '''Append-only JSON lines record of app_state changes so discovery can resume after a crash, a killed pod or a lost SSH
+    session. Each completed run_stack method appends (and fsyncs) only its own state_data, or the removal of a method's state
+    when it is backed over. compact() atomically rewrites discovery.yaml and starts a new journal, replay() applies the journal
+    to the state loaded from discovery.yaml'''
+    def __init__(self, path=JOURNAL_PATH, state_path=STATE_PATH):
+        self.path = path
+        self.state_path = state_path
+        self.records = 0 # records in the journal since it was last compacted
+        self.file = None
+
+    def replay(self, state):
+        'state loaded from discovery.yaml with the journal applied'
+        state = dict(state)
+        try:
+            with open(self.path) as in_file:
+                lines = in_file.readlines()
+        except FileNotFoundError:
+            return state
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break # torn write of the last record before a crash
+            if record['op'] == 'reset':
+                state = {}
+            elif record['op'] == 'set':
+                state[record['method']] = record['data']
+            elif record['op'] == 'pop':
+                state.pop(record['method'], None)
+        self.records = len(lines)
+        return state
+
+    def set(self, method_name, state_data):
+        self._append({ 'op': 'set', 'method': method_name, 'data': state_data })
+
+    def pop(self, method_name):
+        self._append({ 'op': 'pop', 'method': method_name })
+
+    def reset(self):
+        'start over from an empty state, discovery.yaml of the previous run is kept until the next compaction'
+        self._truncate()
+        self._append({ 'op': 'reset' })
+
+    def compact(self, output):
+        'atomically replace discovery.yaml with output, whose state includes everything journaled so far, and start a new journal'
+        tmp_path = '{}.tmp'.format(self.state_path)
+        with open(tmp_path, 'w') as out_file:
+            imb_yaml.dump(output, out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, self.state_path)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.state_path)))
+        # A crash before the truncate replays records already in discovery.yaml, which leaves the state unchanged
+        self._truncate()
+
+    def discard(self):
+        'remove the journal once there is nothing left to resume'
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.records = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _append(self, record):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        # One write per record so a crash tears at most the last line
+        self.file.write(json.dumps(record, default=str) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records += 1
+
+    def _truncate(self):
+        self.close()
+        self.file = open(self.path, 'w')
+        os.fsync(self.file.fileno())
+        self.records = 0
+
+def _fsync_dir(path):
+    # Persists the rename, not supported on every platform
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
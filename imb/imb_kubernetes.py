@@ -1,10 +1,13 @@
 
+from functools import partial
 import json
 import kubernetes
 import os
 from pathlib import Path
 import re
 
+from imb.imb_prefetch import Prefetcher
+from imb.imb_scheduler import DiscoveryScheduler
 from imb.imb_yaml import multiline_str
 
 EXCLUDED_NAMESPACES = ['kube-node-lease', 'kube-public', 'kube-system']
@@ -12,7 +15,7 @@ EXCLUDED_NAMESPACES = ['kube-node-lease', 'kube-public', 'kube-system']
 GATHERED_INFO = set(['context', 'namespace', 'deployment_name', 'container_settings'])
 
 class ImbKubernetes:
-    def __init__(self, ui, finished_method, finished_message, imbConfig, ocoOverride, servoConfig, running_in_k8s):
+    def __init__(self, ui, finished_method, finished_message, imbConfig, ocoOverride, servoConfig, running_in_k8s, inventory=None, scheduler=None, prefetcher=None):
         self.ui = ui # User interface
         self.finished_method = finished_method # Method to call next when this section finishes
         self.finished_message = finished_message # Array of strings printed when Imb finishes. Can be appended/prepended with extra info or replaced when error occurs
@@ -21,6 +24,15 @@ class ImbKubernetes:
         self.ocoOverride = ocoOverride # output dumped to override.yaml
         self.servoConfig = servoConfig # output config.yaml payload dumped to opsani-servo-configmap.yaml
         self.running_in_k8s = running_in_k8s # whether IMB is running within a cluster
+        self.inventory = inventory # cluster wide listings collected once per context and shared by fleet mode workers
+
+        # Listings that only depend on earlier selections run in the background while the user makes the next ones
+        self.scheduler = scheduler or DiscoveryScheduler()
+        self.scheduler.task('prometheus_service', ['k8s_clients'], self._discover_prometheus_service)
+        self.scheduler.task('deployment_services', ['k8s_clients', 'namespace', 'deployment'], self._deployment_services)
+        self.scheduler.task('deployment_pods', ['k8s_clients', 'namespace', 'deployment'], self._deployment_pods)
+        # Listings for the highlighted namespace/deployment are fetched while the user is still deciding
+        self.prefetcher = prefetcher or Prefetcher()
 
         # Initialize info used in Other/Error handling
         self.other_info = {}
@@ -32,6 +44,11 @@ class ImbKubernetes:
         self.prometheusService = None
         self.namespace = ''
         self.depLabels = {}
+        self.container_name = ''
+        self.container_current_settings = {}
+        self.current_settings_since = None # unix time the deployment's current ReplicaSet was created
+        self.pod_names = []
+        self.pod_name_regex = ''
         self.services = []
         self.ingresses = []
 
@@ -41,6 +58,10 @@ class ImbKubernetes:
 
     def on_back(self, state_data):
         self._update_missing_info(state_data, update_method=self.missing_info.add)
+        # Background listings of a selection that was backed over are stale
+        for key, name in (('namespace', 'namespace'), ('deployment_name', 'deployment')):
+            if key in state_data:
+                self.scheduler.retract(name)
 
     def _update_missing_info(self, state_data, update_method):
         for key in state_data.keys():
@@ -201,17 +222,18 @@ class ImbKubernetes:
         self.apps_client = kubernetes.client.AppsV1Api()
         self.exts_client = kubernetes.client.ExtensionsV1beta1Api()
         self.autoscaling_client = kubernetes.client.AutoscalingV1Api()
+        self.scheduler.provide('k8s_clients', { 'core': self.core_client, 'apps': self.apps_client, 'exts': self.exts_client })
+        self.prefetcher.memo.set_scope(self.context['name']) # memoized listings belong to the selected cluster
 
-        cluster_info = kubernetes.client.VersionApi().get_code()
-        if int(cluster_info.major) < 1:
-            self.version_pre_114 = True
-        elif int(cluster_info.major) == 1 and int(re.search(r'\d+', cluster_info.minor)[0]) < 14:
-            self.version_pre_114 = True
+        if self.inventory:
+            self.version_pre_114 = self.inventory['version_pre_114']
+        else:
+            self.version_pre_114 = _version_pre_114(kubernetes.client.VersionApi())
 
         if not state_data:
             state_data['interacted'] = False
             # Get namespaces, prompt if multiple or no match with imb config
-            namespaces = [n.metadata.name for n in self.core_client.list_namespace().items if n.metadata.name not in EXCLUDED_NAMESPACES]
+            namespaces = self.inventory['namespaces'] if self.inventory else await self.prefetcher.get(('namespaces',), partial(_list_namespaces, self.core_client))
             if len(namespaces) == 1:
                 state_data['namespace'] = namespaces[0]
             elif self.imbConfig.get('app') and self.imbConfig['app'] in namespaces:
@@ -220,16 +242,21 @@ class ImbKubernetes:
                 state_data['namespace'] = self.imbConfig['account']
 
             if 'namespace' in state_data:
-                deployments = self.apps_client.list_namespaced_deployment(namespace=state_data['namespace']).items
+                deployments = (await self.prefetcher.get(('deployments', state_data['namespace']),
+                    partial(self.apps_client.list_namespaced_deployment, namespace=state_data['namespace']))).items
                 if len(deployments) < 1:
                     state_data.pop('namespace') # Force a prompt selections if auto-selected namespace contains no deployments
 
-            if not 'namespace' in state_data:
-                result = await self.ui.prompt_radio_list(values=namespaces, title='Select Namespace of App to be Optimized', header='Namespace:')
+            while not 'namespace' in state_data and not state_data.get('other_selected'):
+                result = await self.ui.prompt_radio_list(values=namespaces, title='Select Namespace of App to be Optimized', header='Namespace:',
+                    on_highlight=lambda i: self._prefetch_namespace(namespaces[i]), allow_refresh=True)
                 state_data['interacted'] = True
                 if result.back_selected:
                     return True
-                if result.other_selected:
+                if result.refresh_selected:
+                    self.prefetcher.memo.invalidate()
+                    namespaces = await self.prefetcher.get(('namespaces',), partial(_list_namespaces, self.core_client))
+                elif result.other_selected:
                     state_data['other_selected'] = True
                 else:
                     state_data['namespace'] = namespaces[result.value]
@@ -239,12 +266,16 @@ class ImbKubernetes:
         else:
             self.namespace = state_data['namespace']
             self.k8sConfig['namespace'] = self.namespace
+            self.scheduler.provide('namespace', self.namespace)
+            self.prefetcher.cancel(keep=_namespace_keys(self.namespace))
+            self._prefetch_namespace(self.namespace)
 
             call_next(self.select_deployment)
 
     async def select_deployment(self, call_next, state_data):
         # Get deployments, prompt if multiple
-        deployments = self.apps_client.list_namespaced_deployment(namespace=self.namespace).items
+        deployments = (await self.prefetcher.get(('deployments', self.namespace),
+            partial(self.apps_client.list_namespaced_deployment, namespace=self.namespace))).items
         if len(deployments) < 1:
             self.exit_title = 'No Deployments Found'
             self.exit_prompt = [
@@ -265,10 +296,17 @@ class ImbKubernetes:
                 elif self.imbConfig.get('account') and self.imbConfig['account'] in dep_names:
                     state_data['deployment_name'] = self.imbConfig['account']
                 else:
-                    result = await self.ui.prompt_radio_list(values=dep_names, title='Select Deployment to be Optimized', header='Deployment:')
+                    result = await self.ui.prompt_radio_list(values=dep_names, title='Select Deployment to be Optimized', header='Deployment:',
+                        on_highlight=lambda i: self._prefetch_deployment(deployments[i]), allow_refresh=True)
                     state_data['interacted'] = True
                     if result.back_selected:
                         return True
+                    if result.refresh_selected:
+                        # Relist the namespace and the deployments' pods rather than reusing what was memoized
+                        for key in _namespace_keys(self.namespace) + [('deployment_pods', self.namespace)]:
+                            self.prefetcher.memo.invalidate(key)
+                        state_data.clear()
+                        return await self.select_deployment(call_next, state_data)
                     if result.other_selected:
                         state_data['other_selected'] = True
                     else:
@@ -287,6 +325,8 @@ class ImbKubernetes:
             self.depLabels = self.deployment.spec.selector.match_labels
             if not self.depLabels:
                 raise Exception('Target deployment has no matchLabels selector')
+            self.prefetcher.cancel(keep=_namespace_keys(self.namespace) + [('deployment_pods', self.namespace, self.deployment_name)])
+            self.scheduler.provide('deployment', self.deployment)
 
             call_next(self.select_containers)
 
@@ -346,8 +386,11 @@ class ImbKubernetes:
                 cpu_min, cpu_max = _calculate_min_max(cpu, 0.125, 0.25, 4)
                 mem = _convert_to_gib(mem)
                 mem_min, mem_max = _calculate_min_max(mem, 0.125, 0.25, 4)
+                state_data['container_current_settings'] = { 'cpu': cpu, 'mem': mem, 'replicas': self.deployment.spec.replicas }
 
-                hpa = [hpa for hpa in self.autoscaling_client.list_namespaced_horizontal_pod_autoscaler(namespace=self.namespace).items 
+                hpas = await self.prefetcher.get(('hpas', self.namespace),
+                    partial(self.autoscaling_client.list_namespaced_horizontal_pod_autoscaler, namespace=self.namespace))
+                hpa = [hpa for hpa in hpas.items
                     if hpa.spec.scale_target_ref.kind == "Deployment" and hpa.spec.scale_target_ref.name == self.deployment_name ]
                 if hpa:
                     hpa = hpa[0]
@@ -388,38 +431,140 @@ class ImbKubernetes:
             call_next(self.prompt_other)
         else:
             self.k8sConfig['application']['components'] = state_data['container_settings']
+            self.container_name = next(iter(state_data['container_settings'])).split('/', 1)[1]
+            self.container_current_settings = state_data.get('container_current_settings', {})
             call_next(self.finish_discovery)
 
     async def finish_discovery(self, call_next, state_data):
         state_data['interacted'] = False
-        # Discover services based on deployment selector labels
-        all_tgt_ns_services = self.core_client.list_namespaced_service(namespace=self.namespace)
-        self.services = [s for s in all_tgt_ns_services.items if s.spec.selector and all(( k in self.depLabels and self.depLabels[k] == v for k, v in s.spec.selector.items()))]
-
-        # Discover ingresses based on services
-        all_tgt_ns_ingresses = self.exts_client.list_namespaced_ingress(namespace=self.namespace)
-        self.ingresses = [i for i in all_tgt_ns_ingresses.items if any((
-            (i.spec.backend and i.spec.backend.service_name == s.metadata.name) # Matches default backend
-            or (i.spec.rules and any(( # Matches any of the rules' paths' backends
-                    r.http.paths and any((
-                        p.backend and p.backend.service_name == s.metadata.name 
-                    for p in r.http.paths))
-                for r in i.spec.rules))
-            )  
-            for s in self.services
-        ))]
-        
-        # List services in all namespaces, check for prometheus
-        all_ns_services = self.core_client.list_service_for_all_namespaces()
-        for serv in all_ns_services.items:
-            if serv.metadata.name == 'prometheus':
-                self.prometheusService = serv
-                break
+        # Started in the background once the deployment was selected
+        self.services, self.ingresses = await self.scheduler.get('deployment_services')
+        pods = await self.scheduler.get('deployment_pods')
+        self.pod_names, self.pod_name_regex = pods['pod_names'], pods['pod_name_regex']
+        if pods['current_settings_since'] is not None:
+            self.current_settings_since = pods['current_settings_since']
+        self.prometheusService = await self.scheduler.get('prometheus_service')
 
         # Update outer servo config and set next method to one supplied
         self.servoConfig['k8s'] = self.k8sConfig
         call_next(self.finished_method)
 
+    def _discover_prometheus_service(self, k8s_clients):
+        # List services in all namespaces, check for prometheus
+        if self.inventory:
+            return _service_from_inventory(self.inventory['prometheus_service'])
+        return _find_prometheus_service(k8s_clients['core'])
+
+    async def _deployment_services(self, k8s_clients, namespace, deployment):
+        all_tgt_ns_services = await self.prefetcher.get(('services', namespace),
+            partial(k8s_clients['core'].list_namespaced_service, namespace=namespace))
+        all_tgt_ns_ingresses = await self.prefetcher.get(('ingresses', namespace),
+            partial(k8s_clients['exts'].list_namespaced_ingress, namespace=namespace))
+        return _match_services(deployment, all_tgt_ns_services.items, all_tgt_ns_ingresses.items)
+
+    async def _deployment_pods(self, k8s_clients, namespace, deployment):
+        return await self.prefetcher.get(('deployment_pods', namespace, deployment.metadata.name),
+            partial(_discover_pods, k8s_clients, namespace, deployment))
+
+    def _prefetch_namespace(self, namespace):
+        self.prefetcher.prefetch(('deployments', namespace), partial(self.apps_client.list_namespaced_deployment, namespace=namespace))
+        self.prefetcher.prefetch(('hpas', namespace), partial(self.autoscaling_client.list_namespaced_horizontal_pod_autoscaler, namespace=namespace))
+        self.prefetcher.prefetch(('services', namespace), partial(self.core_client.list_namespaced_service, namespace=namespace))
+        self.prefetcher.prefetch(('ingresses', namespace), partial(self.exts_client.list_namespaced_ingress, namespace=namespace))
+
+    def _prefetch_deployment(self, deployment):
+        k8s_clients = { 'core': self.core_client, 'apps': self.apps_client, 'exts': self.exts_client }
+        self.prefetcher.prefetch(('deployment_pods', self.namespace, deployment.metadata.name),
+            partial(_discover_pods, k8s_clients, self.namespace, deployment))
+
+def _namespace_keys(namespace):
+    return [ (listing, namespace) for listing in ('deployments', 'hpas', 'services', 'ingresses') ]
+
+def _match_services(deployment, all_tgt_ns_services, all_tgt_ns_ingresses):
+    'services selecting the deployment\'s pods and ingresses routing to them'
+    dep_labels = deployment.spec.selector.match_labels
+    # Discover services based on deployment selector labels
+    services = [s for s in all_tgt_ns_services if s.spec.selector and all(( k in dep_labels and dep_labels[k] == v for k, v in s.spec.selector.items()))]
+
+    # Discover ingresses based on services
+    ingresses = [i for i in all_tgt_ns_ingresses if any((
+        (i.spec.backend and i.spec.backend.service_name == s.metadata.name) # Matches default backend
+        or (i.spec.rules and any(( # Matches any of the rules' paths' backends
+                r.http.paths and any((
+                    p.backend and p.backend.service_name == s.metadata.name 
+                for p in r.http.paths))
+            for r in i.spec.rules))
+        )  
+        for s in services
+    ))]
+    return services, ingresses
+
+def _discover_pods(k8s_clients, namespace, deployment):
+    '''names of the deployment's pods, a regex matching them and when its current ReplicaSet was created (or None).
+    Pod names let metrics which don't carry the deployment's selector labels (eg. cAdvisor) still be matched without scanning every series'''
+    deployment_name, dep_labels = deployment.metadata.name, deployment.spec.selector.match_labels
+    label_selector = ','.join('{}={}'.format(k, v) for k, v in dep_labels.items())
+    replica_sets = [rs for rs in k8s_clients['apps'].list_namespaced_replica_set(namespace=namespace, label_selector=label_selector).items
+        if any(o.kind == 'Deployment' and o.uid == deployment.metadata.uid for o in rs.metadata.owner_references or [])]
+    rs_names = set(rs.metadata.name for rs in replica_sets)
+    pods = [p for p in k8s_clients['core'].list_namespaced_pod(namespace=namespace, label_selector=label_selector).items
+        if any(o.kind == 'ReplicaSet' and o.name in rs_names for o in p.metadata.owner_references or [])]
+    result = { 'pod_names': sorted(p.metadata.name for p in pods), 'pod_name_regex': '', 'current_settings_since': None }
+
+    # The ReplicaSet of the deployment's current revision bounds how far back metrics reflect the current settings
+    revision = (deployment.metadata.annotations or {}).get('deployment.kubernetes.io/revision')
+    current_rs = [rs for rs in replica_sets if (rs.metadata.annotations or {}).get('deployment.kubernetes.io/revision') == revision]
+    if revision and current_rs:
+        result['current_settings_since'] = current_rs[0].metadata.creation_timestamp.timestamp()
+
+    pod_template_hashes = set((rs.metadata.labels or {}).get('pod-template-hash') for rs in replica_sets)
+    pod_template_hashes.update((p.metadata.labels or {}).get('pod-template-hash') for p in pods)
+    pod_template_hashes.discard(None)
+    if pod_template_hashes:
+        result['pod_name_regex'] = '{}-({})-[a-z0-9]+'.format(deployment_name, '|'.join(sorted(pod_template_hashes)))
+    elif result['pod_names']:
+        result['pod_name_regex'] = '|'.join(result['pod_names'])
+    return result
+
+def collect_inventory(context_name, kube_config_path=None):
+    '''Cluster wide listings which are the same for every app discovered in a context. Returned as plain data so fleet mode
+    can collect them once per context and pass them to its worker processes'''
+    api_client = kubernetes.config.new_client_from_config(
+        config_file=kube_config_path or kubernetes.config.kube_config.KUBE_CONFIG_DEFAULT_LOCATION, context=context_name)
+    core_client = kubernetes.client.CoreV1Api(api_client)
+    prometheus_service = _find_prometheus_service(core_client)
+    return {
+        'context': context_name,
+        'version_pre_114': _version_pre_114(kubernetes.client.VersionApi(api_client)),
+        'namespaces': _list_namespaces(core_client),
+        'prometheus_service': {
+            'name': prometheus_service.metadata.name,
+            'namespace': prometheus_service.metadata.namespace,
+            'port': prometheus_service.spec.ports[0].port
+        } if prometheus_service else None
+    }
+
+def _version_pre_114(version_client):
+    cluster_info = version_client.get_code()
+    if int(cluster_info.major) < 1:
+        return True
+    return int(cluster_info.major) == 1 and int(re.search(r'\d+', cluster_info.minor)[0]) < 14
+
+def _list_namespaces(core_client):
+    return [n.metadata.name for n in core_client.list_namespace().items if n.metadata.name not in EXCLUDED_NAMESPACES]
+
+def _find_prometheus_service(core_client):
+    return next((serv for serv in core_client.list_service_for_all_namespaces().items if serv.metadata.name == 'prometheus'), None)
+
+def _service_from_inventory(service):
+    'rebuild the parts of a V1Service discovery reads from an inventory entry'
+    if not service:
+        return None
+    return kubernetes.client.V1Service(
+        metadata=kubernetes.client.V1ObjectMeta(name=service['name'], namespace=service['namespace']),
+        spec=kubernetes.client.V1ServiceSpec(ports=[kubernetes.client.V1ServicePort(port=service['port'])])
+    )
+
 # https://stackoverflow.com/a/60708339
 MEM_UNITS = {
     "B": 1, "K": 1000, "M": 1000**2, "G": 1000**3, "T": 1000**4, "P": 1000**5, "E": 1000**6,
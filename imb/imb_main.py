@@ -1,25 +1,29 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
 from base64 import b64encode
-from dotenv import load_dotenv
-import json
 import os
 from pathlib import Path
-import requests
 import subprocess
 import stat
 import sys
 from traceback import format_exc
 
-from imb.imb_tui import ImbTui
-from imb.imb_kubernetes import ImbKubernetes
-from imb.imb_prometheus import ImbPrometheus
-from imb.imb_vegeta import ImbVegeta
-from imb.servo_manifests import servo_configmap, servo_deployment, servo_role, servo_role_binding, servo_secret, servo_service_account
+# Only lightweight modules are imported here so the CLI (eg. --help, --fleet) starts quickly. kubernetes-client, requests,
+#   prompt_toolkit, dotenv and the discovery modules using them are imported by the step that first needs them,
+#   see startup_benchmark.py for the import budget
+from imb.imb_fleet import DEFAULT_FLEET_OUTPUT
+from imb.imb_headless import FLAG_ANSWER_KEYS, HeadlessError, ImbHeadless
+from imb.imb_journal import DiscoveryJournal, JOURNAL_COMPACT_RECORDS
+from imb.imb_prefetch import Prefetcher
+from imb.imb_scheduler import DiscoveryScheduler
+from imb.imb_telemetry import Telemetry
+from imb.imb_watchdog import STALL_LOG, StallWatchdog
 import imb.imb_yaml as imb_yaml
 
 GATHERED_INFO = set(['opsani_account', 'app_name', 'recommended_servo_image', 'servo_namespace'])
+TELEMETRY_PATH = 'discovery-telemetry.yaml' # written instead of discovery.yaml when discovery finishes
 
 LAUNCH_SERVO = '''
 kubectl apply -f servo-manifests/ --namespace {namespace}{context_flag_val}
@@ -39,7 +43,7 @@ esac
 '''
 
 class Imb:
-    def __init__(self):
+    def __init__(self, inventory=None, trace_path=None, debug_stalls=False):
         # list of methods to run
         #   each method invoked in the run_stack is responsible for appending the next method to be called
         #   program exits when None is top of the stack. 
@@ -58,12 +62,34 @@ class Imb:
         self.app_name = None
         self.opsani_account = None
         self.token = None
-
-    def run(self):
-        self.ui = ImbTui()
+        self.oco = None # OcoClient, see _oco_client
+
+        self.headless = False # Errors abort the run instead of being offered for the user to back over
+        self.inventory = inventory # cluster inventory shared by fleet mode runs in the same context
+
+        # Non-interactive discovery work declared by the modules runs concurrently with the interactive run_stack methods
+        self.scheduler = DiscoveryScheduler()
+        self.prefetcher = Prefetcher() # speculative fetches for the choice highlighted on a prompt
+        self.journal = DiscoveryJournal() # checkpoints app_state after every run_stack method
+        self.telemetry = Telemetry(trace_path) # where the time of each run_stack method goes, embedded in discovery.yaml
+        self.debug_stalls = debug_stalls or bool(os.getenv('IMB_DEBUG_STALLS')) # log blocking calls on the event loop to STALL_LOG
+        self.exit_code = 0
+
+    def run(self, headless_ui=None):
+        if headless_ui:
+            self.ui, self.headless = headless_ui, True
+        else:
+            from imb.imb_tui import ImbTui # prompt-toolkit requires a TTY, only load it for interactive runs
+            self.ui = ImbTui()
+        self.telemetry.instrument_ui(self.ui)
+        self.telemetry.instrument_clients()
         
         # prompt-toolkit app.run is blocking so use app.run_async along with async self.main
         loop = asyncio.get_event_loop()
+        watchdog = None
+        if self.debug_stalls:
+            watchdog = StallWatchdog(loop, current_method=self._current_method_name)
+            watchdog.start()
         try:
             loop.run_until_complete(asyncio.gather(
                 self.ui.start_ui(),
@@ -72,11 +98,18 @@ class Imb:
         except asyncio.CancelledError:
             self.finished_message = ['Exited due to ESC keypress']
             pass # UI exit handler cancels Imb.main() task. Catch cancellation here for graceful exit
+        finally:
+            if watchdog:
+                watchdog.stop()
+                if watchdog.stalls:
+                    self.finished_message.append('{} event loop stalls were logged to {}'.format(watchdog.stalls, STALL_LOG))
 
         if self.finished_message:
             print('\n'.join(self.finished_message))
+        self.telemetry.write_trace()
         
         loop.close()
+        return self.exit_code
 
     async def read_state(self):
         try:
@@ -84,6 +117,8 @@ class Imb:
                 self.app_state = imb_yaml.safe_load(in_file)['state']
         except FileNotFoundError:
             self.app_state = {}
+        # Steps completed after discovery.yaml was last written, eg. before a crash
+        self.app_state = self.journal.replay(self.app_state)
 
         if self.app_state:
             # Note this prompt is not added to the run_stack because going back deletes state data so if the user were to back all the 
@@ -93,22 +128,27 @@ class Imb:
                 return True # Notify calling method back was selected
             elif not result.value:
                 self.app_state = {}
+            else:
+                self.journal.compact({ 'state': self.app_state })
+                return
+        self.journal.reset()
 
     async def write_state(self, disable_back=True, formatted_exception=None):
-        output = { 'state': self.app_state }
+        output = { 'state': self.app_state, 'telemetry': self.telemetry.summary() }
         prompt='Would you like to send your discovery.yaml telemetry to Opsani?'
         if formatted_exception:
             output['error'] = imb_yaml.multiline_str(formatted_exception)
             prompt='IMB was unable to complete discovery. Would you like to send your discovery.yaml telemetry to Opsani?'
 
+        if self._baseline():
+            output['baseline'] = self._baseline()
         if self.other_info:
             output['other_info'] = { 'Imb': self.other_info }
         for mod in self.imb_modules:
             if mod.other_info:
                 output.setdefault('other_info', {})[mod.__class__.__name__] = mod.other_info
     
-        with open('discovery.yaml', 'w') as out_file:
-            imb_yaml.dump(output, out_file)
+        self.journal.compact(output)
         
         if self.app_name and self.opsani_account and self.token:
             while True:
@@ -128,61 +168,24 @@ class Imb:
 
 
             if result.value:
-                # TODO: send to oco ('TELEMETRY' event)
-                url=f"https://api.optune.ai/accounts/{self.opsani_account}/applications/{self.app_name}/config/"
-                headers={
-                    "Content-type": "application/json",
-                    "Authorization": f"Bearer {self.token}"}
-                response=requests.get(
-                    url,
-                    headers=headers
-                )
-                json_parse_error = None
-                if response.ok:
-                    try:
-                        current_override = response.json()
-                    except:
-                        json_parse_error = format_exc()
-
-                if not response.ok or json_parse_error:
-                    output['oco-config-get-response-code'] = response.status_code
-                    output['oco-config-get-response-text'] = response.text
-                    if json_parse_error:
-                        output['oco-config-get-json-error'] = imb_yaml.multiline_str(json_parse_error)
-                    with open('discovery.yaml', 'w') as out_file:
-                        imb_yaml.dump(output, out_file)
+                from imb.imb_oco import OcoError
+                oco = self._oco_client()
+                loop = asyncio.get_event_loop()
+                oco_errors = []
+                def set_imb_userdata(config):
+                    config.setdefault('adjustment', {}).setdefault('control', {}).setdefault('userdata', {})['imb'] = output
+                try:
+                    await loop.run_in_executor(None, oco.update_config, set_imb_userdata)
+                except OcoError as e:
+                    oco_errors.append(e.to_dict())
                     self.finished_message = [
                             'Failed to push discovery telemetry to OCO config. Please reach out to opsani with a copy of your discovery.yaml telemetry file.'
                         ] + self.finished_message
-                else:
-                    current_override.setdefault('adjustment', {}).setdefault('control', {}).setdefault('userdata', {})['imb'] = output
-                    response=requests.put(
-                        url,
-                        headers=headers,
-                        json=current_override
-                    )
-                    if not response.ok:
-                        output['oco-config-write-error-code'] = response.status_code
-                        output['oco-config-write-error-text'] = response.text
-                        with open('discovery.yaml', 'w') as out_file:
-                            imb_yaml.dump(output, out_file)
-                        self.finished_message = [
-                                'Failed to push discovery telemetry to OCO config. Please reach out to opsani with a copy of your discovery.yaml telemetry file.'
-                            ] + self.finished_message
 
-                url=f'https://api.opsani.com/accounts/{self.opsani_account}/applications/{self.app_name}/servo'
-                headers.pop('Content-type')
-                payload = {'event': 'TELEMETRY', 'param': output }
-                response=requests.post(
-                    url,
-                    headers=headers,
-                    json=payload
-                )
-                if not response.ok:
-                    output['oco-event-write-error-code'] = response.status_code
-                    output['oco-event-write-error-text'] = response.text
-                    with open('discovery.yaml', 'w') as out_file:
-                        imb_yaml.dump(output, out_file)
+                try:
+                    await loop.run_in_executor(None, oco.post_event, 'TELEMETRY', output)
+                except OcoError as e:
+                    oco_errors.append(e.to_dict())
                     if any('Please reach out to opsani with a copy of your discovery.yaml telemetry file' in m for m in self.finished_message):
                         self.finished_message = [ 'Failed to push discovery telemetry as OCO event.' ] + self.finished_message
                     else:
@@ -190,6 +193,22 @@ class Imb:
                                 'Failed to push discovery telemetry as OCO event. Please reach out to opsani with a copy of your discovery.yaml telemetry file.'
                             ] + self.finished_message
 
+                if oco_errors:
+                    output['oco-errors'] = oco_errors
+                    self.journal.compact(output)
+
+    def write_telemetry(self):
+        'telemetry and baseline of a finished discovery, whose state is not kept in discovery.yaml so it isn\'t offered for resume'
+        output = { 'telemetry': self.telemetry.summary() }
+        if self._baseline():
+            output['baseline'] = self._baseline()
+        with open(TELEMETRY_PATH, 'w') as out_file:
+            imb_yaml.dump(output, out_file)
+
+    def _baseline(self):
+        # None until discovery has been initialized and the baseline captured
+        return _dict(_dict(getattr(self, 'ocoOverride', None)).get('optimization')).get('baseline')
+
     async def main(self):
         try:
             await self.ui.init_done.wait() # wait for UI to be ready before doing anything with it
@@ -203,14 +222,28 @@ class Imb:
 
             if not self.finished_discovery:
                 await self.write_state() # write out discovery.yaml, push to OCO if user accepts
+            else:
+                self.write_telemetry()
+                self.journal.discard() # nothing left to resume
         except asyncio.CancelledError:
             raise
+        except HeadlessError as e:
+            await self.write_state(formatted_exception=format_exc())
+            self.finished_message, self.exit_code = ['Headless discovery failed: {}'.format(e)], 2
         except Exception:
             await self.write_state(formatted_exception=format_exc())
             self.finished_message = ["IMB has encountered an unexpected circumstance. Please reach out to Opsani support",
                 "with a copy of your discovery.yaml telemetry file if you did not send it when prompted"]
+            if self.headless:
+                self.finished_message = [ format_exc() ] + self.finished_message
+            self.exit_code = 1
             # raise # no longer need to raise since exception info is captured in write_state
         finally:
+            self.scheduler.cancel_all()
+            self.prefetcher.cancel()
+            self.journal.close()
+            if self.oco is not None:
+                self.oco.close()
             await self.ui.stop_ui() # Shut down UI when finished
 
     # Update info used in Other/Error handling
@@ -293,6 +326,7 @@ class Imb:
             state_data = self.app_state.get(current_method.__qualname__, {}) # Initialize new dict if it doesn't exist
 
             go_back = None
+            self.telemetry.start_span(current_method.__qualname__)
             if state_data.get('errored'):
                 # If resuming previous run and current_method state_data contains 'errored' key, don't run it, call on_error
                 current_method.__self__.on_error(errored_method_name=current_method.__qualname__, formatted_exception=state_data['error'], call_next=self.call_next)
@@ -303,6 +337,7 @@ class Imb:
                     go_back = await current_method(self.call_next, state_data)
                     current_method.__self__.on_forward(state_data)
                 except asyncio.CancelledError:
+                    self.telemetry.end_span('cancelled')
                     go_back_from_esc = await self.write_state(disable_back=False)
                     if not go_back_from_esc:
                         raise
@@ -310,9 +345,13 @@ class Imb:
                         state_data = {}
                         continue
                 except: # Error handling is included in the run_stack so the user can back over it and try again or change info
+                    if self.headless:
+                        self.telemetry.end_span('error')
+                        raise # Nobody to back over it, fail fast with the original error
                     state_data['errored'] = True
                     state_data['error'] = imb_yaml.multiline_str(format_exc())
                     current_method.__self__.on_error(errored_method_name=current_method.__qualname__, formatted_exception=state_data['error'], call_next=self.call_next)
+            self.telemetry.end_span('error' if state_data.get('errored') else 'back' if go_back else 'forward')
 
             # Methods return True when go back is selected
             if go_back:
@@ -321,6 +360,7 @@ class Imb:
                     # Remove app_state of methods we are backing into/over so it does not trigger 'resume run' logic
                     # TODO: set app_state['backed_in'] = True instead of popping app_state off so app_state values can be used to pre-populate prompts
                     back_data = self.app_state.pop(self.run_stack[-1].__qualname__)
+                    self.journal.pop(self.run_stack[-1].__qualname__)
                     self.run_stack[-1].__self__.on_back(back_data)
                     self.run_stack.pop()
                 if not self.run_stack:
@@ -328,14 +368,31 @@ class Imb:
                     return # Backed out of the entire program, just exit here
                 else:
                     back_data = self.app_state.pop(self.run_stack[-1].__qualname__) # remove new current method's app_state on back to prevent 'resume run' logic
+                    self.journal.pop(self.run_stack[-1].__qualname__)
                     self.run_stack[-1].__self__.on_back(back_data)
             else:
                 # Update app_state with data from method that was just run including bool for whether it was interacted with or not
                 self.app_state[current_method.__qualname__] = state_data
+                self.journal.set(current_method.__qualname__, state_data)
+                if self.journal.records >= JOURNAL_COMPACT_RECORDS:
+                    self.journal.compact({ 'state': self.app_state })
 
     def call_next(self, method):
         self.run_stack.append(method)
 
+    def _oco_client(self):
+        'OCO client shared by the steps talking to OCO, created on first use'
+        if self.oco is None:
+            from imb.imb_oco import OcoClient # requests is deferred, it adds noticeably to startup
+            Telemetry.instrument_loaded_clients() # time OCO calls made from the current step on
+            self.oco = OcoClient(self.opsani_account, self.app_name, self.token)
+        return self.oco
+
+    def _current_method_name(self):
+        # Read from the stall watchdog's thread
+        run_stack = list(self.run_stack)
+        return run_stack[-1].__qualname__ if run_stack and run_stack[-1] is not None else None
+
     async def initialize_discovery(self, call_next, state_data):
         state_data['interacted'] = False
         self.servoConfig = {}
@@ -357,6 +414,7 @@ class Imb:
             env_path = Path('./.env')
         if not env_path.exists():
             env_path = Path('~/opsani.env')
+        from dotenv import load_dotenv
         load_dotenv(dotenv_path=env_path)
 
         if os.getenv('OPSANI_ACCOUNT_ID') is not None:
@@ -372,6 +430,11 @@ class Imb:
             self.imbConfig['mode'] = os.environ['OPSANI_OPTIMIZATION_MODE']
         else:
             self.imbConfig['mode'] = 'saturation'
+        # Servo container resources are sized from the load it generates unless overridden (used as both request and limit)
+        if os.getenv('OPSANI_SERVO_CPU') is not None:
+            self.imbConfig['servo_cpu'] = os.environ['OPSANI_SERVO_CPU']
+        if os.getenv('OPSANI_SERVO_MEMORY') is not None:
+            self.imbConfig['servo_memory'] = os.environ['OPSANI_SERVO_MEMORY']
 
         # Queue up next method and return False for no interaction
         call_next(self.get_credentials)
@@ -438,6 +501,10 @@ class Imb:
 
     async def discover_adjust(self, call_next, state_data):
         state_data['interacted'] = False
+        from imb.imb_kubernetes import ImbKubernetes
+        from imb.imb_prometheus import check_prometheus_service
+        # Checks the in-cluster prometheus service found by kubernetes discovery while the user makes kubernetes selections
+        self.scheduler.task('prometheus_reachable', ['prometheus_service'], check_prometheus_service)
         # Run k8s imb by default for now
         self.k8sImb = ImbKubernetes(
             ui=self.ui, 
@@ -446,13 +513,17 @@ class Imb:
             imbConfig=self.imbConfig,
             ocoOverride=self.ocoOverride,
             servoConfig=self.servoConfig,
-            running_in_k8s=self.running_in_k8s
+            running_in_k8s=self.running_in_k8s,
+            inventory=self.inventory,
+            scheduler=self.scheduler,
+            prefetcher=self.prefetcher
         )
         self.imb_modules.append(self.k8sImb)
         call_next(self.k8sImb.run)
 
     async def discover_measure(self, call_next, state_data):
         state_data['interacted'] = False
+        from imb.imb_prometheus import ImbPrometheus
         # Run prometheus discovery
         self.promImb = ImbPrometheus(
             ui=self.ui, 
@@ -460,19 +531,24 @@ class Imb:
             finished_message=self.finished_message,
             k8sImb=self.k8sImb, 
             ocoOverride=self.ocoOverride,
-            servoConfig=self.servoConfig
+            servoConfig=self.servoConfig,
+            scheduler=self.scheduler,
+            prefetcher=self.prefetcher
         )
         self.imb_modules.append(self.promImb)
         call_next(self.promImb.run)
 
     async def discover_load(self, call_next, state_data):
         state_data['interacted'] = False
+        self.vegImb = None
         if self.imbConfig.get('mode') == 'saturation':
+            from imb.imb_vegeta import ImbVegeta
             # Run imb vegeta as default load gen for now
             self.vegImb = ImbVegeta(
                 ui=self.ui,
                 finished_method=self.select_servo, 
                 k8sImb=self.k8sImb,
+                promImb=self.promImb,
                 ocoOverride=self.ocoOverride,
                 servoConfig=self.servoConfig
             )
@@ -517,35 +593,35 @@ class Imb:
 
             push_override = False
             if self.app_name and self.opsani_account and self.token:
-                url=f"https://api.optune.ai/accounts/{self.opsani_account}/applications/{self.app_name}/config/"
-                headers={"Content-type": "application/merge-patch+json",
-                    "Authorization": f"Bearer {self.token}"}
+                from imb.imb_oco import OcoError
+                oco = self._oco_client()
                 try:
-                    response=requests.get(
-                        url,
-                        headers=headers
-                    )
-                    current_override = response.json()
+                    current_override = await asyncio.get_event_loop().run_in_executor(None, oco.get_config)
+                    # Sections of the live config may be missing, null or of an unexpected type
+                    current_control = _dict(_dict(current_override.get('measurement')).get('control'))
+                    current_optimization = current_override.get('optimization')
 
-                    if self.ocoOverride['measurement']['control'].get('duration') and self.ocoOverride['measurement']['control']['duration'] != current_override.get('measurement', {}).get('control', {}).get('duration'):
+                    if self.ocoOverride['measurement']['control'].get('duration') and self.ocoOverride['measurement']['control']['duration'] != current_control.get('duration'):
                         push_override = True
                     elif self.ocoOverride.get('optimization'):
-                        if 'optimization' in current_override:
-                            if self.ocoOverride['optimization'].get('perf') and self.ocoOverride['optimization']['perf'] != current_override['optimization'].get('perf'):
+                        if isinstance(current_optimization, dict):
+                            if self.ocoOverride['optimization'].get('perf') and self.ocoOverride['optimization']['perf'] != current_optimization.get('perf'):
                                 push_override = True
                             
-                            if self.ocoOverride['optimization'].get('mode') and self.ocoOverride['optimization']['mode'] != current_override['optimization'].get('mode'):
+                            if self.ocoOverride['optimization'].get('mode') and self.ocoOverride['optimization']['mode'] != current_optimization.get('mode'):
                                 push_override = True
                             
-                            if self.ocoOverride['optimization'].get('cost') and self.ocoOverride['optimization']['cost'] != current_override['optimization'].get('cost'):
+                            if self.ocoOverride['optimization'].get('cost') and self.ocoOverride['optimization']['cost'] != current_optimization.get('cost'):
+                                push_override = True
+
+                            if self.ocoOverride['optimization'].get('baseline') and self.ocoOverride['optimization']['baseline'] != current_optimization.get('baseline'):
                                 push_override = True
                         else:
                             push_override = True
-                except:
+                except OcoError as e:
                     self.other_info.setdefault('non-critical-errors', {})['OCO Read Error'] = {
                         'reason': 'Unable to determine current state of OCO override config',
-                        'error': imb_yaml.multiline_str(format_exc()),
-                        'OCO response': imb_yaml.multiline_str(response.text)
+                        'error': e.to_dict()
                     }
 
             if push_override:
@@ -554,14 +630,18 @@ class Imb:
                 if result.back_selected:
                     return True
                 if result.value:
-                    params = {'patch': 'true'}
-                    data = json.dumps(self.ocoOverride)
-                    response=requests.put(
-                        url,
-                        params=params,
-                        headers=headers,
-                        data=data
-                    )
+                    # Only the parts of the override that differ from OCO's current config are sent
+                    try:
+                        await asyncio.get_event_loop().run_in_executor(None, oco.merge_config, self.ocoOverride)
+                    except OcoError as e:
+                        state_data['oco_error'] = e.to_dict()
+                        state_data['finished_message_addon'] = [
+                            "Failed to push the OCO config override ({}). Run".format(e),
+                            "",
+                            "    coctl put --file override.yaml",
+                            "",
+                            "to push it."
+                        ]
                 else:
                     state_data['finished_message_addon'] = [
                         "Run",
@@ -578,6 +658,8 @@ class Imb:
         
     async def finish_discovery(self, call_next, state_data):
         state_data['interacted'] = False
+        from imb.imb_vegeta import VEGETA_TARGETS_KEY, VEGETA_TARGETS_PATH
+        from imb.servo_manifests import servo_configmap, servo_deployment, servo_role, servo_role_binding, servo_secret, servo_service_account, size_servo_resources
         Path('./servo-manifests').mkdir(exist_ok=True)
         # Generate servo rbac manifest
         servo_service_account['metadata']['namespace'] = self.servo_namespace
@@ -611,6 +693,28 @@ class Imb:
                 "value": self.servo_namespace or '@@MANUAL_CONFIGURATION_REQUIRED@@'
             }
         ]
+        prom_config = self.servoConfig.get('prom')
+        servo_deployment['spec']['template']['spec']['containers'][0]['resources'] = size_servo_resources(
+            rate=self.vegImb.rate_per_second if self.vegImb else 0,
+            max_workers=self.vegImb.vegeta_config.get('max-workers', 0) if self.vegImb else 0,
+            targets=len(self.vegImb.load_targets) if self.vegImb else 0,
+            metrics=len(prom_config.get('metrics', {})) if isinstance(prom_config, dict) else 0,
+            cpu=self.imbConfig.get('servo_cpu'),
+            memory=self.imbConfig.get('servo_memory')
+        )
+        # Multi-target load is read by vegeta from a targets file shipped in the servo configmap
+        targets_file = self.vegImb.targets_file if self.vegImb else None
+        volume_mounts = servo_deployment['spec']['template']['spec']['containers'][0]['volumeMounts']
+        volume_mounts[:] = [ m for m in volume_mounts if m.get('subPath') != VEGETA_TARGETS_KEY ]
+        servo_configmap['data'].pop(VEGETA_TARGETS_KEY, None)
+        if targets_file:
+            volume_mounts.append({
+                "name": "config",
+                "mountPath": VEGETA_TARGETS_PATH,
+                "subPath": VEGETA_TARGETS_KEY,
+                "readOnly": True
+            })
+            servo_configmap['data'][VEGETA_TARGETS_KEY] = imb_yaml.multiline_str(targets_file)
         with open('servo-manifests/opsani-servo-deployment.yaml', 'w') as out_file:
             imb_yaml.dump(servo_deployment, out_file)
 
@@ -655,8 +759,28 @@ class Imb:
 
         call_next(None) # done, exit here
 
+def _dict(value):
+    return value if isinstance(value, dict) else {}
+
 def imb():
-    Imb().run()
+    parser = argparse.ArgumentParser(description='Discover an app to be optimized by Opsani and generate servo manifests')
+    parser.add_argument('--headless', action='store_true', help='run without the TUI, answering prompts from --answers and the flags below')
+    parser.add_argument('--answers', help='YAML file mapping prompt titles (or text input prompts) to answers, implies --headless')
+    for flag, key in FLAG_ANSWER_KEYS.items():
+        parser.add_argument('--{}'.format(flag.replace('_', '-')), dest=flag, help='answer to "{}"{}'.format(key, ' (comma separated)' if flag == 'metrics' else ''))
+    parser.add_argument('--fleet', help='YAML file of deployments (or selectors of them) to discover in parallel, see imb/imb_fleet.py')
+    parser.add_argument('--fleet-output', default=DEFAULT_FLEET_OUTPUT, help='directory fleet mode writes per app outputs and its summary to')
+    parser.add_argument('--fleet-workers', type=int, help='worker processes used by fleet mode (default: number of CPUs)')
+    parser.add_argument('--debug-stalls', action='store_true', help='log the stack of calls blocking the event loop to {} (also IMB_DEBUG_STALLS=1)'.format(STALL_LOG))
+    parser.add_argument('--trace', help='write a Chrome trace (chrome://tracing, Perfetto) of the discovery steps and API calls to this file')
+    args = parser.parse_args()
+
+    if args.fleet:
+        from imb.imb_fleet import run_fleet
+        sys.exit(run_fleet(args.fleet, output_dir=args.fleet_output, workers=args.fleet_workers))
+
+    headless = args.headless or args.answers or any(getattr(args, flag) is not None for flag in FLAG_ANSWER_KEYS)
+    sys.exit(Imb(trace_path=args.trace, debug_stalls=args.debug_stalls).run(headless_ui=ImbHeadless.from_args(args) if headless else None))
 
 if __name__ == "__main__":
     imb()
@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+MEMO_TTL = 300 # seconds a memoized listing or query result is reused before it is fetched again
+
+MISSING = object()
+
+class SessionMemo:
+    '''Results of cluster and prometheus lookups keyed by what was looked up and its inputs (eg. ('deployments', namespace)),
+    so run_stack methods re-run after Back/Forward navigation don't repeat them. Entries expire after ttl seconds, are dropped
+    by invalidate() when the user asks for a refresh and are only valid within one scope (the kubernetes context)'''
+    def __init__(self, ttl=MEMO_TTL):
+        self.ttl = ttl
+        self.scope = None
+        self.entries = {} # key -> (monotonic time stored, value)
+
+    def set_scope(self, scope):
+        if scope != self.scope:
+            self.entries = {}
+            self.scope = scope
+
+    def lookup(self, key):
+        'memoized value of key, or MISSING when there is none or it expired'
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING
+        if time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            return MISSING
+        return entry[1]
+
+    def store(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+
+    async def get(self, key, fn):
+        value = self.lookup(key)
+        if value is MISSING:
+            value = await call(fn)
+            self.store(key, value)
+        return value
+
+    def invalidate(self, prefix=()):
+        'drop entries whose key starts with prefix, all of them by default'
+        for key in [ k for k in self.entries if k[:len(prefix)] == prefix ]:
+            del self.entries[key]
+
+async def call(fn):
+    'await the no argument callable fn, plain functions are run in the default executor'
+    if asyncio.iscoroutinefunction(fn):
+        return await fn()
+    return await asyncio.get_event_loop().run_in_executor(None, fn)
@@ -0,0 +1,114 @@
+from collections import namedtuple
+import os
+from pathlib import Path
+
+import imb.imb_yaml as imb_yaml
+
+# Catalog files bundled with IMB. Additional files or directories of files can be supplied through the
+#   IMB_METRICS_CATALOG_PATH env var (os.pathsep separated), entries from those override bundled entries with the same match key
+BUILTIN_CATALOG_DIR = Path(__file__).parent / 'known_metrics'
+MATCH_KEYS = ('name', 'prefix', 'suffix')
+
+# perf_name: suggested config/perf name, query: template where {} is replaced by the metric selector (including all filters),
+#   {base} by the selector without status_filters and {window} by the rate()/increase() range, unit: metric unit,
+#   kind: throughput, error_rate or latency, filters: extra label matchers appended to the metric selector (eg. the reporter
+#   or direction of proxy metrics), status_filters: matchers selecting failed requests, the numerator of an error rate
+class KnownMetric(namedtuple('KnownMetric', ['perf_name', 'query', 'unit', 'kind', 'filters', 'status_filters'])):
+    def format_query(self, selector, base_selector, window='1m'):
+        return self.query.format(selector, base=base_selector, window=window)
+
+class MetricsCatalog:
+    def __init__(self):
+        self.exact = {}
+        # Prefixes and suffixes are indexed by length so a metric name only needs one dict lookup per distinct length
+        self.prefixes = {}
+        self.suffixes = {}
+
+    @classmethod
+    def load(cls, extra_paths=None):
+        if extra_paths is None:
+            extra_paths = [ p for p in os.getenv('IMB_METRICS_CATALOG_PATH', '').split(os.pathsep) if p ]
+
+        catalog = cls()
+        for path in [BUILTIN_CATALOG_DIR] + [ Path(p).expanduser() for p in extra_paths ]:
+            files = sorted(path.glob('*.y*ml')) if path.is_dir() else [path]
+            for f in files:
+                with open(f) as in_file:
+                    catalog.add_entries(imb_yaml.safe_load(in_file) or [], source=f)
+
+        return catalog
+
+    def add_entries(self, entries, source=None):
+        # Entries sharing a match key within one file are grouped (eg. p50/p90/p99 of one histogram) and replace
+        #   any group previously loaded for the same key
+        groups = {}
+        for e in entries:
+            keys = [ k for k in MATCH_KEYS if k in e ]
+            if len(keys) != 1 or not e.get('query'):
+                raise Exception('Invalid known metrics catalog entry in {}, expected a query and exactly one of {}: {}'.format(
+                    source, ', '.join(MATCH_KEYS), e))
+            known = KnownMetric(
+                perf_name=e.get('perf_name', e[keys[0]].strip('_')),
+                query=e['query'],
+                unit=e.get('unit', ''),
+                kind=e.get('kind'),
+                filters=tuple(e.get('filters', ())),
+                status_filters=tuple(e.get('status_filters', ()))
+            )
+            groups.setdefault((keys[0], e[keys[0]]), []).append(known)
+
+        for (key, value), known in groups.items():
+            if key == 'name':
+                self.exact[value] = known
+            elif key == 'prefix':
+                self.prefixes.setdefault(len(value), {})[value] = known
+            else:
+                self.suffixes.setdefault(len(value), {})[value] = known
+
+    def match(self, metric_name):
+        'Return the templates of the most specific catalog entry matching metric_name: exact name, then longest prefix/suffix'
+        if metric_name in self.exact:
+            return self.exact[metric_name]
+
+        best, best_len = [], 0
+        for index, part in ((self.prefixes, lambda l: metric_name[:l]), (self.suffixes, lambda l: metric_name[-l:])):
+            for length, entries in index.items():
+                if best_len < length <= len(metric_name):
+                    known = entries.get(part(length))
+                    if known:
+                        best, best_len = known, length
+        return best
+
+    def match_all(self, metric_names):
+        'Resolve many discovered metric names in one pass, returns a dict of matched names only'
+        matches = {}
+        for m in metric_names:
+            known = self.match(m)
+            if known:
+                matches[m] = known
+        return matches
+
+    def __contains__(self, metric_name):
+        return bool(self.match(metric_name))
+
+# Label names commonly carrying the HTTP status of a request, used to build error rate queries for generated histogram templates
+STATUS_LABELS = ['code', 'status', 'status_code', 'response_code', 'http_status', 'envoy_response_code']
+LATENCY_QUANTILES = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]
+
+def histogram_family_metrics(family, status_label=None):
+    '''Generate throughput, error rate and latency quantile templates for a histogram family with _bucket, _count and _sum series
+    that isn't in the catalog. Returns a dict mapping the _count and _bucket metric names to their templates'''
+    scale, unit = '', ''
+    if family.endswith('_seconds'):
+        scale, unit = '1000 * ', 'ms'
+    elif family.endswith(('_milliseconds', '_ms')):
+        unit = 'ms'
+
+    count_metrics = [ KnownMetric('{}_throughput'.format(family), 'sum(rate({}[{window}]))', 'rpm', 'throughput', (), ()) ]
+    if status_label:
+        count_metrics.append(KnownMetric('{}_error_rate'.format(family), '100 * sum(rate({}[{window}])) / sum(rate({base}[{window}]))',
+            'percent', 'error_rate', (), ('{}=~"5.."'.format(status_label),)))
+    bucket_metrics = [ KnownMetric('{}_{}'.format(family, name), '{}histogram_quantile({}, sum(rate({{}}[{{window}}])) by (le))'.format(scale, q),
+        unit, 'latency', (), ()) for name, q in LATENCY_QUANTILES ]
+
+    return { '{}_count'.format(family): count_metrics, '{}_bucket'.format(family): bucket_metrics }
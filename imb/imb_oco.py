@@ -0,0 +1,143 @@
+import copy
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+OCO_CONFIG_URL = 'https://api.optune.ai/accounts/{account}/applications/{app}/config/'
+OCO_SERVO_URL = 'https://api.opsani.com/accounts/{account}/applications/{app}/servo'
+OCO_TIMEOUT = (3.05, 30) # connect, read seconds
+OCO_RETRIES = 3
+OCO_BACKOFF = 0.5 # seconds, doubled on every retry
+OCO_RETRY_STATUSES = (429, 500, 502, 503, 504)
+OCO_CONFLICT_RETRIES = 2 # times a config update is recomputed when the config changed since it was read
+
+class OcoError(Exception):
+    'Failed OCO API request, to_dict() describes it for discovery.yaml'
+    def __init__(self, operation, url, status=None, response_text=None, reason=None):
+        super().__init__('OCO {} failed{}: {}'.format(operation, ' ({})'.format(status) if status else '', reason or response_text))
+        self.operation = operation
+        self.url = url
+        self.status = status
+        self.response_text = response_text
+        self.reason = reason
+
+    def to_dict(self):
+        return { 'operation': self.operation, 'url': self.url, 'status': self.status, 'reason': self.reason, 'response': self.response_text }
+
+class OcoClient:
+    '''Client of an OCO application's config and servo event APIs sharing one pooled session. Idempotent requests are retried
+    with backoff on connection errors and OCO_RETRY_STATUSES. Config updates are sent as a minimal JSON merge patch (RFC 7386)
+    computed from the config as last read, conditional on its ETag when OCO provides one so concurrent changes aren't
+    overwritten: the update is recomputed against the new config instead'''
+    def __init__(self, account, app, token, timeout=OCO_TIMEOUT):
+        self.config_url = OCO_CONFIG_URL.format(account=account, app=app)
+        self.servo_url = OCO_SERVO_URL.format(account=account, app=app)
+        self.timeout = timeout
+        self.config = None # as last read
+        self.etag = None
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer {}'.format(token)
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=4, max_retries=_retry()))
+
+    def get_config(self):
+        response = self._request('read config', 'GET', self.config_url)
+        try:
+            self.config = response.json()
+        except ValueError:
+            raise OcoError('read config', self.config_url, response.status_code, response.text, 'response is not valid JSON')
+        if not isinstance(self.config, dict):
+            self.config = None
+            raise OcoError('read config', self.config_url, response.status_code, response.text, 'response is not a JSON object')
+        self.etag = response.headers.get('ETag')
+        return copy.deepcopy(self.config)
+
+    def update_config(self, update):
+        '''apply update(config), which modifies the config passed to it, to the app's config. Returns the merge patch sent,
+        None when there was nothing to change'''
+        for _ in range(OCO_CONFLICT_RETRIES + 1):
+            if self.config is None:
+                self.get_config()
+            target = copy.deepcopy(self.config)
+            update(target)
+            patch = merge_patch_diff(self.config, target)
+            if patch is None:
+                return None
+
+            headers = { 'Content-Type': 'application/merge-patch+json' }
+            if self.etag:
+                headers['If-Match'] = self.etag
+            try:
+                response = self._request('update config', 'PUT', self.config_url, params={ 'patch': 'true' }, headers=headers,
+                    data=json.dumps(patch))
+            except OcoError as e:
+                if e.status != 412: # Precondition Failed, the config changed since it was read
+                    raise
+                self.config = None
+                continue
+            self.config, self.etag = target, response.headers.get('ETag')
+            return patch
+        raise OcoError('update config', self.config_url, 412, reason='config kept changing while it was being updated')
+
+    def merge_config(self, patch):
+        'merge patch into the app\'s config, only the parts of it that differ from the current config are sent'
+        return self.update_config(lambda config: apply_merge_patch(config, patch))
+
+    def post_event(self, event, param):
+        self._request('post {} event'.format(event), 'POST', self.servo_url, json={ 'event': event, 'param': param })
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, operation, method, url, **kwargs):
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise OcoError(operation, url, reason='{}: {}'.format(type(e).__name__, e))
+        if not response.ok:
+            raise OcoError(operation, url, response.status_code, response.text, response.reason)
+        return response
+
+def apply_merge_patch(target, patch):
+    'RFC 7386 merge patch, target is modified in place when both are objects. Returns the result'
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = apply_merge_patch(target.get(key), value)
+    return target
+
+def merge_patch_diff(source, target):
+    '''minimal RFC 7386 merge patch turning source into target, None when they are equal. Merge patches can't set null
+    values, nulls within target are treated as removals'''
+    if not isinstance(source, dict) or not isinstance(target, dict):
+        return None if source == target else copy.deepcopy(target)
+    patch = {}
+    for key in source:
+        if source[key] is not None and (key not in target or target[key] is None):
+            patch[key] = None
+    for key, value in target.items():
+        if value is None:
+            continue
+        if key not in source:
+            patch[key] = copy.deepcopy(value)
+        else:
+            value_patch = merge_patch_diff(source[key], value)
+            if value_patch is not None:
+                patch[key] = value_patch
+    return patch or None
+
+def _retry():
+    kwargs = dict(total=OCO_RETRIES, backoff_factor=OCO_BACKOFF, status_forcelist=OCO_RETRY_STATUSES, raise_on_status=False)
+    # Connection errors are retried for any method, read errors and retry statuses only for idempotent ones (not event POSTs)
+    methods = frozenset(['GET', 'PUT'])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError: # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
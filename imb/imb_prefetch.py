@@ -0,0 +1,62 @@
+import asyncio
+from collections import OrderedDict
+
+from imb.imb_memo import MISSING, call, SessionMemo
+
+PREFETCH_MAX_IN_FLIGHT = 8 # speculative fetches running at once, the oldest is cancelled to make room
+
+class Prefetcher:
+    '''Speculatively fetches data a step will probably need while the user is still on a prompt (eg. the deployments of the
+    highlighted namespace). fn is a no argument callable, plain functions run in the default executor. Steps consume the
+    data with get(), which waits for a matching fetch already in flight or fetches it directly. Failed speculative fetches
+    are retried by get() so their errors surface in the step that needs the data. Fetched data is memoized in memo'''
+    def __init__(self, max_in_flight=PREFETCH_MAX_IN_FLIGHT, memo=None):
+        self.max_in_flight = max_in_flight
+        self.memo = memo or SessionMemo()
+        self.tasks = OrderedDict() # key -> task, oldest first
+
+    def prefetch(self, key, fn):
+        if self.memo.lookup(key) is not MISSING:
+            return
+        if key in self.tasks:
+            self.tasks.move_to_end(key)
+            return
+        self.tasks[key] = asyncio.ensure_future(_run(fn))
+
+        in_flight = [ k for k, t in self.tasks.items() if not t.done() ]
+        for k in in_flight[:max(0, len(in_flight) - self.max_in_flight)]:
+            self.tasks.pop(k).cancel()
+
+    async def get(self, key, fn):
+        result = self.memo.lookup(key)
+        if result is not MISSING:
+            return result
+
+        task = self.tasks.pop(key, None)
+        if task is not None and not task.cancelled():
+            try:
+                result = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+        if result is MISSING or isinstance(result, _Failed):
+            result = await call(fn)
+        self.memo.store(key, result)
+        return result
+
+    def cancel(self, keep=()):
+        'cancel speculative fetches for choices that weren\'t made, finished ones other than keep are dropped too'
+        for key in [ k for k in self.tasks if k not in keep ]:
+            self.tasks.pop(key).cancel()
+
+class _Failed:
+    def __init__(self, exception):
+        self.exception = exception
+
+async def _run(fn):
+    try:
+        return await call(fn)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        return _Failed(e)
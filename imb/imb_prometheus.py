@@ -1,28 +1,175 @@
+from array import array
 import asyncio
 import atexit
+from functools import partial
+import gzip
+import hashlib
 import json
+import math
+import os
 from os.path import expanduser
+from pathlib import Path
+import re
 import requests
 import subprocess
 import time
 
-# Maps metric name to suggested config/perf name, query template and unit
-KNOWN_METRICS = {
-    'envoy_cluster_upstream_rq_total': ('main_request_rate', 'sum(rate({}[1m]))', 'rpm'),
-    # 'envoy_cluster_external_upstream_rq_time_bucket': ('main_p90_time', 'histogram_quantile(0.9,sum(rate({}[1m])) by (envoy_cluster_name, le))', 'ms'),
-    'api_requests_total': ('main_request_rate', 'sum(rate({}[1m]))', 'rpm'),
+from imb.imb_metrics_catalog import histogram_family_metrics, MetricsCatalog, STATUS_LABELS
+from imb.imb_prefetch import Prefetcher
+import imb.imb_stats as imb_stats
+import imb.imb_yaml as imb_yaml
+
+# Labels which vary per pod, scrape target or histogram bucket. Queries used by servo should aggregate these away so the
+#   result is cheap to evaluate and stays stable as pods are replaced
+HIGH_CARDINALITY_LABELS = ['pod', 'pod_name', 'instance', 'le']
+HIGH_CARDINALITY_THRESHOLD = 20 # labels with more distinct values than this are also considered high cardinality
+CARDINALITY_ANALYSIS_LIMIT = 100 # max number of candidate metrics to analyze
+QUERY_CONCURRENCY = 8 # max number of prometheus queries in flight at once
+TYPEAHEAD_THRESHOLD = 100 # candidate metric lists longer than this are picked with a server side search instead of a full list
+
+# rate()/increase() windows must span several scrapes to avoid empty or jittery results
+RATE_WINDOW_SCRAPE_MULTIPLE = 4
+DEFAULT_RATE_WINDOW = '1m'
+
+# Range queries are split into step-aligned shards of at most this many points per series (prometheus rejects
+#   queries resolving to more than 11000) which are fetched concurrently and cached on disk by query and time bucket
+RANGE_QUERY_SHARD_POINTS = 720
+RANGE_QUERY_CONCURRENCY = 4
+RANGE_QUERY_CACHE_DIR = Path('.imb-cache/range-queries')
+RANGE_QUERY_SETTLE_SECONDS = 300 # shards ending more recently than this may still receive samples and are not cached
+
+# Baseline performance of the current deployment settings is summarized over this recent window (or since the current
+#   ReplicaSet was rolled out if that is more recent)
+BASELINE_LOOKBACK = 60 * 60
+BASELINE_STEP = 60
+BASELINE_RESOURCE_QUERIES = {
+    'cpu_usage': 'sum(rate(container_cpu_usage_seconds_total{{{selector}}}[{window}]))', # cores
+    'mem_usage': 'sum(container_memory_working_set_bytes{{{selector}}}) / 1073741824', # GiB
 }
 
+# Measurement duration is recommended from the noise of the perf metric over this window: the shortest candidate duration
+#   whose mean has a coefficient of variation at or below the target
+DURATION_ANALYSIS_LOOKBACK = 6 * 60 * 60
+DURATION_CANDIDATES = [60, 120, 180, 300, 600, 900, 1800]
+DURATION_MAX_CV = 0.05
+DEFAULT_MEASUREMENT_PAST = 60 # seconds, measurement.control.past of the override when no duration is recommended
+
+SLO_HEADROOM = 1.2 # suggested latency SLO relative to the current value
+
+# Production request rate (peak and p95) of the throughput metric, proposed as the load generator rate. A week covers
+#   daily and weekday/weekend traffic patterns
+PRODUCTION_RATE_LOOKBACK = 7 * 24 * 60 * 60
+PRODUCTION_RATE_STEP = 5 * 60
+
+# Requests of the throughput metric are broken down by the first path and method labels present to weight load generation targets
+PATH_LABELS = ['path', 'handler', 'uri', 'route', 'url', 'request_path']
+METHOD_LABELS = ['method', 'http_method', 'request_method', 'verb']
+TRAFFIC_MIX_WINDOW = '1d'
+TRAFFIC_MIX_MAX_PATHS = 20
+
+# Range queries looking back further than the recent endpoint's retention are routed to the first long-term endpoint.
+#   Used when retention can't be read from the endpoint's flags
+DEFAULT_RECENT_RETENTION = 24 * 60 * 60
+
+# (namespace, pod, container) label names used by common scrape configs: cAdvisor/prometheus-operator,
+#   cAdvisor before kubernetes 1.16, and the kubernetes-pods job relabeling of the community helm chart
+POD_LABEL_NAMES = [
+    ('namespace', 'pod', 'container'),
+    ('namespace', 'pod_name', 'container_name'),
+    ('kubernetes_namespace', 'kubernetes_pod_name', None),
+]
+
+class RangeSeries:
+    'compact array-backed series of unix timestamps and float64 values'
+    __slots__ = ('labels', 'timestamps', 'values')
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.timestamps = array('d')
+        self.values = array('d')
+
+    def __len__(self):
+        return len(self.values)
+
+class PrometheusRangeQuery:
+    def __init__(self, api_url, cache_dir=RANGE_QUERY_CACHE_DIR, max_concurrency=RANGE_QUERY_CONCURRENCY, shard_points=RANGE_QUERY_SHARD_POINTS):
+        self.api_url = api_url
+        self.cache_dir = cache_dir
+        self.max_concurrency = max_concurrency
+        self.shard_points = shard_points
+
+    async def query(self, query_text, start, end, step):
+        'evaluate query_text every step seconds between unix times start and end, returns a list of RangeSeries'
+        step = max(1, int(step))
+        start, end = (int(start) // step) * step, (int(end) // step) * step
+        shard_span = step * self.shard_points
+
+        # Shards cover whole, absolute buckets so overlapping analyses share cached shards. Points outside [start, end] are dropped on merge
+        now = time.time()
+        buckets = range((start // shard_span) * shard_span, end + 1, shard_span)
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch(bucket_start):
+            async with semaphore:
+                return await loop.run_in_executor(None, self._fetch_shard, query_text, bucket_start, bucket_start + shard_span - step, step, now)
+
+        shards = await asyncio.gather(*[fetch(b) for b in buckets])
+
+        series = {}
+        for shard in shards: # shards are in time order and don't overlap so points can simply be appended
+            for result in shard:
+                key = tuple(sorted(result['metric'].items()))
+                if key not in series:
+                    series[key] = RangeSeries(result['metric'])
+                for ts, val in result['values']:
+                    if start <= ts <= end:
+                        series[key].timestamps.append(ts)
+                        series[key].values.append(float(val))
+
+        return list(series.values())
+
+    def _fetch_shard(self, query_text, shard_start, shard_end, step, now):
+        cacheable = shard_end <= now - RANGE_QUERY_SETTLE_SECONDS
+        cache_path = self.cache_dir / '{}.json.gz'.format(hashlib.sha256(
+            json.dumps([self.api_url, query_text, step, shard_start]).encode('utf-8')).hexdigest())
+        if cacheable:
+            try:
+                with gzip.open(str(cache_path), 'rt') as in_file:
+                    return json.load(in_file)
+            except (OSError, ValueError): # missing or corrupt cache entry
+                pass
+
+        if shard_start > now:
+            return []
+
+        query_resp = requests.get(url='{}/query_range'.format(self.api_url), timeout=(0.25, 60), params={
+            'query': query_text, 'start': shard_start, 'end': min(shard_end, int(now)), 'step': step })
+        query_resp.raise_for_status()
+        result = query_resp.json()['data']['result']
+
+        if cacheable:
+            # Write to a temp file and rename so concurrent or interrupted runs never read a partial entry
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name('{}.{}.tmp'.format(cache_path.name, os.getpid()))
+            with gzip.open(str(tmp_path), 'wt') as out_file:
+                json.dump(result, out_file)
+            os.replace(str(tmp_path), str(cache_path))
+
+        return result
+
 GATHERED_INFO = set(['prometheus_endpoint', 'local_endpoint', 'desired_deployment_metrics', 'configured_deployment_metrics', 'perf_metric'])
 
 class ImbPrometheus:
-    def __init__(self, ui, finished_method, finished_message, k8sImb, ocoOverride, servoConfig):
+    def __init__(self, ui, finished_method, finished_message, k8sImb, ocoOverride, servoConfig, scheduler=None, prefetcher=None):
         self.ui = ui
         self.finished_method = finished_method
         self.finished_message = finished_message
         self.k8sImb = k8sImb
         self.ocoOverride = ocoOverride
         self.servoConfig = servoConfig
+        self.scheduler = scheduler # checked the in-cluster prometheus service while kubernetes selections were made
+        self.prefetcher = prefetcher or Prefetcher()
 
         # Initialize info used in Other/Error handling
         self.other_info = {}
@@ -30,8 +177,24 @@ class ImbPrometheus:
 
         self.port_forward_proc = None
         self.promConfig = { }
+        self.metric_cardinality = {}
+        self.metric_query_labels = {} # Maps metric name to the label matchers that select the deployment's series
+        self.metric_rate_windows = {} # Maps metric name to the rate window sized from its job's scrape interval
+        self.default_rate_window = DEFAULT_RATE_WINDOW
+        self.recommended_duration = None # seconds
+        self.generated_metrics = {} # templates generated for histogram families the catalog doesn't know
+        self.metric_kinds = {} # configured metric name -> throughput, error_rate or latency
+        self.perf_metric_name = None # configured metric the perf objective is primarily based on
+        self.perf_slo = None # throughput and latency metric names of an SLO constrained objective
+        self.production_rate = None # peak/p95/mean requests per second of the throughput metric
+        self.metric_sources = {} # configured metric name -> prometheus metric it was built from
+        self.traffic_mix = [] # share of production requests by path and method
+        self.metric_name_lookups = {} # search text -> matching metric names, cached for the typeahead metric picker
+        self.known_metrics = MetricsCatalog.load() # Maps metric names to suggested config/perf names, query templates and units
         # self.servMetrics = {}
         self.remote_prometheus_used = False
+        self.long_term_endpoints = []
+        self.endpoints = []
 
     def __del__(self): # Ensure port forward is killed if prom discovery is backed out of and replaced by a new instance
         if self.port_forward_proc and self.port_forward_proc.poll() is None:
@@ -170,11 +333,9 @@ class ImbPrometheus:
             state_data['interacted'] = False
             if self.k8sImb.prometheusService:
                 # Check if endpoint is accessible, port forward if its not
-                state_data['prometheus_endpoint'] = 'http://{}.{}.svc:{}'.format(
-                    self.k8sImb.prometheusService.metadata.name,
-                    self.k8sImb.prometheusService.metadata.namespace,
-                    self.k8sImb.prometheusService.spec.ports[0].port
-                )
+                state_data['prometheus_endpoint'] = service_url(self.k8sImb.prometheusService)
+                # Most users accept the discovered endpoint, query the deployment's metrics while they review it
+                self._prefetch_deployment_metrics(state_data['prometheus_endpoint'])
             else:
                 state_data['prometheus_endpoint'] = ''
             
@@ -183,6 +344,7 @@ class ImbPrometheus:
                 title='Prometheus Endpoint',
                 prompts=[
                     {'prompt': 'Enter/Edit the prometheus endpoint for Servo to use', 'initial_text': state_data['prometheus_endpoint']},
+                    {'prompt': '(Optional) Long-term storage endpoints used for discovery only, eg. Thanos Querier (comma separated)', 'initial_text': '', 'optional': True},
                 ],
                 allow_other=True
             )
@@ -192,20 +354,29 @@ class ImbPrometheus:
             if result.other_selected:
                 state_data['other_selected'] = True
             else:
-                state_data['prometheus_endpoint'] = result.value
+                state_data['prometheus_endpoint'], long_term_endpoints = result.value
+                state_data['long_term_endpoints'] = [ e.strip().rstrip('/') for e in long_term_endpoints.split(',') if e.strip() ]
 
         if state_data.get('other_selected'):
             call_next(self.prompt_other)
         else:
+            # Servo always measures against the endpoint for recent data, long-term stores only serve discovery and history queries
             self.prometheus_endpoint = state_data['prometheus_endpoint']
+            self.long_term_endpoints = state_data.get('long_term_endpoints', [])
             self.promConfig['prometheus_endpoint'] = self.prometheus_endpoint
             
-            try:
-                requests.get(self.prometheus_endpoint, timeout=(0.25, 10))
-            except requests.exceptions.ConnectionError:
+            reachable = None
+            if self.scheduler and self.k8sImb.prometheusService:
+                checked = await self.scheduler.get('prometheus_reachable')
+                if checked and checked['url'] == self.prometheus_endpoint:
+                    reachable = checked['reachable']
+            if reachable is None:
+                reachable = endpoint_reachable(self.prometheus_endpoint)
+
+            if not reachable:
                 call_next(self.prompt_local_endpoint)
             else:
-                self.query_url = '{}/api/v1/query'.format(self.prometheus_endpoint)
+                self._init_endpoints('{}/api/v1'.format(self.prometheus_endpoint))
                 call_next(self.select_deployment_metrics)
 
     async def prompt_local_endpoint(self, call_next, state_data):
@@ -249,7 +420,7 @@ class ImbPrometheus:
             return
 
         self.local_endpoint = state_data['local_endpoint']
-        self.query_url = '{}/api/v1/query'.format(self.local_endpoint)
+        self._init_endpoints('{}/api/v1'.format(self.local_endpoint))
 
         if self.k8sImb.prometheusService:
             # Check if they've already opened a port forward
@@ -290,34 +461,25 @@ class ImbPrometheus:
             state_data['interacted'] = False
             # Get Deployment metrics
             get_metrics_query_text = 'sum by(__name__)({{ {} }})'.format(','.join(self.query_labels))
+            query_url = self.query_url
+            # Copied, the memoized result is extended below with metrics found by other label sets
+            found_metrics = list(await self.prefetcher.get(('deployment_metrics', query_url, get_metrics_query_text),
+                partial(_query_metric_names, query_url, get_metrics_query_text)))
 
-            connect_attempts = 10
-            while connect_attempts > 0:
-                try:
-                    query_resp = requests.get(url=self.query_url, params={ 'query': get_metrics_query_text }, timeout=(0.25, 10))
-                    break
-                except requests.exceptions.ConnectionError:
-                    connect_attempts -= 1
-                    await asyncio.sleep(0.25)
-                except requests.exceptions.ReadTimeout:
-                    connect_attempts -= 1
+            # Format data and prompt
+            self.metric_query_labels = { m['metric']['__name__']: self.query_labels for m in found_metrics }
 
-            try:
-                query_resp = requests.get(url=self.query_url, params={ 'query': get_metrics_query_text })
-            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
-                raise
-                 # TODO pass custom error message to on_error
-                # while self.finished_message:
-                #     self.finished_message.pop()
-                # if self.remote_prometheus_used:
-                #     self.finished_message.append('Extra configuration will be needed to allow Servo to talk to your Prometheus instance, please contact Opsani for further assistance')
-                # else:
-                #     self.finished_message.append('Failed to connect to local prometheus endpoint. Please try again or contact Opsani support for further assistance')
-                # call_next(None)
-                # return {}
+            # cAdvisor and many exporters don't carry the deployment's selector labels, match their series by namespace/pod(/container).
+            #   Each metric keeps the labels of the first (most specific) label set that found it. Queries are fanned out to
+            #   long-term endpoints as well to pick up metrics which are not currently being scraped
+            label_sets = [ self.query_labels ] + self._pod_label_sets()
+            label_set_results = await self._gather_queries([ 'sum by(__name__)({{ {} }})'.format(','.join(ls)) for ls in label_sets ], federated=True)
+            for label_set, result in zip(label_sets, label_set_results):
+                for m in result or []:
+                    if m['metric']['__name__'] not in self.metric_query_labels:
+                        self.metric_query_labels[m['metric']['__name__']] = label_set
+                        found_metrics.append(m)
 
-            # Format data and prompt
-            found_metrics = query_resp.json()['data']['result']
             if not found_metrics:
                 # If no matches found, prompt with all metrics regardless of label
                 self.query_labels = []
@@ -333,21 +495,38 @@ class ImbPrometheus:
 
             if not state_data.get('no_metrics_found'):
                 found_metrics_names = [ m['metric']['__name__'] for m in found_metrics ]
-                matching_known_metrics = [m for m in found_metrics_names if m in KNOWN_METRICS]
+                known_matches = self.known_metrics.match_all(found_metrics_names)
+                # Histogram families (_bucket/_count/_sum) the catalog doesn't cover get generated throughput, error rate and latency templates
+                state_data['histogram_families'] = await self._detect_histogram_families(found_metrics_names, known_matches)
+                self.generated_metrics = self._generate_family_metrics(state_data['histogram_families'], known_matches)
+                known_matches.update(self.generated_metrics)
+                matching_known_metrics = list(known_matches)
+                # Filter out non 'request' oriented metrics
+                req_metrics = [m for m in found_metrics_names if 'request' in m or 'rq' in m]
+
+                # Report series count and the labels driving it for each candidate so users can favor cheap, stable metrics
+                candidates = sorted(matching_known_metrics or req_metrics)[:CARDINALITY_ANALYSIS_LIMIT]
+                state_data['scrape_intervals'] = await self._discover_rate_windows(candidates)
+                state_data['metric_cardinality'] = await self._analyze_cardinality(candidates)
+                self.metric_cardinality = state_data['metric_cardinality']
 
                 if len(matching_known_metrics) == 1:
                     state_data['desired_deployment_metrics'] = matching_known_metrics
                 elif len(matching_known_metrics) > 1:
                     matching_known_metrics.sort()
                     known_metrics_options = ['Enter Metric __name__(s) manually']
-                    known_metrics_options.extend(['{} - {}'.format(m, KNOWN_METRICS[m][0]) for m in matching_known_metrics])
+                    known_metrics_options.extend(['{} - {}{}'.format(m, ', '.join(k.perf_name for k in known_matches[m]), self._describe_cardinality(m))
+                        for m in matching_known_metrics])
                     result = await self.ui.prompt_check_list(
                         values=known_metrics_options, 
                         title='Select Deployment Metrics for Optimization Measurement', 
-                        header='Metric __name__ - Suggested Perf Name:')
+                        header='Metric __name__ - Suggested Perf Name - Series Count (Labels Driving Cardinality):',
+                        allow_refresh=True)
                     state_data['interacted'] = True
                     if result.back_selected:
                         return True
+                    if result.refresh_selected:
+                        return await self._refresh_deployment_metrics(call_next, state_data)
                     if result.other_selected:
                         state_data['other_selected'] = True
                     else:
@@ -355,18 +534,36 @@ class ImbPrometheus:
                             state_data['add_manual_metrics'] = True
                             result.value = result.value[1:]
                         state_data['desired_deployment_metrics'] = [matching_known_metrics[i] for i in result.value]
+                elif len(req_metrics) > TYPEAHEAD_THRESHOLD:
+                    # Rendering thousands of entries is slow, let the user narrow them down with prometheus doing the filtering
+                    self.found_metrics_names = found_metrics_names
+                    result = await self.ui.prompt_search_check_list(
+                        search=self._search_metric_names,
+                        initial_text='request|rq',
+                        title='Select Deployment Metrics for Optimization Measurement',
+                        header='Metric __name__ - Series Count (Labels Driving Cardinality). Check none to enter manually:')
+                    state_data['interacted'] = True
+                    if result.back_selected:
+                        return True
+                    if result.other_selected:
+                        state_data['other_selected'] = True
+                    else:
+                        if not result.value:
+                            state_data['add_manual_metrics'] = True
+                        state_data['desired_deployment_metrics'] = result.value
                 else:
-                    # Filter out non 'request' oriented metrics
-                    req_metrics = [m for m in found_metrics_names if 'request' in m or 'rq' in m]
                     req_metrics.sort()
                     req_metrics = ['Enter Metric __name__(s) manually'] + req_metrics
                     result = await self.ui.prompt_check_list(
-                        values=req_metrics, 
+                        values=[req_metrics[0]] + ['{}{}'.format(m, self._describe_cardinality(m)) for m in req_metrics[1:]],
                         title='Select Deployment Metrics for Optimization Measurement', 
-                        header='Metric __name__:')
+                        header='Metric __name__ - Series Count (Labels Driving Cardinality):',
+                        allow_refresh=True)
                     state_data['interacted'] = True
                     if result.back_selected:
                         return True
+                    if result.refresh_selected:
+                        return await self._refresh_deployment_metrics(call_next, state_data)
                     if result.other_selected:
                         state_data['other_selected'] = True
                     else:
@@ -375,17 +572,36 @@ class ImbPrometheus:
                             result.value = result.value[1:]
                         state_data['desired_deployment_metrics'] = [ req_metrics[i] for i in result.value ]
         
+            if 'desired_deployment_metrics' in state_data:
+                state_data['query_labels'] = self.query_labels
+                state_data['metric_query_labels'] = { m: self.metric_query_labels[m] for m in state_data['desired_deployment_metrics'] if m in self.metric_query_labels }
+                state_data['metric_rate_windows'] = { m: self.metric_rate_windows[m] for m in state_data['desired_deployment_metrics'] if m in self.metric_rate_windows }
+                state_data['default_rate_window'] = self.default_rate_window
+
         if state_data.get('no_metrics_found'):
             call_next(self.prompt_exit)
         elif state_data.get('other_selected'):
             call_next(self.prompt_other)
         else:
+            self.query_labels = state_data.get('query_labels', self.query_labels)
+            self.metric_query_labels = state_data.get('metric_query_labels', {})
+            self.metric_rate_windows = state_data.get('metric_rate_windows', {})
+            self.default_rate_window = state_data.get('default_rate_window', DEFAULT_RATE_WINDOW)
+            self.metric_cardinality = state_data.get('metric_cardinality', {})
+            self.generated_metrics = self._generate_family_metrics(state_data.get('histogram_families', {}))
             self.desired_deployment_metrics = state_data['desired_deployment_metrics']
             if state_data.get('add_manual_metrics'):
                 call_next(self.enter_deployment_metrics)
             else:
                 call_next(self.configure_deployment_metrics)
 
+    async def _refresh_deployment_metrics(self, call_next, state_data):
+        'rediscover the deployment\'s metrics with fresh prometheus queries'
+        self.prefetcher.memo.invalidate(('deployment_metrics',))
+        self.prefetcher.memo.invalidate(('prometheus_query',))
+        state_data.clear()
+        return await self.select_deployment_metrics(call_next, state_data)
+
     async def enter_deployment_metrics(self, call_next, state_data):
         if not state_data:
             state_data['interacted'] = False
@@ -418,19 +634,28 @@ class ImbPrometheus:
     async def configure_deployment_metrics(self, call_next, state_data):
         if not state_data:
             state_data['interacted'] = False
-            # Format desired metrics into queries for servo config
-            num_metrics = len(self.desired_deployment_metrics)
+            # Format desired metrics into queries for servo config. A single metric may expand into several
+            #   queries when the catalog knows more than one template for it (eg. histogram quantiles)
+            metric_queries = []
+            for m in self.desired_deployment_metrics:
+                known = self.known_metrics.match(m) or self.generated_metrics.get(m)
+                if known:
+                    metric_queries.extend((k.perf_name, k.format_query(self._selector(m, k.filters + k.status_filters), self._selector(m, k.filters), self._rate_window(m)), k.unit, k.kind, m)
+                        for k in known)
+                else:
+                    # Suggest the aggregated query proposed by cardinality analysis when available
+                    metric_queries.append((m, self.metric_cardinality.get(m, {}).get('aggregated_query') or 'sum({})'.format(self._selector(m)), '', None, m))
+
+            num_metrics = len(metric_queries)
             i = 0
             while(i < num_metrics):
-                m = self.desired_deployment_metrics[i]
-                perf_name, query_template, perf_unit = KNOWN_METRICS.get(m, (m, 'sum({})', ''))
-                query_text = query_template.format('{}{{{}}}'.format(m, ','.join(self.query_labels)))
+                perf_name, query_text, perf_unit, kind, source_metric = metric_queries[i]
                 result = await self.ui.prompt_text_input(
                     title='Deployment Metrics Config {}/{}'.format(i+1, num_metrics),
                     prompts=[
                         {'prompt': 'Enter/Edit the name of the metric to be used by servo:', 'initial_text': perf_name},
                         {'prompt': 'Edit Metric Query:', 'initial_text': query_text},
-                        {'prompt': 'Metric Unit:', 'initial_text': perf_unit},
+                        {'prompt': 'Metric Unit:', 'initial_text': perf_unit, 'optional': True},
                     ],
                     allow_other=True
                 )
@@ -452,6 +677,9 @@ class ImbPrometheus:
                 state_data.setdefault('configured_deployment_metrics', {})[perf_name] = { 'query': query_text }
                 if perf_unit:
                     state_data['configured_deployment_metrics'][perf_name]['unit'] = perf_unit
+                if kind:
+                    state_data.setdefault('metric_kinds', {})[perf_name] = kind
+                state_data.setdefault('metric_sources', {})[perf_name] = source_metric
 
                 i += 1
 
@@ -459,6 +687,8 @@ class ImbPrometheus:
             call_next(self.prompt_other)
         else:
             self.configured_deployment_metrics = state_data['configured_deployment_metrics']
+            self.metric_kinds = { n: k for n, k in state_data.get('metric_kinds', {}).items() if n in self.configured_deployment_metrics }
+            self.metric_sources = { n: m for n, m in state_data.get('metric_sources', {}).items() if n in self.configured_deployment_metrics }
             call_next(self.select_perf)
 
     # async def select_service_metrics(self, run_stack):
@@ -513,23 +743,180 @@ class ImbPrometheus:
             state_data['interacted'] = False
             metric_names = list(self.configured_deployment_metrics.keys()) # + list(self.servMetrics.keys())
             if metric_names:
-                result = await self.ui.prompt_radio_list(title='Select Performance Metric', header='Metric Name:', values=metric_names)
+                # Offer composite objectives when both throughput and latency (and error rate) metrics were configured
+                perf_options = [ { 'label': m, 'perf_metric': "metrics['{}']".format(m), 'perf_metric_name': m } for m in metric_names ]
+                throughput = self._metric_of_kind('throughput')
+                latency = self._metric_of_kind('latency')
+                error_rate = self._metric_of_kind('error_rate')
+                if throughput and latency:
+                    perf_options.append({ 'label': '{} constrained by a {} SLO'.format(throughput, latency), 'perf_metric_name': throughput,
+                        'slo': { 'throughput': throughput, 'latency': latency } })
+                if throughput and error_rate:
+                    perf_options.append({ 'label': '{} excluding errors ({})'.format(throughput, error_rate), 'perf_metric_name': throughput,
+                        'perf_metric': "metrics['{}'] * (100 - metrics['{}']) / 100".format(throughput, error_rate) })
+
+                result = await self.ui.prompt_radio_list(title='Select Performance Metric', header='Metric Name / Objective:', values=[ o['label'] for o in perf_options ])
                 state_data['interacted'] = True
                 if result.back_selected:
                     return True
                 if result.other_selected:
                     state_data['other_selected'] = True
                 else:
-                    state_data['perf_metric'] = "metrics['{}']".format(metric_names[result.value])
+                    state_data['perf_metric_name'] = perf_options[result.value]['perf_metric_name']
+                    if 'slo' in perf_options[result.value]:
+                        state_data['perf_slo'] = perf_options[result.value]['slo']
+                    else:
+                        state_data['perf_metric'] = perf_options[result.value]['perf_metric']
             else:
                 self.ocoOverride['optimization'].pop('perf', None)
 
         if state_data.get('other_selected'):
             call_next(self.prompt_other)
         else:
+            self.perf_metric_name = state_data.get('perf_metric_name')
+            if state_data.get('perf_slo'):
+                self.perf_slo = state_data['perf_slo']
+                call_next(self.select_slo)
+                return
             if state_data.get('perf_metric'):
                 self.ocoOverride['optimization']['perf'] = state_data['perf_metric']
-            call_next(self.finish_discovery)
+            call_next(self.capture_baseline)
+
+    async def select_slo(self, call_next, state_data):
+        throughput, latency = self.perf_slo['throughput'], self.perf_slo['latency']
+        if not state_data:
+            state_data['interacted'] = False
+            # Suggest an SLO with some headroom over the current latency
+            initial_text = ''
+            current = await self._gather_queries([ self.configured_deployment_metrics[latency]['query'] ])
+            if current[0]:
+                current_values = imb_stats.finite([ float(r['value'][1]) for r in current[0] ])
+                if current_values:
+                    initial_text = '{:g}'.format(round(max(current_values) * SLO_HEADROOM, 3))
+
+            while 'slo' not in state_data and not state_data.get('other_selected'):
+                result = await self.ui.prompt_text_input(
+                    title='Latency SLO',
+                    prompts=[
+                        {'prompt': 'Enter the maximum acceptable {}{}. Configurations exceeding it score 0'.format(
+                            latency, ' ({})'.format(self.configured_deployment_metrics[latency]['unit']) if self.configured_deployment_metrics[latency].get('unit') else ''),
+                         'initial_text': initial_text}
+                    ],
+                    allow_other=True
+                )
+                state_data['interacted'] = True
+                if result.back_selected:
+                    return True
+                if result.other_selected:
+                    state_data['other_selected'] = True
+                    break
+                try:
+                    slo = float(result.value)
+                except ValueError:
+                    slo = None
+                if slo is not None and math.isfinite(slo) and slo > 0:
+                    state_data['slo'] = slo
+                else:
+                    # Ask again, keeping the entered text for editing
+                    initial_text = result.value
+                    await self.ui.prompt_ok(title='Invalid Latency SLO', prompt='"{}" is not a positive number, please enter the SLO again'.format(result.value))
+
+        if state_data.get('other_selected'):
+            call_next(self.prompt_other)
+        else:
+            self.ocoOverride['optimization']['perf'] = "metrics['{}'] if metrics['{}'] <= {:g} else 0".format(throughput, latency, state_data['slo'])
+            call_next(self.capture_baseline)
+
+    def _metric_of_kind(self, kind):
+        'name of the configured metric of the given kind, preferring the highest latency quantile'
+        names = sorted(n for n, k in self.metric_kinds.items() if k == kind)
+        if kind == 'latency':
+            names.sort(key=lambda n: ('p99' not in n, 'p90' not in n))
+        return names[0] if names else None
+
+    async def capture_baseline(self, call_next, state_data):
+        if not state_data:
+            state_data['interacted'] = False
+            lookback = BASELINE_LOOKBACK
+            if self.k8sImb.current_settings_since:
+                lookback = max(BASELINE_STEP, min(lookback, int(time.time() - self.k8sImb.current_settings_since)))
+
+            # Evaluate the perf metric along with the resource usage that drives cost under the current settings
+            baseline_metrics = {}
+            if self.perf_metric_name in self.configured_deployment_metrics:
+                summary = await self._summarize_range(self.configured_deployment_metrics[self.perf_metric_name]['query'], lookback, BASELINE_STEP)
+                if summary:
+                    baseline_metrics[self.perf_metric_name] = summary
+
+            # cAdvisor series carry a container label, use the first label naming scheme that returns data
+            for label_set in [ ls for ls in self._pod_label_sets() if any(l.startswith('container') for l in ls) ]:
+                # cAdvisor is scraped by the kubelet job, whose interval can differ from the app metrics' the default window is sized from
+                window = await self._scrape_rate_window('container_cpu_usage_seconds_total{{{}}}'.format(','.join(label_set))) \
+                    or _format_prom_duration(max(_parse_prom_duration(self.default_rate_window), _parse_prom_duration(DEFAULT_RATE_WINDOW)))
+                for name, query_template in BASELINE_RESOURCE_QUERIES.items():
+                    summary = await self._summarize_range(query_template.format(selector=','.join(label_set), window=window), lookback, BASELINE_STEP)
+                    if summary:
+                        baseline_metrics[name] = summary
+                if any(name in baseline_metrics for name in BASELINE_RESOURCE_QUERIES):
+                    break
+
+            if baseline_metrics:
+                state_data['baseline'] = {
+                    'window': _format_prom_duration(lookback),
+                    'settings': self.k8sImb.container_current_settings,
+                    'metrics': baseline_metrics
+                }
+
+        if state_data.get('baseline'):
+            self.ocoOverride['optimization']['baseline'] = state_data['baseline']
+        else:
+            self.ocoOverride['optimization'].pop('baseline', None)
+        call_next(self.recommend_duration)
+
+    async def recommend_duration(self, call_next, state_data):
+        if not state_data:
+            state_data['interacted'] = False
+            if self.perf_metric_name in self.configured_deployment_metrics:
+                # Sample at the scrape interval, finer steps only repeat the same rate() values
+                step = max(5, _parse_prom_duration(self.default_rate_window) // RATE_WINDOW_SCRAPE_MULTIPLE)
+                rate_window = _parse_prom_duration(self.default_rate_window)
+                try:
+                    series = await self._query_range(self.configured_deployment_metrics[self.perf_metric_name]['query'], DURATION_ANALYSIS_LOOKBACK, step)
+                except (requests.exceptions.RequestException, KeyError, ValueError):
+                    series = []
+
+                if series:
+                    duration, analysis = imb_stats.recommend_window(
+                        list(max(series, key=len).values), step, [ d for d in DURATION_CANDIDATES if d >= rate_window ] or [rate_window], DURATION_MAX_CV)
+                    if duration:
+                        state_data['recommended_duration'] = duration
+                        state_data['duration_analysis'] = { _format_prom_duration(d): a for d, a in analysis.items() }
+
+        # Recomputed on every pass so a recommendation made before going Back doesn't linger
+        self.recommended_duration = state_data.get('recommended_duration')
+        self.ocoOverride['measurement']['control']['past'] = self.recommended_duration or DEFAULT_MEASUREMENT_PAST
+        call_next(self.analyze_production_rate)
+
+    async def analyze_production_rate(self, call_next, state_data):
+        if not state_data:
+            state_data['interacted'] = False
+            throughput = self._metric_of_kind('throughput')
+            if throughput:
+                # Throughput templates are per second rate()s
+                summary = await self._summarize_range(self.configured_deployment_metrics[throughput]['query'], PRODUCTION_RATE_LOOKBACK, PRODUCTION_RATE_STEP)
+                if summary:
+                    state_data['production_rate'] = {
+                        'metric': throughput,
+                        'lookback': _format_prom_duration(PRODUCTION_RATE_LOOKBACK),
+                        'peak': summary['max'],
+                        'p95': summary['p95'],
+                        'mean': summary['mean']
+                    }
+                state_data['traffic_mix'] = await self._analyze_traffic_mix(self.metric_sources.get(throughput))
+
+        self.production_rate = state_data.get('production_rate')
+        self.traffic_mix = state_data.get('traffic_mix') or []
+        call_next(self.finish_discovery)
 
     async def finish_discovery(self, call_next, state_data):
         state_data['interacted'] = False
@@ -542,3 +929,350 @@ class ImbPrometheus:
             self.port_forward_proc.kill()
 
         call_next(self.finished_method)
+
+    def _selector(self, metric_name, filters=()):
+        query_labels = self.metric_query_labels.get(metric_name, self.query_labels)
+        return '{}{{{}}}'.format(metric_name, ','.join(list(query_labels) + list(filters)))
+
+    def _prefetch_deployment_metrics(self, prometheus_endpoint):
+        if not self.k8sImb.depLabels:
+            return
+        query_url = '{}/api/v1/query'.format(prometheus_endpoint)
+        query_text = 'sum by(__name__)({{ {} }})'.format(','.join('{}="{}"'.format(k, v) for k, v in self.k8sImb.depLabels.items()))
+
+        async def fetch():
+            # Skip endpoints the background check found unreachable rather than retrying them
+            if self.scheduler:
+                checked = await self.scheduler.get('prometheus_reachable')
+                if not checked or checked['url'] != prometheus_endpoint or not checked['reachable']:
+                    raise Exception('Prometheus endpoint {} is not reachable'.format(prometheus_endpoint))
+            return await asyncio.get_event_loop().run_in_executor(None, _query_metric_names, query_url, query_text)
+        self.prefetcher.prefetch(('deployment_metrics', query_url, query_text), fetch)
+
+    def _init_endpoints(self, api_url):
+        # The endpoint for recent data (in-cluster or port forwarded) comes first and is preferred when results overlap
+        self.api_url = api_url
+        self.query_url = '{}/query'.format(self.api_url)
+        self.endpoints = [ { 'role': 'recent', 'api_url': api_url } ] + [
+            { 'role': 'long_term', 'api_url': '{}/api/v1'.format(e) } for e in self.long_term_endpoints ]
+        self.range_queries = { e['api_url']: PrometheusRangeQuery(e['api_url']) for e in self.endpoints }
+        self.recent_retention = None
+
+    async def _query_range(self, query_text, lookback, step):
+        'evaluate query_text over the last lookback seconds, routed to a long-term endpoint if it exceeds the recent endpoint\'s retention'
+        api_url = self.api_url
+        long_term = [ e['api_url'] for e in self.endpoints if e['role'] == 'long_term' ]
+        if long_term:
+            if self.recent_retention is None:
+                self.recent_retention = await asyncio.get_event_loop().run_in_executor(None, self._get_retention)
+            if lookback > self.recent_retention:
+                api_url = long_term[0]
+
+        end = time.time()
+        return await self.range_queries[api_url].query(query_text, end - lookback, end, step)
+
+    def _get_retention(self):
+        'retention (seconds) of the recent endpoint from its command line flags'
+        try:
+            flags_resp = requests.get(url='{}/status/flags'.format(self.api_url), timeout=(0.25, 10))
+            flags_resp.raise_for_status()
+            flags = flags_resp.json()['data']
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            return DEFAULT_RECENT_RETENTION
+        retention = flags.get('storage.tsdb.retention.time') or flags.get('storage.tsdb.retention')
+        if not retention or retention == '0s': # retention.time defaults to 0s when the deprecated retention flag is in use
+            retention = flags.get('storage.tsdb.retention') or '15d'
+        try:
+            return _parse_prom_duration(retention)
+        except ValueError:
+            return DEFAULT_RECENT_RETENTION
+
+    async def _summarize_range(self, query_text, lookback, step):
+        'summary statistics of all values returned by query_text, or None when it fails or returns no data'
+        try:
+            series = await self._query_range(query_text, lookback, step)
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            return None
+        return imb_stats.summarize([ v for s in series for v in s.values ])
+
+    async def _search_metric_names(self, text):
+        'typeahead lookup of the deployment\'s metric names matching the regex text, returns (name, label) tuples for the picker'
+        if text not in self.metric_name_lookups:
+            loop = asyncio.get_event_loop()
+            endpoint_names = await asyncio.gather(*[ loop.run_in_executor(None, self._lookup_metric_names, text, e['api_url']) for e in self.endpoints ],
+                return_exceptions=True)
+            self.metric_name_lookups[text] = sorted(set().union(*[ names for names in endpoint_names if not isinstance(names, Exception) ]))
+        return [ (m, '{}{}'.format(m, self._describe_cardinality(m))) for m in self.metric_name_lookups[text] ]
+
+    def _lookup_metric_names(self, text, api_url):
+        try:
+            pattern = re.compile(text, flags=re.IGNORECASE)
+        except re.error:
+            return []
+        name_matcher = '__name__=~"(?i).*(?:{}).*"'.format(text.replace('\\', '\\\\').replace('"', '\\"')) if text else '__name__=~".+"'
+        label_sets = set(tuple(ls) for ls in self.metric_query_labels.values()) or { tuple(self.query_labels) }
+        try:
+            values_resp = requests.get(url='{}/label/__name__/values'.format(api_url), timeout=(0.25, 10),
+                params={ 'match[]': [ '{{{}}}'.format(','.join((name_matcher,) + ls)) for ls in label_sets ] })
+            values_resp.raise_for_status()
+            names = values_resp.json()['data']
+        except requests.exceptions.HTTPError:
+            names = self.found_metrics_names
+        # prometheus < 2.24 ignores match[] on label values and returns every metric name, so results are always limited to the
+        # deployment's metrics and filtered here too
+        found_names = set(self.found_metrics_names)
+        return sorted(m for m in names if m in found_names and pattern.search(m))
+
+    async def _analyze_traffic_mix(self, metric_name):
+        'share of requests by path and method over TRAFFIC_MIX_WINDOW, heaviest first. Empty when the metric has no path label'
+        if not metric_name:
+            return []
+        # Grouping by labels a series doesn't have is harmless, so one query covers every naming convention
+        result = (await self._gather_queries([ 'sum by({})(increase({}[{}]))'.format(
+            ','.join(PATH_LABELS + METHOD_LABELS), self._selector(metric_name), TRAFFIC_MIX_WINDOW) ]))[0] or []
+
+        requests_by_path = {}
+        for r in result:
+            path = next((r['metric'][l] for l in PATH_LABELS if r['metric'].get(l)), None)
+            if not path:
+                continue
+            method = next((r['metric'][l].upper() for l in METHOD_LABELS if r['metric'].get(l)), 'GET')
+            count = float(r['value'][1])
+            if not math.isnan(count):
+                requests_by_path[(path, method)] = requests_by_path.get((path, method), 0.0) + count
+
+        total = sum(requests_by_path.values())
+        if not total:
+            return []
+        heaviest = sorted(requests_by_path.items(), key=lambda item: -item[1])[:TRAFFIC_MIX_MAX_PATHS]
+        return [ { 'path': path, 'method': method, 'share': count / total } for (path, method), count in heaviest if count > 0 ]
+
+    async def _detect_histogram_families(self, metric_names, known_matches):
+        'histogram families with _bucket, _count and _sum series not fully covered by the catalog, mapped to their status label (if any)'
+        names = set(metric_names)
+        families = sorted(n[:-len('_bucket')] for n in names if n.endswith('_bucket')
+            and n[:-len('_bucket')] + '_count' in names and n[:-len('_bucket')] + '_sum' in names
+            and not (n in known_matches and n[:-len('_bucket')] + '_count' in known_matches))
+
+        # A sample series of each family's _count shows whether there is a label for building an error rate query
+        samples = await self._gather_queries([ 'topk(1, {})'.format(self._selector(f + '_count')) for f in families ])
+        histogram_families = {}
+        for family, sample in zip(families, samples):
+            labels = sample[0]['metric'] if sample else {}
+            histogram_families[family] = { 'status_label': next((l for l in STATUS_LABELS if l in labels), None) }
+        return histogram_families
+
+    def _generate_family_metrics(self, histogram_families, known_matches=None):
+        generated = {}
+        for family, info in histogram_families.items():
+            for m, known in histogram_family_metrics(family, info.get('status_label')).items():
+                if not (known_matches or {}).get(m) and not self.known_metrics.match(m):
+                    generated[m] = known
+                    # generated names share the label matchers of the family's bucket series
+                    if m not in self.metric_query_labels and family + '_bucket' in self.metric_query_labels:
+                        self.metric_query_labels[m] = self.metric_query_labels[family + '_bucket']
+        return generated
+
+    def _rate_window(self, metric_name):
+        return self.metric_rate_windows.get(metric_name, self.default_rate_window)
+
+    async def _discover_rate_windows(self, metric_names):
+        'size rate windows from the scrape interval of the job(s) exporting each metric, returns the discovered intervals by job'
+        job_results = await self._gather_queries([ 'count by(job)({})'.format(self._selector(m)) for m in metric_names ])
+        metric_jobs = { m: set(r['metric'].get('job') for r in result) - {None} for m, result in zip(metric_names, job_results) if result }
+        jobs = set().union(*metric_jobs.values()) if metric_jobs else set()
+        if not jobs:
+            return {}
+
+        try:
+            intervals = await asyncio.get_event_loop().run_in_executor(None, self._get_scrape_intervals, jobs)
+        except (requests.exceptions.RequestException, KeyError, ValueError, TypeError, AttributeError):
+            return {} # Keep the default window when prometheus doesn't expose its targets or config
+
+        for m, m_jobs in metric_jobs.items():
+            m_intervals = [ intervals[j] for j in m_jobs if j in intervals ]
+            if m_intervals:
+                self.metric_rate_windows[m] = _format_prom_duration(RATE_WINDOW_SCRAPE_MULTIPLE * max(m_intervals))
+        if intervals:
+            self.default_rate_window = _format_prom_duration(RATE_WINDOW_SCRAPE_MULTIPLE * max(intervals.values()))
+        return intervals
+
+    async def _scrape_rate_window(self, selector):
+        'rate window sized from the scrape interval of the job(s) exporting the series of selector, None when it can\'t be determined'
+        result = (await self._gather_queries([ 'count by(job)({})'.format(selector) ]))[0]
+        jobs = set(r['metric'].get('job') for r in result or []) - {None}
+        if not jobs:
+            return None
+        try:
+            intervals = await asyncio.get_event_loop().run_in_executor(None, self._get_scrape_intervals, jobs)
+        except (requests.exceptions.RequestException, KeyError, ValueError, TypeError, AttributeError):
+            return None
+        return _format_prom_duration(RATE_WINDOW_SCRAPE_MULTIPLE * max(intervals.values())) if intervals else None
+
+    def _get_scrape_intervals(self, jobs):
+        'maps job label values to scrape interval seconds using the targets API, falling back to the loaded config for older prometheus'
+        targets_resp = requests.get(url='{}/targets'.format(self.api_url), params={ 'state': 'active' }, timeout=(0.25, 10))
+        targets_resp.raise_for_status()
+
+        intervals, job_pools = {}, {}
+        for target in targets_resp.json()['data']['activeTargets']:
+            job = target['labels'].get('job')
+            if job not in jobs:
+                continue
+            if target.get('scrapeInterval'): # Only reported by prometheus >= 2.34
+                intervals[job] = max(intervals.get(job, 0), _parse_prom_duration(target['scrapeInterval']))
+            else:
+                job_pools.setdefault(job, set()).add(target.get('scrapePool', job))
+
+        if job_pools:
+            config_resp = requests.get(url='{}/status/config'.format(self.api_url), timeout=(0.25, 10))
+            config_resp.raise_for_status()
+            config = imb_yaml.safe_load(config_resp.json()['data']['yaml'])
+            default_interval = _parse_prom_duration(config.get('global', {}).get('scrape_interval', DEFAULT_RATE_WINDOW))
+            pool_intervals = { sc['job_name']: _parse_prom_duration(sc['scrape_interval']) if sc.get('scrape_interval') else default_interval
+                for sc in config.get('scrape_configs', []) }
+            for job, pools in job_pools.items():
+                intervals[job] = max(pool_intervals.get(p, default_interval) for p in pools)
+
+        return intervals
+
+    def _pod_label_sets(self):
+        'label matchers identifying the deployment\'s series by pod name, ordered most to least specific'
+        if not self.k8sImb.pod_name_regex:
+            return []
+
+        label_sets = []
+        for ns_label, pod_label, container_label in POD_LABEL_NAMES:
+            label_set = [ '{}="{}"'.format(ns_label, self.k8sImb.namespace), '{}=~"{}"'.format(pod_label, self.k8sImb.pod_name_regex) ]
+            if container_label and self.k8sImb.container_name:
+                label_sets.append(label_set + [ '{}="{}"'.format(container_label, self.k8sImb.container_name) ])
+            label_sets.append(label_set)
+        return label_sets
+
+    def _query(self, query_text, api_url=None):
+        query_resp = requests.get(url='{}/query'.format(api_url or self.api_url), params={ 'query': query_text }, timeout=(0.25, 10))
+        query_resp.raise_for_status()
+        return query_resp.json()['data']['result']
+
+    async def _gather_queries(self, queries, federated=False):
+        '''run instant queries concurrently in worker threads. Results are returned in query order, failed queries yield None.
+        When federated, each query is run against every endpoint and the results merged, preferring series from earlier endpoints.
+        Results are memoized for the session so re-running a step after Back doesn't repeat its queries'''
+        semaphore = asyncio.Semaphore(QUERY_CONCURRENCY)
+        api_urls = [ e['api_url'] for e in self.endpoints ] if federated else [ self.api_url ]
+
+        async def run_query(query_text, api_url):
+            async with semaphore:
+                try:
+                    return await self.prefetcher.memo.get(('prometheus_query', api_url, query_text), partial(self._query, query_text, api_url))
+                except (requests.exceptions.RequestException, KeyError, ValueError):
+                    return None
+
+        results = await asyncio.gather(*[ run_query(q, u) for q in queries for u in api_urls ])
+        merged = []
+        for i in range(len(queries)):
+            endpoint_results = [ r for r in results[i * len(api_urls):(i + 1) * len(api_urls)] if r is not None ]
+            merged.append(_merge_results(endpoint_results) if endpoint_results else None)
+        return merged
+
+    async def _analyze_cardinality(self, metric_names):
+        # First pass: total series count and a sample series whose label names are broken down in the second pass
+        selectors = [ self._selector(m) for m in metric_names ]
+        results = await self._gather_queries(
+            [ 'count({})'.format(s) for s in selectors ] + [ 'topk(1, {})'.format(s) for s in selectors ])
+        counts, samples = results[:len(selectors)], results[len(selectors):]
+
+        label_queries = []
+        for m, s, sample in zip(metric_names, selectors, samples):
+            label_names = sorted(l for l in sample[0]['metric'] if l != '__name__') if sample else []
+            label_queries.extend((m, l, 'count(count by({})({}))'.format(l, s)) for l in label_names)
+        label_counts = await self._gather_queries([ q for _, _, q in label_queries ])
+
+        cardinality = { m: { 'series': int(float(c[0]['value'][1])) if c else 0, 'labels': {} } for m, c in zip(metric_names, counts) }
+        for (m, l, _), c in zip(label_queries, label_counts):
+            if c:
+                cardinality[m]['labels'][l] = int(float(c[0]['value'][1]))
+
+        for m, s in zip(metric_names, selectors):
+            labels = cardinality[m]['labels']
+            high_cardinality = sorted(
+                (l for l, n in labels.items() if n > 1 and (l in HIGH_CARDINALITY_LABELS or n > HIGH_CARDINALITY_THRESHOLD)),
+                key=lambda l: -labels[l])
+            cardinality[m]['high_cardinality_labels'] = high_cardinality
+            if high_cardinality:
+                inner = 'rate({}[{}])'.format(s, self._rate_window(m)) if _is_counter(m) else s
+                cardinality[m]['aggregated_query'] = 'sum without({}) ({})'.format(','.join(high_cardinality), inner)
+
+        return cardinality
+
+    def _describe_cardinality(self, metric_name):
+        info = self.metric_cardinality.get(metric_name)
+        if not info:
+            return ''
+        driving = sorted(((l, n) for l, n in info['labels'].items() if n > 1), key=lambda ln: -ln[1])
+        if not driving:
+            return ' - {} series'.format(info['series'])
+        return ' - {} series ({})'.format(info['series'], ', '.join('{}: {}'.format(l, n) for l, n in driving[:3]))
+
+def service_url(service):
+    return 'http://{}.{}.svc:{}'.format(service.metadata.name, service.metadata.namespace, service.spec.ports[0].port)
+
+def endpoint_reachable(url):
+    try:
+        requests.get(url, timeout=(0.25, 10))
+    except requests.exceptions.ConnectionError:
+        return False
+    return True
+
+def check_prometheus_service(prometheus_service):
+    'whether the in-cluster url of the discovered prometheus service is reachable from here, None when there is no service'
+    if prometheus_service is None:
+        return None
+    url = service_url(prometheus_service)
+    return { 'url': url, 'reachable': endpoint_reachable(url) }
+
+def _query_metric_names(query_url, query_text, connect_attempts=10):
+    'result of a sum by(__name__) query, retried while a port forward to prometheus comes up'
+    while True:
+        try:
+            query_resp = requests.get(url=query_url, params={ 'query': query_text }, timeout=(0.25, 10))
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
+            connect_attempts -= 1
+            if connect_attempts <= 0:
+                # Reported by on_error and recorded in discovery.yaml
+                raise Exception('Unable to reach prometheus at {}: {}: {}'.format(query_url, type(e).__name__, e)) from e
+            if isinstance(e, requests.exceptions.ConnectionError):
+                time.sleep(0.25)
+
+    return query_resp.json()['data']['result']
+
+def _merge_results(endpoint_results):
+    'dedupe instant vectors from several endpoints by label set, keeping the first occurrence'
+    merged, seen = [], set()
+    for result in endpoint_results:
+        for r in result:
+            key = tuple(sorted(r['metric'].items()))
+            if key not in seen:
+                seen.add(key)
+                merged.append(r)
+    return merged
+
+def _is_counter(metric_name):
+    return metric_name.endswith(('_total', '_count', '_sum', '_bucket'))
+
+PROM_DURATION_UNITS = [('y', 365*24*60*60), ('w', 7*24*60*60), ('d', 24*60*60), ('h', 60*60), ('m', 60), ('s', 1), ('ms', 0.001)]
+def _parse_prom_duration(duration):
+    'seconds in a prometheus duration string such as 30s, 1m30s or 500ms'
+    units = dict(PROM_DURATION_UNITS)
+    matches = re.findall(r'(\d+)(ms|[smhdwy])', duration)
+    if not matches:
+        raise ValueError('Invalid prometheus duration: {}'.format(duration))
+    return sum(int(val) * units[unit] for val, unit in matches)
+
+def _format_prom_duration(seconds):
+    seconds = int(math.ceil(seconds))
+    for unit, unit_seconds in PROM_DURATION_UNITS[:-1]:
+        if seconds >= unit_seconds and seconds % unit_seconds == 0:
+            return '{}{}'.format(seconds // unit_seconds, unit)
+    return '{}s'.format(seconds)
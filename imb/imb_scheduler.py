@@ -0,0 +1,113 @@
+import asyncio
+from functools import partial
+
+class DiscoveryScheduler:
+    '''Runs non-interactive discovery work in the background as soon as its inputs are known.
+
+    Tasks are registered with the name of the value they produce and the names of the values they need. Interactive
+    run_stack methods provide values (eg. the selected namespace) as the user makes selections and await the products
+    they consume with get(). Providing a value again, eg. after the user went back and picked another deployment,
+    cancels and restarts every task depending on it so stale results are never returned. A failed task's error is raised
+    by get() and the task is restarted, so retrying the consuming method (eg. Back from its error prompt) fetches again.
+    Plain functions are run in the default executor so blocking kubernetes/prometheus clients don't stall the UI'''
+    def __init__(self):
+        self.tasks = {} # product name -> (needs, fn)
+        self.values = {} # provided and produced values
+        self.futures = {} # value name -> future resolved with the value
+        self.running = {} # product name -> asyncio task computing it
+        self.failed = set() # products whose task raised, restarted once get() has surfaced the error
+
+    def task(self, produces, needs, fn):
+        'register fn(**needs) as the producer of produces'
+        self.tasks[produces] = (tuple(needs), fn)
+        self._start_ready()
+
+    def provide(self, name, value):
+        self._invalidate(name)
+        self._set(name, value)
+        self._start_ready()
+
+    def retract(self, name):
+        'forget a provided value (eg. a selection the user backed over) and everything computed from it'
+        self._invalidate(name)
+        self.values.pop(name, None)
+        future = self.futures.pop(name, None)
+        if future and not future.done():
+            future.cancel()
+
+    async def get(self, name):
+        'value of name, waiting for it to be provided or produced'
+        while True:
+            future = self._future(name)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The value was invalidated while waiting for it, wait for its replacement unless we were cancelled ourselves
+                if future.cancelled() and self._future(name) is not future:
+                    continue
+                raise
+            except Exception:
+                self._retry_failed(name, future)
+                raise
+
+    def cancel_all(self):
+        for task in self.running.values():
+            task.cancel()
+        self.running = {}
+
+    def _future(self, name):
+        if name not in self.futures:
+            self.futures[name] = asyncio.get_event_loop().create_future()
+        return self.futures[name]
+
+    def _set(self, name, value):
+        self.values[name] = value
+        future = self._future(name)
+        if future.done():
+            future = self.futures[name] = asyncio.get_event_loop().create_future()
+        future.set_result(value)
+
+    def _retry_failed(self, name, future):
+        'restart a failed product whose error was surfaced, unless it was already restarted or invalidated'
+        if name in self.failed and self.futures.get(name) is future:
+            self.failed.discard(name)
+            del self.futures[name]
+            self._start_ready()
+
+    def _invalidate(self, name):
+        'drop everything computed from name, cancelling tasks still running'
+        for produces, (needs, _) in self.tasks.items():
+            if name in needs and (produces in self.values or produces in self.running or produces in self.failed):
+                self.failed.discard(produces)
+                self._invalidate(produces)
+                task = self.running.pop(produces, None)
+                if task:
+                    task.cancel()
+                self.values.pop(produces, None)
+                future = self.futures.pop(produces, None)
+                if future and not future.done():
+                    future.cancel()
+
+    def _start_ready(self):
+        for produces, (needs, fn) in self.tasks.items():
+            if produces not in self.values and produces not in self.running and produces not in self.failed \
+                    and all(n in self.values for n in needs):
+                self.running[produces] = asyncio.ensure_future(self._run(produces, fn, { n: self.values[n] for n in needs }))
+
+    async def _run(self, produces, fn, kwargs):
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                value = await fn(**kwargs)
+            else:
+                value = await asyncio.get_event_loop().run_in_executor(None, partial(fn, **kwargs))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Surface the error to whoever consumes the product, their run_stack method's error handling applies
+            self.running.pop(produces, None)
+            self.failed.add(produces)
+            self._future(produces).set_exception(e)
+            return
+        self.running.pop(produces, None)
+        self._set(produces, value)
+        self._start_ready()
@@ -0,0 +1,89 @@
+import math
+
+# Small statistics helpers for summarizing prometheus range query results without pulling in numpy
+
+def finite(values):
+    return [ v for v in values if not math.isnan(v) and not math.isinf(v) ]
+
+def mean(values):
+    return sum(values) / len(values)
+
+def variance(values):
+    'population variance'
+    m = mean(values)
+    return sum((v - m) ** 2 for v in values) / len(values)
+
+def percentile(values, q):
+    'q in [0, 100], linearly interpolated between closest ranks'
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100.0
+    low, high = int(math.floor(rank)), int(math.ceil(rank))
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(values):
+    'mean, p50, p95, max and variance of the finite values, or None when there are none'
+    values = finite(values)
+    if not values:
+        return None
+    return {
+        'mean': mean(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': max(values),
+        'variance': variance(values),
+        'samples': len(values)
+    }
+
+def coefficient_of_variation(values):
+    'standard deviation relative to the mean, None when the mean is 0'
+    m = mean(values)
+    if m == 0:
+        return None
+    return math.sqrt(variance(values)) / abs(m)
+
+def autocorrelation(values, lag=1):
+    'sample autocorrelation at the given lag, 0 for constant or too short series'
+    if len(values) <= lag:
+        return 0.0
+    m = mean(values)
+    denominator = sum((v - m) ** 2 for v in values)
+    if denominator == 0:
+        return 0.0
+    return sum((values[i] - m) * (values[i + lag] - m) for i in range(len(values) - lag)) / denominator
+
+def window_stability(values, step, window, min_blocks=4):
+    '''Estimate the coefficient of variation of the mean of a measurement lasting window seconds from values sampled every step seconds.
+    The empirical CV of non-overlapping window means is used when there are at least min_blocks of them. It is compared against
+    the point CV scaled by the effective sample size of an AR(1) process with the series' lag 1 autocorrelation, and the larger
+    (more conservative) of the two is returned along with its inputs'''
+    points = max(1, int(window // step))
+    r = min(max(autocorrelation(values), 0.0), 0.99)
+    point_cv = coefficient_of_variation(values)
+    if point_cv is None:
+        return None
+    estimated_cv = point_cv * math.sqrt((1 + r) / (1 - r) / points)
+
+    block_means = [ mean(values[i:i + points]) for i in range(0, len(values) - points + 1, points) ]
+    empirical_cv = coefficient_of_variation(block_means) if len(block_means) >= min_blocks else None
+    return {
+        'cv': max(estimated_cv, empirical_cv or 0.0),
+        'estimated_cv': estimated_cv,
+        'empirical_cv': empirical_cv,
+        'autocorrelation': r,
+        'windows': len(block_means)
+    }
+
+def recommend_window(values, step, candidate_windows, max_cv):
+    'shortest candidate window (seconds) whose mean is stable to within max_cv, or the longest candidate. Returns (window, analysis)'
+    values = finite(values)
+    analysis = {}
+    if len(values) < 2:
+        return None, analysis
+    for window in sorted(candidate_windows):
+        stability = window_stability(values, step, window)
+        if stability is None:
+            return None, analysis
+        analysis[window] = stability
+        if stability['cv'] <= max_cv:
+            return window, analysis
+    return max(candidate_windows), analysis
@@ -0,0 +1,137 @@
+import asyncio
+from functools import wraps
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+OCO_HOSTS = ('api.optune.ai', 'api.opsani.com')
+
+class Telemetry:
+    '''Per run_stack method spans recording wall time, time the user spent on prompts and the count, time and response bytes
+    of kubernetes, prometheus and OCO calls made while the method ran. Calls made by background work (scheduler, prefetcher)
+    count towards the method running at the time and may overlap, so call time can exceed wall time'''
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path # Chrome trace event file written by write_trace, eg. for chrome://tracing or Perfetto
+        self.started = time.monotonic()
+        self.spans = []
+        self.current = None
+        self.events = [] # individual calls, only kept when a trace is written
+        self.lock = threading.Lock() # calls are recorded from executor threads
+
+    def start_span(self, name):
+        self.instrument_loaded_clients()
+        self.current = { 'name': name, 'start': round(time.monotonic() - self.started, 3), 'wall': None, 'user_wait': 0.0,
+            'calls': {} }
+        return self.current
+
+    def end_span(self, outcome):
+        span, self.current = self.current, None
+        span['wall'] = round(time.monotonic() - self.started - span['start'], 3)
+        span['user_wait'] = round(span['user_wait'], 3)
+        span['outcome'] = outcome # forward, back, error or cancelled
+        self.spans.append(span)
+
+    def record_call(self, kind, started, seconds, size):
+        with self.lock:
+            if self.current is not None:
+                calls = self.current['calls'].setdefault(kind, { 'count': 0, 'seconds': 0.0, 'bytes': 0 })
+                calls['count'] += 1
+                calls['seconds'] = round(calls['seconds'] + seconds, 3)
+                calls['bytes'] += size
+            if self.trace_path:
+                self.events.append({ 'name': kind, 'cat': 'call', 'ph': 'X', 'pid': 1, 'tid': threading.get_ident(),
+                    'ts': int((started - self.started) * 1e6), 'dur': int(seconds * 1e6), 'args': { 'bytes': size } })
+
+    def summary(self):
+        'spans and per kind totals, embedded in discovery.yaml'
+        totals = { 'wall': round(time.monotonic() - self.started, 3), 'user_wait': round(sum(s['user_wait'] for s in self.spans), 3), 'calls': {} }
+        for span in self.spans:
+            for kind, calls in span['calls'].items():
+                total = totals['calls'].setdefault(kind, { 'count': 0, 'seconds': 0.0, 'bytes': 0 })
+                total['count'] += calls['count']
+                total['seconds'] = round(total['seconds'] + calls['seconds'], 3)
+                total['bytes'] += calls['bytes']
+        return { 'totals': totals, 'spans': self.spans }
+
+    def write_trace(self):
+        if not self.trace_path:
+            return
+        events = [ { 'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': { 'name': 'IMB' } } ]
+        for span in self.spans:
+            events.append({ 'name': span['name'], 'cat': 'step', 'ph': 'X', 'pid': 1, 'tid': 0, 'ts': int(span['start'] * 1e6),
+                'dur': int(span['wall'] * 1e6), 'args': { k: span[k] for k in ('user_wait', 'calls', 'outcome') } })
+        with self.lock:
+            events.extend(self.events)
+        with open(self.trace_path, 'w') as out_file:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, out_file)
+
+    def instrument_ui(self, ui):
+        'count time spent in the ui\'s prompts towards the current span\'s user_wait'
+        for name in dir(ui):
+            method = getattr(ui, name)
+            if name.startswith('prompt_') or name.startswith('long_prompt_'):
+                if asyncio.iscoroutinefunction(method):
+                    setattr(ui, name, self._timed_prompt(method))
+
+    def instrument_clients(self):
+        'record the kubernetes and requests (prometheus, OCO) calls made by this process'
+        global _active
+        _active = self
+        self.instrument_loaded_clients()
+
+    @staticmethod
+    def instrument_loaded_clients():
+        'wrap the clients imported so far, they are imported by the steps needing them rather than upfront'
+        for module, patch in (('requests', _patch_requests), ('kubernetes.client.rest', _patch_kubernetes)):
+            if module in sys.modules and module not in _patched:
+                _patched.add(module)
+                patch(sys.modules[module])
+
+    def _timed_prompt(self, prompt):
+        @wraps(prompt)
+        async def timed(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await prompt(*args, **kwargs)
+            finally:
+                if self.current is not None:
+                    self.current['user_wait'] += time.monotonic() - started
+        return timed
+
+_active = None # Telemetry calls are recorded to, patched clients are shared by the process
+_patched = set() # modules whose clients are wrapped
+
+def _patch_requests(requests):
+    session_send = requests.Session.send
+    @wraps(session_send)
+    def send(session, request, **kwargs):
+        started = time.monotonic()
+        response = session_send(session, request, **kwargs)
+        if _active:
+            # Reading the content of a streamed response would defeat streaming, fall back to its declared length
+            size = int(response.headers.get('content-length') or 0) if kwargs.get('stream') else len(response.content or b'')
+            _active.record_call(_request_kind(request.url), started, time.monotonic() - started, size)
+        return response
+    requests.Session.send = send
+
+def _patch_kubernetes(rest):
+    rest_request = rest.RESTClientObject.request
+    @wraps(rest_request)
+    def k8s_request(rest_client, *args, **kwargs):
+        started = time.monotonic()
+        response = rest_request(rest_client, *args, **kwargs)
+        if _active:
+            size = len(response.data or b'') if kwargs.get('_preload_content', True) else 0
+            _active.record_call('kubernetes', started, time.monotonic() - started, size)
+        return response
+    rest.RESTClientObject.request = k8s_request
+
+def _request_kind(url):
+    parts = urlsplit(url)
+    if parts.hostname in OCO_HOSTS:
+        return 'oco'
+    if '/api/v1/' in parts.path:
+        return 'prometheus'
+    return 'http'
@@ -19,10 +19,13 @@ from prompt_toolkit.layout.dimension import Dimension
 from prompt_toolkit.layout.layout import Layout
 from prompt_toolkit.key_binding import KeyBindings
 
+HIGHLIGHT_POLL_INTERVAL = 0.15 # seconds, a highlight is reported once it survives a poll so scrolling past choices doesn't trigger them
+
 class ImbTuiResult:
     def __init__(self):
         self.back_selected = False
         self.other_selected = False
+        self.refresh_selected = False
         self.value = None
 
 # TODO: refactor redundant logic (eg. input_done = asyncio.Event())
@@ -333,7 +336,8 @@ class ImbTui:
         await input_done.wait()
         return result
 
-    async def prompt_radio_list(self, values, title, header, allow_other=True):
+    async def prompt_radio_list(self, values, title, header, allow_other=True, on_highlight=None, allow_refresh=False):
+        '''on_highlight(index) is called once the cursor rests on a choice, letting callers prefetch what that choice would need'''
         result = ImbTuiResult()
         input_done = asyncio.Event()
 
@@ -349,12 +353,18 @@ class ImbTui:
             result.other_selected = True
             input_done.set()
 
+        def refresh_handler() -> None:
+            result.refresh_selected = True
+            input_done.set()
+
         buttons = [
             Button(text='Ok', handler=ok_handler),
             Button(text='Back', handler=back_handler),
         ]
         if allow_other:
             buttons.append(Button(text='Other', handler=other_handler))
+        if allow_refresh:
+            buttons.append(Button(text='Refresh', handler=refresh_handler))
 
         radio_list = RadioList(list(enumerate(values)))
         dialog = Dialog(
@@ -375,10 +385,15 @@ class ImbTui:
         ])
         self.app.invalidate()
         self.app.layout.focus(self.app_frame)
-        await input_done.wait()
+        highlight_task = asyncio.ensure_future(_watch_highlight(radio_list, on_highlight)) if on_highlight else None
+        try:
+            await input_done.wait()
+        finally:
+            if highlight_task:
+                highlight_task.cancel()
         return result
 
-    async def prompt_check_list(self, values, title, header, allow_other=True):
+    async def prompt_check_list(self, values, title, header, allow_other=True, allow_refresh=False):
         result = ImbTuiResult()
         input_done = asyncio.Event()
 
@@ -394,12 +409,18 @@ class ImbTui:
             result.other_selected = True
             input_done.set()
 
+        def refresh_handler() -> None:
+            result.refresh_selected = True
+            input_done.set()
+
         buttons = [
             Button(text='Ok', handler=ok_handler),
             Button(text='Back', handler=back_handler),
         ]
         if allow_other:
             buttons.append(Button(text='Other', handler=other_handler))
+        if allow_refresh:
+            buttons.append(Button(text='Refresh', handler=refresh_handler))
 
         cb_list = CheckboxList(list(enumerate(values)))
         dialog = Dialog(
@@ -418,4 +439,129 @@ class ImbTui:
         self.app.invalidate()
         self.app.layout.focus(self.app_frame)
         await input_done.wait()
-        return result
\ No newline at end of file
+        return result
+
+    async def prompt_search_check_list(self, search, title, header, initial_text='', allow_other=True, page_size=20, debounce=0.3):
+        '''check list populated by the async search(text) callable, which returns a list of (value, label) tuples, as the user types.
+        Lookups are debounced and superseded lookups cancelled. Results are paged (PgUp/PgDn) and checked values persist across
+        searches and pages. Unlike prompt_check_list, result.value is the list of checked values rather than indexes'''
+        result = ImbTuiResult()
+        input_done = asyncio.Event()
+        checked = [] # checked values in the order they were checked
+        state = {'results': [], 'page': 0, 'task': None}
+
+        def sync_checked():
+            # CheckboxList only knows about the values on the current page
+            for value, _ in cb_list.values:
+                if value is None:
+                    continue
+                if value in cb_list.current_values and value not in checked:
+                    checked.append(value)
+                elif value not in cb_list.current_values and value in checked:
+                    checked.remove(value)
+
+        def show_page():
+            page_values = state['results'][state['page'] * page_size:(state['page'] + 1) * page_size]
+            cb_list.values = page_values or [(None, '(no matches)')]
+            cb_list.current_values = [ v for v, _ in page_values if v in checked ]
+            cb_list._selected_index = 0
+            num_pages = max(1, (len(state['results']) + page_size - 1) // page_size)
+            status.text = '{} matches, page {}/{} (PgUp/PgDn), {} checked'.format(len(state['results']), state['page'] + 1, num_pages, len(checked))
+            self.app.invalidate()
+
+        async def run_search(text):
+            await asyncio.sleep(debounce)
+            status.text = 'Searching...'
+            self.app.invalidate()
+            try:
+                results = await search(text)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                results = []
+            sync_checked()
+            state['results'], state['page'] = results, 0
+            show_page()
+
+        def on_text_changed(buf):
+            if state['task'] and not state['task'].done():
+                state['task'].cancel()
+            state['task'] = asyncio.ensure_future(run_search(buf.text))
+
+        def ok_handler() -> None:
+            sync_checked()
+            result.value = list(checked)
+            input_done.set()
+
+        def back_handler() -> None:
+            result.back_selected = True
+            input_done.set()
+
+        def other_handler() -> None:
+            result.other_selected = True
+            input_done.set()
+
+        buttons = [
+            Button(text='Ok', handler=ok_handler),
+            Button(text='Back', handler=back_handler),
+        ]
+        if allow_other:
+            buttons.append(Button(text='Other', handler=other_handler))
+
+        kb = KeyBindings()
+        @kb.add('pagedown')
+        def _(event):
+            if (state['page'] + 1) * page_size < len(state['results']):
+                sync_checked()
+                state['page'] += 1
+                show_page()
+
+        @kb.add('pageup')
+        def _(event):
+            if state['page'] > 0:
+                sync_checked()
+                state['page'] -= 1
+                show_page()
+
+        search_field = TextArea(text=initial_text, multiline=False, prompt='Search (regex): ')
+        search_field.buffer.on_text_changed += on_text_changed
+        status = FormattedTextControl('')
+        cb_list = CheckboxList([(None, '')])
+        dialog = Dialog(
+            title=title,
+            body=HSplit([
+                Label(text=HTML("    <b>{}</b>".format(header)), dont_extend_height=True),
+                search_field,
+                Window(status, height=1),
+                cb_list,
+            ], padding=1, key_bindings=kb),
+            buttons=buttons,
+            modal=False,
+        )
+        # disable a_reverse style applied to dialogs
+        dialog.container.container.content.style=""
+        self.app_frame.body = HSplit([
+            Window(),
+            dialog,
+            Window()
+        ])
+        self.app.invalidate()
+        self.app.layout.focus(self.app_frame)
+        on_text_changed(search_field.buffer)
+        try:
+            await input_done.wait()
+        finally:
+            if state['task'] and not state['task'].done():
+                state['task'].cancel()
+        return result
+
+async def _watch_highlight(radio_list, on_highlight):
+    # RadioList has no event for cursor movement, poll the index it tracks
+    reported, previous = None, None
+    while True:
+        index = radio_list._selected_index
+        if index == previous and index != reported:
+            reported = index
+            on_highlight(index)
+        previous = index
+        await asyncio.sleep(HIGHLIGHT_POLL_INTERVAL)
@@ -1,15 +1,42 @@
+import asyncio
 from datetime import timedelta
+from functools import reduce
+from math import gcd
+from os.path import expanduser
 import re
+import socket
+import subprocess
+from urllib.parse import urlsplit
+
+import imb.imb_http as imb_http
 
 GATHERED_INFO = set(['vegeta_config', 'load_duration'])
 
+# Share of the calibrated saturation rate to load the app at, leaves headroom for slower configurations tried during optimization
+CALIBRATION_LOAD_RATIO = 0.8
+CALIBRATION_WORKER_HEADROOM = 2 # workers relative to the concurrency required by Little's law
+MIN_WORKERS = 10
+MAX_WORKERS = 500
+PORT_FORWARD_READY_TIMEOUT = 10 # seconds
+
+VEGETA_TARGETS_KEY = 'vegeta-targets.txt' # servo configmap key
+VEGETA_TARGETS_PATH = '/servo/' + VEGETA_TARGETS_KEY
+VEGETA_TARGETS_LINES = 100 # targets file entries weights are distributed over
+LOAD_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
 class ImbVegeta:
-    def __init__(self, ui, finished_method, k8sImb, ocoOverride, servoConfig):
+    def __init__(self, ui, finished_method, k8sImb, promImb, ocoOverride, servoConfig):
         self.ui = ui
         self.finished_method = finished_method
         self.k8sImb = k8sImb
+        self.promImb = promImb
         self.ocoOverride = ocoOverride
         self.servoConfig = servoConfig
+        self.vegeta_config = {}
+        self.load_targets = []
+        self.load_calibration = None
+        self.rate_per_second = 0
+        self.targets_file = None # vegeta targets file content when load is spread over multiple targets
         
         # Initialize info used in Other/Error handling
         self.other_info = {}
@@ -103,34 +130,46 @@ class ImbVegeta:
                     serv.metadata.name,
                     serv.metadata.namespace,
                     serv.spec.ports[0].port
-                ), 'host': None})
+                ), 'host': None, 'path': ''})
 
             for ing in self.k8sImb.ingresses:
-                ing_hostname = ing.status.load_balancer.ingress[0].hostname
+                # Load balancers report either a hostname or an ip, and none at all while still provisioning
+                lb_address = next((lb.hostname or lb.ip for lb in (ing.status.load_balancer.ingress or []) if lb.hostname or lb.ip), None)
+                tls_hosts = set(h for tls in (ing.spec.tls or []) for h in (tls.hosts or []))
                 # Get endpoint for any matching rule and path
                 if ing.spec.rules:
                     for r in ing.spec.rules:
+                        address = lb_address or r.host
+                        if not address or not r.http:
+                            continue
                         for p in r.http.paths:
                             if p.backend and any((p.backend.service_name == s.metadata.name for s in self.k8sImb.services)):
-                                url = 'http://{}:{}{}'.format(
-                                    ing_hostname,
-                                    p.backend.service_port,
-                                    p.path
+                                url = '{}://{}{}'.format(
+                                    'https' if r.host in tls_hosts else 'http',
+                                    address,
+                                    p.path or ''
                                 )
-                                app_load_endpoints.append({'url': url, 'host': r.host})
+                                app_load_endpoints.append({'url': url, 'host': r.host, 'path': p.path or ''})
 
                 # Get endpoint for default backend if it matches any services
-                if ing.spec.backend and any((ing.spec.backend.service_name == s.metadata.name for s in self.k8sImb.services)):
-                    url = 'http://{}:{}'.format(ing_hostname, ing.spec.backend.service_port)
-                    app_load_endpoints.append({'url': url, 'host': None})
+                if lb_address and ing.spec.backend and any((ing.spec.backend.service_name == s.metadata.name for s in self.k8sImb.services)):
+                    url = 'http://{}'.format(lb_address)
+                    app_load_endpoints.append({'url': url, 'host': None, 'path': ''})
+
+            # Probe all candidates concurrently, cluster internal service urls are only reachable when running in the cluster
+            probe_targets = [ ep for ep in app_load_endpoints if self.k8sImb.running_in_k8s or not _is_cluster_internal(ep['url']) ]
+            probes = await imb_http.probe_all([ (ep['url'], ep['host']) for ep in probe_targets ])
+            for ep, probe in zip(probe_targets, probes):
+                ep['probe'] = probe
+            app_load_endpoints.sort(key=_probe_rank)
 
             if len(app_load_endpoints) == 1:
                 desired_endpoint = app_load_endpoints[0]
             else:
                 result = await self.ui.prompt_radio_list(
                     title='Select Endpoint for Load Generation', 
-                    header='URL:', 
-                    values=[ep['url'] for ep in app_load_endpoints])
+                    header='URL / Probe:', 
+                    values=[ '{} - {}'.format(ep['url'], _describe_probe(ep.get('probe'))) for ep in app_load_endpoints ])
                 state_data['interacted'] = True
                 if result.back_selected:
                     return True
@@ -143,20 +182,81 @@ class ImbVegeta:
                 state_data['vegeta_config'] = { 'target': 'GET {}'.format(desired_endpoint['url']) }
                 if desired_endpoint.get('host'):
                     state_data['vegeta_config']['host'] = desired_endpoint['host'] # NOTE: servo-vegeta does not currently implement host http request header
+                state_data['load_endpoint'] = desired_endpoint
+                state_data['app_load_endpoints'] = app_load_endpoints
 
         if state_data.get('other_selected'):
             call_next(self.prompt_other)
         else:
-            self.vegeta_config = state_data['vegeta_config']
-            call_next(self.select_duration)
+            # Copied so later stages don't alter the saved state when going back and forth
+            self.vegeta_config = dict(state_data['vegeta_config'])
+            self.load_endpoint = state_data['load_endpoint']
+            self.app_load_endpoints = state_data['app_load_endpoints']
+            call_next(self.select_targets)
+
+    async def select_targets(self, call_next, state_data):
+        if not state_data:
+            state_data['interacted'] = False
+            state_data['load_targets'] = [ dict(method='GET', url=self.load_endpoint['url'], host=self.load_endpoint['host'], weight=1.0) ]
+            candidates = self._candidate_targets()
+            if len(candidates) > 1:
+                result = await self.ui.prompt_check_list(
+                    title='Select Load Generation Targets',
+                    header='Share of requests / Target (select none to only load {}):'.format(self.load_endpoint['url']),
+                    values=[ '{:>6.1%} {} {}{}'.format(t['weight'], t['method'], t['url'], ' (Host: {})'.format(t['host']) if t['host'] else '')
+                        for t in candidates ])
+                state_data['interacted'] = True
+                if result.back_selected:
+                    return True
+                if result.other_selected:
+                    state_data['other_selected'] = True
+                elif result.value:
+                    selected = [ candidates[i] for i in sorted(result.value) ]
+                    total = sum(t['weight'] for t in selected)
+                    state_data['load_targets'] = [ dict(t, weight=t['weight'] / total) for t in selected ]
+
+        if state_data.get('other_selected'):
+            call_next(self.prompt_other)
+            return
+
+        self.load_targets = state_data['load_targets']
+        if len(self.load_targets) > 1:
+            # vegeta reads multiple targets (with their Host headers) from a file mounted alongside the servo config
+            self.vegeta_config.pop('target', None)
+            self.vegeta_config.pop('host', None)
+            self.vegeta_config['targets'] = VEGETA_TARGETS_PATH
+            self.targets_file = _render_targets(self.load_targets)
+        else:
+            self.targets_file = None
+        call_next(self.select_duration)
+
+    def _candidate_targets(self):
+        'weighted targets from the production traffic mix under the selected endpoint, or all discovered endpoints equally weighted'
+        parts = urlsplit(self.load_endpoint['url'])
+        origin = '{}://{}'.format(parts.scheme, parts.netloc)
+        prefix = self.load_endpoint['path'].rstrip('/')
+
+        # Only methods that don't need a request body can be generated, templated routes (eg. /users/{id}) can't be requested as is
+        mix = [ m for m in self.promImb.traffic_mix if m['method'] in LOAD_METHODS and m['path'].startswith('/')
+            and not re.search(r'[{}*:<>]', m['path']) and (m['path'] + '/').startswith(prefix + '/') ]
+        if mix:
+            total = sum(m['share'] for m in mix)
+            return [ dict(method=m['method'], url=origin + m['path'], host=self.load_endpoint['host'], weight=m['share'] / total) for m in mix ]
+
+        return [ dict(method='GET', url=ep['url'], host=ep['host'], weight=1.0 / len(self.app_load_endpoints)) for ep in self.app_load_endpoints ]
 
     async def select_duration(self, call_next, state_data):
         if not state_data:
             state_data['interacted'] = False
+            # Default to the shortest duration that gives a stable perf metric reading when prometheus discovery could determine it
+            prompt, initial_text = 'Duration of load generation', '5m'
+            if self.promImb.recommended_duration:
+                initial_text = _format_duration(self.promImb.recommended_duration)
+                prompt = 'Duration of load generation (recommended from perf metric stability)'
             result = await self.ui.prompt_text_input(
                 title='Load Generation Configuration',
                 prompts=[
-                    {'prompt': 'Duration of load generation', 'initial_text': '5m'}
+                    {'prompt': prompt, 'initial_text': initial_text}
                 ],
                 allow_other=True
             )
@@ -173,15 +273,128 @@ class ImbVegeta:
         else:
             self.vegeta_config['duration'] = state_data['load_duration']
             self.ocoOverride['measurement']['control']['duration'] = _convert_to_seconds(state_data['load_duration'])
-            call_next(self.finish_discovery)
+            call_next(self.calibrate_load)
+
+    async def calibrate_load(self, call_next, state_data):
+        if not state_data:
+            state_data['interacted'] = False
+            result = await self.ui.prompt_yn(
+                title='Load Calibration',
+                prompt='Run a short load ramp (up to {}s) against the selected endpoint to size the load generator rate and workers?'.format(
+                    imb_http.RAMP_STEP_DURATION * imb_http.RAMP_MAX_STEPS)
+            )
+            state_data['interacted'] = True
+            if result.back_selected:
+                return True
+            state_data['load_calibration'] = None
+            if result.value:
+                calibration = await self._run_calibration()
+                state_data['load_calibration'] = calibration
+
+                result = await self.ui.prompt_ok(title='Load Calibration Results', prompt=_describe_calibration(calibration) if calibration else
+                    'Unable to reach the load generation endpoint for calibration, the default load generator settings will be used')
+                if result.back_selected:
+                    return True
+
+        self.load_calibration = state_data['load_calibration']
+        if self.load_calibration and self.load_calibration.get('settings'):
+            self.vegeta_config.update(self.load_calibration['settings'])
+        call_next(self.select_rate)
+
+    async def select_rate(self, call_next, state_data):
+        production_rate = self.promImb.production_rate
+        if not state_data:
+            state_data['interacted'] = False
+            # Only prompt when observed production traffic gives a realistic alternative to the calibrated/default rate
+            if production_rate:
+                prompt = [
+                    'Production request rate of {} over the last {}:'.format(production_rate['metric'], production_rate['lookback']),
+                    '  p95 {}, peak {}, mean {}'.format(*( _format_rate(production_rate[k]) for k in ('p95', 'peak', 'mean') ))
+                ]
+                if self.load_calibration and self.load_calibration.get('saturation_rate'):
+                    prompt.append('Calibrated saturation point: {}'.format(_format_rate(self.load_calibration['saturation_rate'])))
+                    if production_rate['p95'] > self.load_calibration['saturation_rate']:
+                        prompt.append('NOTE: production traffic exceeds the saturation point measured for a single endpoint')
+                prompt.append('Enter the load generation rate (defaults to the production p95 rate):')
+
+                result = await self.ui.long_prompt_text_input(
+                    title='Load Generation Rate',
+                    prompt=prompt,
+                    initial_text=_format_rate(production_rate['p95']),
+                    allow_other=True
+                )
+                state_data['interacted'] = True
+                if result.back_selected:
+                    return True
+                if result.other_selected:
+                    state_data['other_selected'] = True
+                else:
+                    state_data['load_rate'] = result.value
+
+        if state_data.get('other_selected'):
+            call_next(self.prompt_other)
+            return
+
+        if state_data.get('load_rate'):
+            self.vegeta_config['rate'] = state_data['load_rate']
+            # Keep workers in line with the chosen rate when calibration measured the app's latency
+            if self.load_calibration and self.load_calibration.get('latency_p95'):
+                workers, max_workers = _size_workers(_convert_to_per_second(state_data['load_rate']), self.load_calibration['latency_p95'])
+                self.vegeta_config.update({ 'workers': workers, 'max-workers': max_workers })
+        call_next(self.finish_discovery)
+
+    async def _run_calibration(self):
+        # Targets are sorted heaviest first, calibrate against the one most of the load goes to
+        target = max(self.load_targets, key=lambda t: t['weight'])
+        target_url = target['url']
+        # Cluster internal service urls are reached directly from within the cluster, else through a port forward from this machine
+        service = None if self.k8sImb.running_in_k8s else re.match(r'http://(?P<name>[^.]+)\.(?P<namespace>[^.]+)\.svc:(?P<port>\d+)(?P<path>.*)$', target_url)
+        port_forward_proc = None
+        try:
+            if service:
+                local_port = _free_port()
+                port_forward_proc = subprocess.Popen(
+                    stdout=subprocess.DEVNULL,
+                    args=['kubectl', 'port-forward',
+                        '--kubeconfig', expanduser(self.k8sImb.kubeConfigPath),
+                        '--context', self.k8sImb.context['name'],
+                        '--namespace', service.group('namespace'),
+                        'svc/{}'.format(service.group('name')),
+                        '{}:{}'.format(local_port, service.group('port'))])
+                target_url = 'http://127.0.0.1:{}{}'.format(local_port, service.group('path'))
+                await _wait_for_port(local_port, port_forward_proc)
+
+            ramp = await imb_http.calibrate(target_url, host=target['host'])
+        except OSError as e: # kubectl missing or the port forward failed, calibration is optional
+            self.other_info.setdefault('non-critical-errors', {})['Load Calibration Error'] = {
+                'reason': 'Unable to reach {} for load calibration'.format(target['url']),
+                'error': '{}: {}'.format(type(e).__name__, e)
+            }
+            return None
+        finally:
+            if port_forward_proc is not None and port_forward_proc.poll() is None:
+                port_forward_proc.kill()
+
+        calibration = { 'steps': ramp['steps'], 'saturated': ramp['saturated'], 'settings': None }
+        healthy = ramp['healthy_step']
+        if healthy:
+            rate = healthy['rate'] * CALIBRATION_LOAD_RATIO
+            workers, max_workers = _size_workers(rate, healthy['latency_p95'])
+            calibration['saturation_rate'] = healthy['rate']
+            calibration['latency_p95'] = healthy['latency_p95']
+            calibration['settings'] = {
+                'rate': _format_rate(rate),
+                'workers': workers,
+                'max-workers': max_workers
+            }
+        return calibration
 
     async def finish_discovery(self, call_next, state_data):
         state_data['interacted'] = False
-        self.vegeta_config.update({
-            'rate': '3000/m',
-            'workers': 50,
-            'max-workers': 500
-        })
+        # Defaults when load calibration was skipped
+        for key, value in (('rate', '3000/m'), ('workers', 50), ('max-workers', 500)):
+            self.vegeta_config.setdefault(key, value)
+        self.rate_per_second = _convert_to_per_second(self.vegeta_config['rate'])
         self.servoConfig['vegeta'] = self.vegeta_config
 
         call_next(self.finished_method)
@@ -193,3 +406,95 @@ def _convert_to_seconds(s):
         UNITS.get(m.group('unit').lower(), 'seconds'): int(m.group('val'))
         for m in re.finditer(r'(?P<val>\d+)(?P<unit>[smhdw]?)', s, flags=re.I)
     }).total_seconds())
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return ''.join(('{}m'.format(minutes) if minutes else '', '{}s'.format(seconds) if seconds else '')) or '0s'
+
+def _render_targets(targets):
+    '''vegeta http format targets file. vegeta round robins over the entries so targets are repeated in proportion to their
+    weight, interleaved with smooth weighted round robin to avoid bursts of a single target'''
+    repeats = [ max(1, int(round(t['weight'] * VEGETA_TARGETS_LINES))) for t in targets ]
+    divisor = reduce(gcd, repeats)
+    repeats = [ r // divisor for r in repeats ]
+
+    entries, current, total = [], [0] * len(targets), sum(repeats)
+    for _ in range(total):
+        current = [ c + r for c, r in zip(current, repeats) ]
+        i = current.index(max(current))
+        current[i] -= total
+        t = targets[i]
+        entries.append('{} {}{}\n'.format(t['method'], t['url'], '\nHost: {}'.format(t['host']) if t['host'] else ''))
+    return '\n'.join(entries)
+
+def _size_workers(rate, latency):
+    'vegeta workers and max-workers for rate (per second) at latency (seconds)'
+    # Little's law: requests in flight = arrival rate * time in system, p95 latency covers most of the tail
+    concurrency = imb_http.littles_law_concurrency(rate, latency)
+    workers = min(MAX_WORKERS, max(MIN_WORKERS, concurrency * CALIBRATION_WORKER_HEADROOM))
+    return workers, min(MAX_WORKERS, max(workers, concurrency * CALIBRATION_WORKER_HEADROOM * 4))
+
+def _format_rate(rate):
+    'vegeta rate of requests per minute from requests per second'
+    return '{}/m'.format(max(1, int(round(rate * 60))))
+
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+def _convert_to_per_second(rate):
+    'requests per second of a vegeta rate, eg. 3000/m or 50/1s'
+    count, _, per = rate.partition('/')
+    per = _convert_to_seconds(per) if re.match(r'^\d', per) else RATE_UNITS.get(per or 's', 1)
+    return float(count) / (per or 1)
+
+def _describe_calibration(calibration):
+    lines = [ '{:>8g}/s: achieved {:.1f}/s, p95 {}, errors {:.1%}{}'.format(
+        s['rate'], s['achieved_rate'], '{:.0f}ms'.format(s['latency_p95'] * 1000) if s['latency_p95'] is not None else '-',
+        s['error_ratio'], ' ({})'.format(s['degraded']) if s['degraded'] else '') for s in calibration['steps'] ]
+    if not calibration['settings']:
+        lines.append('The endpoint degraded at the lowest rate, the default load generator settings will be used')
+    else:
+        if not calibration['saturated']:
+            lines.append('No degradation was observed, the highest rate tried is used as a lower bound of the saturation point')
+        lines.append('Load generator settings: rate {rate}, workers {workers}, max-workers {max-workers}'.format(**calibration['settings']))
+    return lines
+
+def _is_cluster_internal(url):
+    return bool(re.match(r'https?://[^/:]+\.svc(:\d+)?(/|$)', url))
+
+def _probe_rank(endpoint):
+    'sort key placing responsive endpoints first (fastest first), then unprobed ones, then failing or unreachable ones'
+    probe = endpoint.get('probe')
+    if not probe:
+        return (1, 0)
+    if probe['error'] or probe['status'] >= 400:
+        return (2, 0)
+    return (0, probe['ttfb'])
+
+def _describe_probe(probe):
+    if not probe:
+        return 'not probed (cluster internal)'
+    if probe['error']:
+        return 'unreachable: {}'.format(probe['error'])
+    details = [ str(probe['status']), '{:.0f}ms'.format(probe['ttfb'] * 1000) ]
+    if probe['keep_alive']:
+        details.append('keep-alive')
+    if probe['http2']:
+        details.append('h2')
+    return ', '.join(details)
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def _wait_for_port(port, proc):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + PORT_FORWARD_READY_TIMEOUT
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if proc.poll() is not None or loop.time() > deadline:
+                raise ConnectionError('Unable to port forward to the load generation endpoint for calibration')
+            await asyncio.sleep(0.25)
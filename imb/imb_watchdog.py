@@ -0,0 +1,60 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+STALL_THRESHOLD = 0.25 # seconds the event loop can go without a heartbeat before it is reported as stalled
+STALL_LOG = 'imb-stalls.log'
+HEARTBEAT_INTERVAL = 0.05
+
+class StallWatchdog:
+    '''Debug aid reporting blocking calls made on the event loop (eg. synchronous requests/kubernetes-client calls within a
+    coroutine), which otherwise only show up as a frozen TUI. A heartbeat coroutine timestamps every HEARTBEAT_INTERVAL and
+    a watchdog thread logs the loop thread's stack and the run_stack method running once a heartbeat is more than threshold
+    late, then the stall's total duration once the loop recovers'''
+    def __init__(self, loop, current_method=lambda: None, threshold=STALL_THRESHOLD, log_path=STALL_LOG):
+        self.loop = loop
+        self.current_method = current_method # name of the run_stack method running
+        self.threshold = threshold
+        self.log_path = log_path
+        self.beat = time.monotonic()
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+        self.stalls = 0
+
+    def start(self):
+        self.heartbeat_task = self.loop.create_task(self._heartbeat())
+        self.thread = threading.Thread(target=self._watch, name='imb-stall-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        'stop watching, called once the loop is no longer running'
+        self.stopped.set()
+        self.thread.join()
+        self.heartbeat_task.cancel()
+        self.loop.run_until_complete(asyncio.gather(self.heartbeat_task, return_exceptions=True))
+
+    async def _heartbeat(self):
+        self.loop_thread_id = threading.get_ident()
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def _watch(self):
+        stalled_since = None
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            late = time.monotonic() - self.beat
+            if late > self.threshold and stalled_since is None:
+                stalled_since = self.beat
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else '(loop thread stack unavailable)\n'
+                self._log('Event loop stalled for {:.3f}s in {}, stack of the loop thread:\n{}'.format(late, self.current_method(), stack))
+                self.stalls += 1
+            elif late <= self.threshold and stalled_since is not None:
+                self._log('Event loop recovered after {:.3f}s\n\n'.format(self.beat - stalled_since))
+                stalled_since = None
+
+    def _log(self, message):
+        with open(self.log_path, 'a') as out_file:
+            out_file.write('{} {}'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), message))
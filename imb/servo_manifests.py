@@ -161,3 +161,43 @@ servo_deployment = {
         }
     }
 }
+
+# Servo container sizing model. The servo runs vegeta, whose CPU use grows with the request rate (request encoding,
+#   connection handling and result decoding, ~2000 plain http requests per second per core) plus a small cost per
+#   target and per prometheus metric queried each measurement. Memory grows with vegeta's workers (goroutine stacks and
+#   connection buffers) and with the number of results in flight. Limits are SERVO_LIMIT_FACTOR times the requests so
+#   bursts at the start of a measurement aren't throttled
+SERVO_BASE_CPU_MILLICORES = 125
+SERVO_BASE_MEMORY_MIB = 128
+SERVO_CPU_MILLICORES_PER_RPS = 0.5
+SERVO_CPU_MILLICORES_PER_TARGET = 2
+SERVO_CPU_MILLICORES_PER_METRIC = 5
+SERVO_MEMORY_MIB_PER_WORKER = 0.25
+SERVO_MEMORY_MIB_PER_RPS = 0.05
+SERVO_LIMIT_FACTOR = 2
+SERVO_CPU_ROUNDING = 25 # millicores
+SERVO_MEMORY_ROUNDING = 32 # MiB
+
+def size_servo_resources(rate=0, max_workers=0, targets=1, metrics=0, cpu=None, memory=None):
+    '''Container resources for a servo generating rate requests per second with up to max_workers vegeta workers over
+    targets targets and querying metrics prometheus metrics. cpu/memory (kubernetes quantities) override the model
+    and are used as both request and limit'''
+    cpu_millicores = SERVO_BASE_CPU_MILLICORES + rate * SERVO_CPU_MILLICORES_PER_RPS \
+        + targets * SERVO_CPU_MILLICORES_PER_TARGET + metrics * SERVO_CPU_MILLICORES_PER_METRIC
+    memory_mib = SERVO_BASE_MEMORY_MIB + max_workers * SERVO_MEMORY_MIB_PER_WORKER + rate * SERVO_MEMORY_MIB_PER_RPS
+
+    cpu_request = '{}m'.format(_round_up(cpu_millicores, SERVO_CPU_ROUNDING))
+    memory_request = '{}Mi'.format(_round_up(memory_mib, SERVO_MEMORY_ROUNDING))
+    return {
+        'limits': {
+            'cpu': cpu or '{}m'.format(_round_up(cpu_millicores * SERVO_LIMIT_FACTOR, SERVO_CPU_ROUNDING)),
+            'memory': memory or '{}Mi'.format(_round_up(memory_mib * SERVO_LIMIT_FACTOR, SERVO_MEMORY_ROUNDING))
+        },
+        'requests': {
+            'cpu': cpu or cpu_request,
+            'memory': memory or memory_request
+        }
+    }
+
+def _round_up(value, multiple):
+    return int(-(-value // multiple) * multiple)
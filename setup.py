@@ -9,8 +9,22 @@ setup ( name='imb',
       'imb.imb_prometheus',
       'imb.imb_vegeta',
       'imb.imb_yaml',
+      'imb.imb_metrics_catalog',
+      'imb.imb_stats',
+      'imb.imb_http',
+      'imb.imb_headless',
+      'imb.imb_fleet',
+      'imb.imb_scheduler',
+      'imb.imb_prefetch',
+      'imb.imb_memo',
+      'imb.imb_journal',
+      'imb.imb_telemetry',
+      'imb.imb_watchdog',
+      'imb.imb_oco',
       'imb.servo_manifests'
       ],
+  packages=['imb'],
+  package_data={'imb': ['known_metrics/*.yaml']},
   install_requires=[
       'kubernetes',
       'PyYAML',
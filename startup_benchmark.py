@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''Measures how long the imb entry point takes to start and fails when it exceeds its budget.
+
+Reports the median wall time of `imb --help` and the import time of imb.imb_main broken down by the slowest top level
+modules (from python -X importtime). Fails when the import time exceeds --budget or when a module that is only needed
+once discovery runs (kubernetes-client, requests, prompt_toolkit, dotenv) is imported at startup.
+
+    python3 startup_benchmark.py [--budget MS] [--runs N]
+'''
+import argparse
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import time
+
+IMPORT_BUDGET_MS = 200
+DEFERRED_MODULES = ('kubernetes', 'requests', 'prompt_toolkit', 'dotenv')
+REPO_DIR = Path(__file__).resolve().parent
+
+HELP_CODE = "import sys; sys.argv = ['imb', '--help']; from imb.imb_main import imb; imb()"
+LOADED_CODE = "import sys, imb.imb_main; print(' '.join(m for m in {!r} if m in sys.modules))".format(DEFERRED_MODULES)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure imb startup time against an import time budget')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS, help='import time budget of imb.imb_main in ms')
+    parser.add_argument('--runs', type=int, default=5, help='runs to take the median of')
+    args = parser.parse_args()
+
+    help_times, import_times = [], []
+    for _ in range(args.runs):
+        started = time.monotonic()
+        _python('-c', HELP_CODE)
+        help_times.append((time.monotonic() - started) * 1000)
+        import_times.append(_import_times())
+    import_ms = statistics.median(t.pop('total') for t in import_times)
+
+    print('imb --help: {:.0f}ms (median of {} runs)'.format(statistics.median(help_times), args.runs))
+    print('import imb.imb_main: {:.0f}ms, budget {:.0f}ms'.format(import_ms, args.budget))
+    slowest = sorted(import_times[-1].items(), key=lambda m: -m[1])[:10]
+    for module, ms in slowest:
+        print('    {:8.1f}ms  {}'.format(ms, module))
+
+    failures = []
+    loaded = _python('-c', LOADED_CODE).stdout.split()
+    if loaded:
+        failures.append('modules that should be deferred are imported at startup: {}'.format(', '.join(loaded)))
+    if import_ms > args.budget:
+        failures.append('import time {:.0f}ms exceeds the {:.0f}ms budget'.format(import_ms, args.budget))
+    for failure in failures:
+        print('FAIL: {}'.format(failure))
+    return 1 if failures else 0
+
+def _python(*args):
+    return subprocess.run([sys.executable] + list(args), cwd=str(REPO_DIR), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+def _import_times():
+    '''import time in ms of imb.imb_main (total) and of each module it imports directly, from python -X importtime.
+    Nested imports are indented in its output and included in their importer's cumulative time'''
+    stderr = _python('-X', 'importtime', '-c', 'import imb.imb_main').stderr
+    times, children = {'total': 0.0}, {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative) / 1000
+        elif depth == 0:
+            # Imports are listed after the modules they import, skip the interpreter's own startup imports
+            if name.strip().split('.')[0] == 'imb':
+                times['total'] += int(cumulative) / 1000
+                times.update(children)
+            children = {}
+    return times
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+from urllib.parse import urlsplit
+
+from imb.imb_headless import HeadlessError, ImbHeadless
+from imb.imb_prometheus import ImbPrometheus
+
+PROMETHEUS_URL = 'http://prometheus.monitoring.svc:9090'
+METRIC = 'app_request_latency' # not in the catalog, so it is configured without a unit
+
+class FakeResponse:
+    def __init__(self, data):
+        self.ok = True
+        self.status_code = 200
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return { 'status': 'success', 'data': self.data }
+
+def fake_prometheus_get(url, params=None, timeout=None):
+    'answers the prometheus API calls made by discovery with a single series of METRIC'
+    path = urlsplit(url).path
+    query = (params or {}).get('query', '')
+    if path.endswith('/query'):
+        if query.startswith('sum by(__name__)') and 'app="web"' in query:
+            return FakeResponse({ 'resultType': 'vector', 'result': [ { 'metric': { '__name__': METRIC }, 'value': [0, '1'] } ] })
+        if query.startswith('count(') or query.startswith('topk('):
+            return FakeResponse({ 'resultType': 'vector', 'result': [ { 'metric': { '__name__': METRIC, 'app': 'web' }, 'value': [0, '1'] } ] })
+        return FakeResponse({ 'resultType': 'vector', 'result': [] })
+    if path.endswith('/query_range'):
+        return FakeResponse({ 'resultType': 'matrix', 'result': [] })
+    if path.endswith('/targets'):
+        return FakeResponse({ 'activeTargets': [] })
+    return FakeResponse({})
+
+class HeadlessTextInputTest(unittest.TestCase):
+    def prompt(self, answers, prompts):
+        return asyncio.get_event_loop().run_until_complete(ImbHeadless(answers).prompt_text_input('Title', prompts))
+
+    def test_optional_field_accepts_empty_default(self):
+        result = self.prompt({}, [{'prompt': 'a', 'initial_text': 'x'}, {'prompt': 'b', 'initial_text': '', 'optional': True}])
+        self.assertEqual(result.value, ('x', ''))
+
+    def test_required_field_rejects_empty_default(self):
+        with self.assertRaises(HeadlessError):
+            self.prompt({}, [{'prompt': 'a', 'initial_text': ''}])
+
+    def test_scalar_answers_first_field(self):
+        result = self.prompt({'Title': 'y'}, [{'prompt': 'a', 'initial_text': 'x'}, {'prompt': 'b', 'initial_text': 'z'}])
+        self.assertEqual(result.value, ('y', 'z'))
+
+    def test_repeated_answer_is_rejected(self):
+        ui = ImbHeadless({'Title': 'abc'})
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ui.prompt_text_input('Title', [{'prompt': 'a'}]))
+        with self.assertRaises(HeadlessError):
+            loop.run_until_complete(ui.prompt_text_input('Title', [{'prompt': 'a'}]))
+
+class HeadlessPrometheusDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        # range queries are cached relative to the working directory
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def test_discovery_with_default_answers(self):
+        ui = ImbHeadless({
+            'Prometheus Endpoint': PROMETHEUS_URL,
+            'Select Deployment Metrics for Optimization Measurement': [METRIC],
+            'Select Performance Metric': METRIC,
+        })
+        k8sImb = SimpleNamespace(
+            prometheusService=SimpleNamespace(metadata=SimpleNamespace(name='prometheus', namespace='monitoring'), spec=SimpleNamespace(ports=[SimpleNamespace(port=9090)])),
+            depLabels={ 'app': 'web' }, pod_name_regex=None, namespace='default', container_name='web',
+            current_settings_since=None, container_current_settings={})
+        servoConfig = {}
+        ocoOverride = { 'optimization': {}, 'measurement': { 'control': {} } }
+        finished = []
+        async def finished_method(call_next, state_data):
+            finished.append(True)
+            call_next(None)
+        prom = ImbPrometheus(ui, finished_method, [], k8sImb, ocoOverride, servoConfig)
+
+        with mock.patch('imb.imb_prometheus.requests.get', side_effect=fake_prometheus_get):
+            asyncio.get_event_loop().run_until_complete(_run_stack(prom.run))
+
+        self.assertTrue(finished)
+        self.assertEqual(servoConfig['prom']['prometheus_endpoint'], PROMETHEUS_URL)
+        self.assertEqual(servoConfig['prom']['metrics'], { METRIC: { 'query': 'sum({}{{app="web"}})'.format(METRIC) } })
+        self.assertEqual(ocoOverride['optimization']['perf'], "metrics['{}']".format(METRIC))
+
+async def _run_stack(method):
+    'run methods the way Imb.execute_run_stack does, errors are raised rather than handled'
+    run_stack = [method]
+    while run_stack[-1] is not None:
+        await run_stack[-1](run_stack.append, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from imb.imb_metrics_catalog import histogram_family_metrics, MetricsCatalog
+
+# (metric name, perf names of the templates it matches in the bundled catalog)
+CATALOG_MATCHES = [
+    ('http_requests_total', ['main_request_rate', 'main_error_rate']),
+    ('myapp_http_requests_total', ['main_request_rate', 'main_error_rate']), # suffix
+    ('myapp_http_request_duration_seconds_bucket', ['main_p50_time', 'main_p90_time', 'main_p99_time']),
+    ('http_request_duration_seconds_bucket', ['main_p50_time', 'main_p90_time', 'main_p99_time']),
+    ('istio_requests_total', ['main_request_rate', 'main_error_rate']),
+    ('http_server_requests_seconds_count', ['main_request_rate', 'main_error_rate']),
+    ('api_requests_total', ['main_request_rate']),
+    ('http_requests_total_bytes', []),
+    ('requests_total', []),
+    ('_http_requests_total', ['main_request_rate', 'main_error_rate']),
+    ('', []),
+]
+
+class MetricsCatalogTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.catalog = MetricsCatalog.load(extra_paths=[])
+
+    def test_match(self):
+        for metric_name, perf_names in CATALOG_MATCHES:
+            with self.subTest(metric_name=metric_name):
+                self.assertEqual([ k.perf_name for k in self.catalog.match(metric_name) ], perf_names)
+                self.assertEqual(metric_name in self.catalog, bool(perf_names))
+
+    def test_match_all_skips_unknown(self):
+        matches = self.catalog.match_all(['myapp_http_requests_total', 'unknown_metric'])
+        self.assertEqual(list(matches), ['myapp_http_requests_total'])
+
+    def test_error_rate_query(self):
+        error_rate = next(k for k in self.catalog.match('myapp_http_requests_total') if k.kind == 'error_rate')
+        self.assertEqual(error_rate.status_filters, ('code=~"5.."',))
+        self.assertEqual(error_rate.format_query('m{app="web",code=~"5.."}', 'm{app="web"}', '5m'),
+            '100 * sum(rate(m{app="web",code=~"5.."}[5m])) / sum(rate(m{app="web"}[5m]))')
+
+    def test_most_specific_entry_wins(self):
+        catalog = MetricsCatalog()
+        catalog.add_entries([
+            { 'prefix': 'app_', 'perf_name': 'prefix', 'query': '{}' },
+            { 'suffix': '_requests_total', 'perf_name': 'suffix', 'query': '{}' },
+            { 'name': 'app_requests_total', 'perf_name': 'exact', 'query': '{}' },
+        ])
+        for metric_name, perf_name in [('app_requests_total', 'exact'), ('app_web_requests_total', 'suffix'), ('app_web_total', 'prefix')]:
+            with self.subTest(metric_name=metric_name):
+                self.assertEqual([ k.perf_name for k in catalog.match(metric_name) ], [perf_name])
+
+    def test_later_entries_replace_group(self):
+        catalog = MetricsCatalog()
+        catalog.add_entries([ { 'name': 'm', 'perf_name': 'a', 'query': '{}' }, { 'name': 'm', 'perf_name': 'b', 'query': '{}' } ])
+        catalog.add_entries([ { 'name': 'm', 'perf_name': 'c', 'query': '{}' } ])
+        self.assertEqual([ k.perf_name for k in catalog.match('m') ], ['c'])
+
+    def test_invalid_entry(self):
+        for entry in [ { 'query': '{}' }, { 'name': 'm' }, { 'name': 'm', 'suffix': 'm', 'query': '{}' } ]:
+            with self.subTest(entry=entry):
+                with self.assertRaises(Exception):
+                    MetricsCatalog().add_entries([entry])
+
+# (family, status label, perf names of the _count templates, latency unit)
+HISTOGRAM_FAMILIES = [
+    ('app_latency_seconds', 'code', ['app_latency_seconds_throughput', 'app_latency_seconds_error_rate'], 'ms'),
+    ('app_latency_ms', None, ['app_latency_ms_throughput'], 'ms'),
+    ('app_latency', None, ['app_latency_throughput'], ''),
+]
+
+class HistogramFamilyMetricsTest(unittest.TestCase):
+    def test_templates(self):
+        for family, status_label, count_perf_names, unit in HISTOGRAM_FAMILIES:
+            with self.subTest(family=family):
+                metrics = histogram_family_metrics(family, status_label)
+                self.assertEqual([ k.perf_name for k in metrics['{}_count'.format(family)] ], count_perf_names)
+                self.assertEqual(set(k.unit for k in metrics['{}_bucket'.format(family)]), { unit })
+
+    def test_seconds_are_scaled(self):
+        p50 = histogram_family_metrics('app_latency_seconds')['app_latency_seconds_bucket'][0]
+        self.assertEqual(p50.format_query('m', 'm', '1m'), '1000 * histogram_quantile(0.5, sum(rate(m[1m])) by (le))')
+
+if __name__ == '__main__':
+    unittest.main()
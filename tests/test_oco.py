@@ -0,0 +1,115 @@
+import json
+import unittest
+
+from imb.imb_oco import apply_merge_patch, merge_patch_diff, OcoClient, OcoError
+
+# (source, target, expected merge patch)
+MERGE_PATCH_DIFFS = [
+    ({ 'a': { 'b': 1, 'c': 2 } }, { 'a': { 'b': 1, 'c': 3 } }, { 'a': { 'c': 3 } }), # nested change
+    ({ 'a': { 'b': { 'c': 1 } } }, { 'a': { 'b': { 'c': 1, 'd': 2 } } }, { 'a': { 'b': { 'd': 2 } } }), # nested addition
+    ({ 'a': 1, 'b': 2 }, { 'a': 1 }, { 'b': None }), # deletion
+    ({ 'a': { 'b': 1, 'c': 2 } }, { 'a': { 'b': 1 } }, { 'a': { 'c': None } }), # nested deletion
+    ({ 'a': [1, 2, 3] }, { 'a': [1, 2] }, { 'a': [1, 2] }), # lists are replaced whole
+    ({ 'a': { 'b': 1 } }, { 'a': [1] }, { 'a': [1] }), # type change
+    ({ 'a': 1, 'b': None }, { 'a': 1 }, None), # null values can't be expressed, dropping one is a no-op
+    ({ 'a': { 'b': [1] } }, { 'a': { 'b': [1] } }, None), # no-op
+    ({}, {}, None),
+]
+
+class MergePatchTest(unittest.TestCase):
+    def test_diff(self):
+        for source, target, expected in MERGE_PATCH_DIFFS:
+            with self.subTest(source=source, target=target):
+                self.assertEqual(merge_patch_diff(source, target), expected)
+
+    def test_diff_applies_to_target(self):
+        for source, target, expected in MERGE_PATCH_DIFFS:
+            if expected is None:
+                continue
+            with self.subTest(source=source, target=target):
+                self.assertEqual(apply_merge_patch(json.loads(json.dumps(source)), expected), target)
+
+    def test_apply(self):
+        self.assertEqual(apply_merge_patch({ 'a': { 'b': 1, 'c': 2 }, 'd': 1 }, { 'a': { 'b': None, 'e': 3 }, 'd': [1] }),
+            { 'a': { 'c': 2, 'e': 3 }, 'd': [1] })
+        self.assertEqual(apply_merge_patch({ 'a': 1 }, [1]), [1])
+        self.assertEqual(apply_merge_patch('a', { 'b': 1 }), { 'b': 1 })
+
+class FakeResponse:
+    def __init__(self, status, body=None, etag=None):
+        self.status_code = status
+        self.ok = status < 400
+        self.reason = 'Precondition Failed' if status == 412 else 'OK'
+        self.body = body
+        self.text = json.dumps(body)
+        self.headers = { 'ETag': etag } if etag else {}
+
+    def json(self):
+        return self.body
+
+class FakeSession:
+    'replays responses in order and records the requests made'
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, kwargs.get('headers'), json.loads(kwargs['data']) if 'data' in kwargs else None))
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+class OcoClientTest(unittest.TestCase):
+    def client(self, responses):
+        client = OcoClient('account', 'app', 'token')
+        client.session = FakeSession(responses)
+        return client
+
+    def test_update_sends_minimal_patch_with_etag(self):
+        client = self.client([
+            FakeResponse(200, { 'optimization': { 'mode': 'saturation', 'perf': 'a' } }, '"1"'),
+            FakeResponse(200, None, '"2"'),
+        ])
+        patch = client.merge_config({ 'optimization': { 'mode': 'saturation', 'perf': 'b' } })
+
+        self.assertEqual(patch, { 'optimization': { 'perf': 'b' } })
+        (_, _, _), (method, headers, data) = client.session.requests
+        self.assertEqual(method, 'PUT')
+        self.assertEqual(headers['If-Match'], '"1"')
+        self.assertEqual(headers['Content-Type'], 'application/merge-patch+json')
+        self.assertEqual(data, { 'optimization': { 'perf': 'b' } })
+        self.assertEqual(client.etag, '"2"')
+
+    def test_precondition_failed_rereads_and_retries(self):
+        client = self.client([
+            FakeResponse(200, { 'optimization': { 'perf': 'a' } }, '"1"'),
+            FakeResponse(412),
+            # changed concurrently, the patch is recomputed against the new config
+            FakeResponse(200, { 'optimization': { 'perf': 'a', 'mode': 'saturation' }, 'measurement': { 'past': 60 } }, '"2"'),
+            FakeResponse(200, None, '"3"'),
+        ])
+        patch = client.update_config(lambda config: config['measurement'].update(past=120) if 'measurement' in config else config.update(measurement={ 'past': 120 }))
+
+        self.assertEqual([ (m, h and h.get('If-Match')) for m, h, _ in client.session.requests ], [('GET', None), ('PUT', '"1"'), ('GET', None), ('PUT', '"2"')])
+        self.assertEqual(patch, { 'measurement': { 'past': 120 } })
+        self.assertEqual(client.config, { 'optimization': { 'perf': 'a', 'mode': 'saturation' }, 'measurement': { 'past': 120 } })
+
+    def test_no_op_update_is_not_sent(self):
+        client = self.client([ FakeResponse(200, { 'optimization': { 'perf': 'a' } }, '"1"') ])
+        self.assertIsNone(client.merge_config({ 'optimization': { 'perf': 'a' } }))
+        self.assertEqual(len(client.session.requests), 1)
+
+    def test_persistent_conflict_raises(self):
+        client = self.client([ FakeResponse(200, {}, '"1"'), FakeResponse(412) ] * 3)
+        with self.assertRaises(OcoError) as raised:
+            client.merge_config({ 'a': 1 })
+        self.assertEqual(raised.exception.status, 412)
+
+    def test_non_object_config_raises(self):
+        client = self.client([ FakeResponse(200, ['not', 'a', 'config']) ])
+        with self.assertRaises(OcoError):
+            client.get_config()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import asyncio
+import unittest
+
+from imb.imb_scheduler import DiscoveryScheduler
+
+# (tasks registered as (produces, needs), values provided, products computed in order)
+SCHEDULES = [
+    ([('pods', ['namespace'])], { 'namespace': 'default' }, ['pods']),
+    ([('pods', ['namespace']), ('metrics', ['pods', 'prometheus'])], { 'namespace': 'default', 'prometheus': 'url' }, ['pods', 'metrics']),
+    ([('metrics', ['pods', 'prometheus']), ('pods', ['namespace'])], { 'namespace': 'default', 'prometheus': 'url' }, ['pods', 'metrics']), # registration order doesn't matter
+    ([('pods', ['namespace']), ('metrics', ['pods', 'prometheus'])], { 'namespace': 'default' }, ['pods']), # metrics waits for prometheus
+    ([('a', []), ('b', ['a']), ('c', ['b'])], {}, ['a', 'b', 'c']),
+]
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+async def _settle():
+    # let started tasks, and tasks started by their completion, run
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+class DiscoverySchedulerTest(unittest.TestCase):
+    def test_dependency_order(self):
+        for tasks, provided, computed in SCHEDULES:
+            with self.subTest(tasks=tasks, provided=provided):
+                calls = []
+                async def scenario():
+                    scheduler = DiscoveryScheduler()
+                    for produces, needs in tasks:
+                        scheduler.task(produces, needs, _producer(produces, calls))
+                    for name, value in provided.items():
+                        scheduler.provide(name, value)
+                    await _settle()
+                    scheduler.cancel_all()
+                _run(scenario())
+                self.assertEqual([ produces for produces, _ in calls ], computed)
+
+    def test_products_are_computed_from_their_needs(self):
+        async def scenario():
+            scheduler = DiscoveryScheduler()
+            scheduler.task('b', ['a'], lambda a: a + 1) # plain functions run in the executor
+            scheduler.task('c', ['a', 'b'], _async(lambda a, b: a * b))
+            scheduler.provide('a', 2)
+            return await scheduler.get('c')
+        self.assertEqual(_run(scenario()), 6)
+
+    def test_provide_again_recomputes_dependents(self):
+        calls = []
+        async def scenario():
+            scheduler = DiscoveryScheduler()
+            scheduler.task('pods', ['namespace'], _producer('pods', calls))
+            scheduler.provide('namespace', 'a')
+            first = await scheduler.get('pods')
+            scheduler.provide('namespace', 'b')
+            return first, await scheduler.get('pods')
+        self.assertEqual(_run(scenario()), ('pods(namespace=a)', 'pods(namespace=b)'))
+        self.assertEqual(len(calls), 2)
+
+    def test_get_waits_for_replacement_of_invalidated_value(self):
+        async def scenario():
+            scheduler = DiscoveryScheduler()
+            release = asyncio.Event()
+            async def pods(namespace):
+                if namespace == 'a':
+                    await release.wait()
+                return namespace
+            scheduler.task('pods', ['namespace'], pods)
+            scheduler.provide('namespace', 'a')
+            waiting = asyncio.ensure_future(scheduler.get('pods'))
+            await _settle()
+            scheduler.provide('namespace', 'b')
+            return await waiting
+        self.assertEqual(_run(scenario()), 'b')
+
+    def test_failure_is_raised_then_retried(self):
+        attempts = []
+        async def flaky(namespace):
+            attempts.append(namespace)
+            if len(attempts) == 1:
+                raise ValueError('unavailable')
+            return 'pods'
+        async def scenario():
+            scheduler = DiscoveryScheduler()
+            scheduler.task('pods', ['namespace'], flaky)
+            scheduler.provide('namespace', 'default')
+            with self.assertRaises(ValueError):
+                await scheduler.get('pods')
+            return await scheduler.get('pods')
+        self.assertEqual(_run(scenario()), 'pods')
+        self.assertEqual(len(attempts), 2)
+
+    def test_retract_cancels_dependents(self):
+        async def scenario():
+            scheduler = DiscoveryScheduler()
+            scheduler.task('pods', ['namespace'], _async(lambda namespace: namespace))
+            scheduler.provide('namespace', 'default')
+            await scheduler.get('pods')
+            scheduler.retract('namespace')
+            await _settle()
+            return scheduler.values, scheduler.running
+        self.assertEqual(_run(scenario()), ({}, {}))
+
+def _producer(produces, calls):
+    async def produce(**needs):
+        calls.append((produces, needs))
+        return '{}({})'.format(produces, ','.join('{}={}'.format(k, v) for k, v in sorted(needs.items())))
+    return produce
+
+def _async(fn):
+    async def call(**kwargs):
+        return fn(**kwargs)
+    return call
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import math
+import unittest
+
+from imb import imb_stats
+
+# (values, lag 1 autocorrelation)
+AUTOCORRELATIONS = [
+    ([1, -1, 1, -1], -0.75),
+    ([1, 2, 3, 4], 0.25),
+    ([5, 5, 5, 5], 0.0), # constant
+    ([1], 0.0), # too short
+]
+
+STEP = 15
+CANDIDATE_WINDOWS = [60, 300, 900]
+
+# (values sampled every STEP seconds, max cv, recommended window, windows analyzed)
+RECOMMENDED_WINDOWS = [
+    ([10.0] * 60, 0.05, 60, [60]), # constant
+    ([10, 12] * 30, 0.05, 60, [60]), # noisy but uncorrelated, averages out within 4 points
+    ([10, 12] * 30, 0.025, 300, [60, 300]),
+    ([float(v) for v in range(1, 61)], 0.05, 900, [60, 300, 900]), # trending, never stable so the longest window is recommended
+    ([10, float('nan'), 10, float('inf')] * 15, 0.05, 60, [60]), # non finite values are dropped
+    ([0.0] * 60, 0.05, None, []), # zero mean, the cv is undefined
+    ([10.0], 0.05, None, []), # too few values
+]
+
+class StatsTest(unittest.TestCase):
+    def test_autocorrelation(self):
+        for values, expected in AUTOCORRELATIONS:
+            with self.subTest(values=values):
+                self.assertAlmostEqual(imb_stats.autocorrelation(values), expected)
+
+    def test_summarize(self):
+        summary = imb_stats.summarize([1, 2, 3, 4, float('nan')])
+        self.assertEqual(summary, { 'mean': 2.5, 'p50': 2.5, 'p95': 3.85, 'max': 4, 'variance': 1.25, 'samples': 4 })
+        self.assertIsNone(imb_stats.summarize([float('nan')]))
+
+    def test_correlated_series_needs_longer_window(self):
+        # the same point cv, but autocorrelation means fewer effective samples per window
+        uncorrelated = imb_stats.window_stability([10, 12] * 30, STEP, 60)
+        correlated = imb_stats.window_stability([10] * 4 + [12] * 4 + [10] * 4 + [12] * 4, STEP, 60)
+        self.assertEqual(uncorrelated['autocorrelation'], 0.0)
+        self.assertGreater(correlated['autocorrelation'], 0.5)
+        self.assertGreater(correlated['estimated_cv'], uncorrelated['estimated_cv'])
+        self.assertTrue(math.isclose(correlated['cv'], max(correlated['estimated_cv'], correlated['empirical_cv'])))
+
+    def test_recommend_window(self):
+        for values, max_cv, window, analyzed in RECOMMENDED_WINDOWS:
+            with self.subTest(values=values[:4], max_cv=max_cv):
+                recommended, analysis = imb_stats.recommend_window(values, STEP, CANDIDATE_WINDOWS, max_cv)
+                self.assertEqual(recommended, window)
+                self.assertEqual(sorted(analysis), analyzed)
+
+if __name__ == '__main__':
+    unittest.main()